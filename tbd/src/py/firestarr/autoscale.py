@@ -0,0 +1,318 @@
+"""
+Size the batch pool from how long queued simulations are expected to take
+
+Usage: python autoscale.py [deadline_minutes] [max_runs]
+    Replay past runs to compare cost and makespan against the static formula
+"""
+
+import glob
+import heapq
+import json
+import math
+import os
+import sys
+
+import azure.batch.models as batchmodels
+import numpy as np
+import pandas as pd
+from azurebatch import (
+    _AUTO_SCALE_EVALUATION_INTERVAL,
+    _AUTO_SCALE_FORMULA,
+    _MAX_NODES,
+    _MIN_NODES,
+    _USE_LOW_PRIORITY,
+    POOL_ID,
+    get_batch_client,
+    get_task_name,
+    list_task_states,
+)
+from common import CONFIG, DIR_SIMS, logging
+
+# seconds to assume a simulation takes if there's nothing to go on
+DEFAULT_SIM_TIME = 600
+# seconds a node takes to start before it can run anything
+NODE_START_TIME = 300
+# how many past runs to learn simulation times from
+HISTORY_RUNS = 20
+# run folder -> (mtime, DataFrame) so finished runs are only read once
+SIM_HISTORY = {}
+# pool_id -> last target pushed so we don't keep replacing the formula
+LAST_TARGET = {}
+
+
+def get_deadline():
+    deadline = CONFIG.get("AUTOSCALE_DEADLINE_MINUTES", None)
+    # nothing set means use static formula
+    return None if not deadline else float(deadline) * 60
+
+
+def read_sim_attributes(dir_fire):
+    # NOTE: only want properties so don't bother with geopandas
+    for file_sim in glob.glob(os.path.join(dir_fire, "firestarr_*.geojson")):
+        try:
+            with open(file_sim) as f:
+                features = json.load(f)["features"]
+            if 1 == len(features):
+                return features[0]["properties"]
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            logging.warning(f"Couldn't read {file_sim}: {ex}")
+    return None
+
+
+def read_run_history(dir_sims):
+    rows = []
+    for dir_fire in sorted(glob.glob(os.path.join(dir_sims, "*"))):
+        data = read_sim_attributes(dir_fire)
+        if data is not None:
+            rows.append(
+                {
+                    "task_id": get_task_name(dir_fire),
+                    "area": data.get("area", None),
+                    "max_days": data.get("max_days", None),
+                    "sim_time": data.get("sim_time", None),
+                }
+            )
+    df = pd.DataFrame(rows, columns=["task_id", "area", "max_days", "sim_time"])
+    df["run"] = os.path.basename(dir_sims)
+    return df
+
+
+def read_sim_history(max_runs=HISTORY_RUNS, exclude=[]):
+    exclude = set(os.path.normpath(x) for x in exclude)
+    runs = [
+        x
+        for x in sorted(glob.glob(os.path.join(DIR_SIMS, "*")))
+        if os.path.isdir(x) and os.path.normpath(x) not in exclude
+    ][-max_runs:]
+    dfs = []
+    for dir_sims in runs:
+        mtime = os.path.getmtime(dir_sims)
+        cached = SIM_HISTORY.get(dir_sims, None)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, read_run_history(dir_sims))
+            SIM_HISTORY[dir_sims] = cached
+        dfs.append(cached[1])
+    if not dfs:
+        return pd.DataFrame(columns=["task_id", "area", "max_days", "sim_time", "run"])
+    df = pd.concat(dfs, ignore_index=True)
+    return df.loc[pd.to_numeric(df["sim_time"], errors="coerce") > 0]
+
+
+def make_features(df):
+    area = pd.to_numeric(df["area"], errors="coerce").fillna(0).clip(lower=0).to_numpy(dtype=float)
+    max_days = pd.to_numeric(df["max_days"], errors="coerce").fillna(0).to_numpy(dtype=float)
+    return np.column_stack([np.ones(len(df)), np.log1p(area), max_days])
+
+
+def fit_sim_times(df_history):
+    """!
+    Fit log(simulation time) to fire size and number of days simulated
+    @param df_history DataFrame with area, max_days and sim_time columns
+    @return Coefficients for make_features(), or None if not enough history
+    """
+    if len(df_history) < 10:
+        return None
+    y = np.log(pd.to_numeric(df_history["sim_time"]).to_numpy(dtype=float))
+    coef, _, _, _ = np.linalg.lstsq(make_features(df_history), y, rcond=None)
+    return coef
+
+
+def predict_sim_times(df_fires, df_history):
+    """!
+    Predict how long each simulation will take
+    @param df_fires DataFrame with task_id, area and max_days columns
+    @param df_history DataFrame of past simulations from read_sim_history()
+    @return Series of predicted seconds for each fire
+    """
+    predicted = pd.Series(float(DEFAULT_SIM_TIME), index=df_fires.index)
+    coef = fit_sim_times(df_history)
+    if coef is not None and len(df_fires):
+        predicted[:] = np.exp(make_features(df_fires) @ coef)
+    # same fire in an earlier run is a better guess than the fit
+    last = df_history.drop_duplicates("task_id", keep="last").set_index("task_id")["sim_time"]
+    previous = pd.to_numeric(df_fires["task_id"].map(last), errors="coerce")
+    return previous.fillna(predicted).astype(float)
+
+
+def find_makespan(times, num_nodes, start_time=NODE_START_TIME):
+    # longest first onto whichever node frees up first
+    if 0 == len(times):
+        return 0
+    nodes = [start_time] * max(1, int(num_nodes))
+    for t in sorted(times, reverse=True):
+        heapq.heappush(nodes, heapq.heappop(nodes) + t)
+    return max(nodes)
+
+
+def find_node_cost(times, num_nodes, start_time=NODE_START_TIME):
+    # nodes deallocate on task completion so cost is work plus startup for each node used
+    return sum(times) + start_time * min(len(times), max(1, int(num_nodes)))
+
+
+def find_target_nodes(times, deadline, min_nodes=_MIN_NODES, max_nodes=_MAX_NODES):
+    """!
+    Find fewest nodes that finish the work before the deadline
+    @param times Predicted seconds for each task
+    @param deadline Seconds to finish everything in
+    @param min_nodes Fewest nodes to return
+    @param max_nodes Most nodes to return
+    @return Number of nodes
+    """
+    times = list(times)
+    if 0 == len(times):
+        return min_nodes
+    # no point in having more nodes than tasks
+    upper = max(min_nodes, min(max_nodes, len(times)))
+    lower = max(min_nodes, 1, min(upper, math.ceil(sum(times) / max(1, deadline - NODE_START_TIME))))
+    for n in range(lower, upper + 1):
+        if find_makespan(times, n) <= deadline:
+            return n
+    logging.warning(f"Can't finish {len(times)} tasks in {deadline}s with {upper} nodes")
+    return upper
+
+
+def make_formula(target, min_nodes=_MIN_NODES, max_nodes=_MAX_NODES, use_low_priority=_USE_LOW_PRIORITY):
+    # still drop nodes as queue empties, but never ask for more than the work needs
+    return f"""
+    $min_nodes = {min_nodes};
+    $max_nodes = {max_nodes};
+    $pending = val($PendingTasks.GetSample(1), 0);
+    $want_nodes = max($min_nodes, min($max_nodes, min($pending, {int(target)})));
+    $TargetDedicatedNodes = {"$min_nodes" if use_low_priority else "$want_nodes"};
+    $TargetLowPriorityNodes = {"max(0, $want_nodes - $TargetDedicatedNodes)" if use_low_priority else "0"};
+    $NodeDeallocationOption = taskcompletion;
+"""
+
+
+def find_queued_times(job_id, dirs_fire, client=None):
+    # NOTE: list once instead of starting a poller since this runs before workers fork
+    tasks = list_task_states(job_id, client=client) or {}
+    df_fires = pd.DataFrame(
+        [
+            {"task_id": get_task_name(dir_fire), **(read_sim_attributes(dir_fire) or {})}
+            for dir_fire in dirs_fire
+            if "completed" != getattr(tasks.get(get_task_name(dir_fire), None), "state", None)
+        ],
+        columns=["task_id", "area", "max_days"],
+    )
+    # run being scaled for shouldn't count as history for itself
+    dirs_run = set(os.path.dirname(os.path.normpath(dir_fire)) for dir_fire in dirs_fire)
+    return predict_sim_times(df_fires, read_sim_history(exclude=dirs_run))
+
+
+def scale_for_tasks(job_id, dirs_fire, deadline=None, pool_id=POOL_ID, resize=False, client=None):
+    """!
+    Set pool size from the predicted work left for a job
+    @param job_id Job that tasks are in
+    @param dirs_fire Simulation directories that tasks are for
+    @param deadline Seconds to finish in (None to use AUTOSCALE_DEADLINE_MINUTES)
+    @param pool_id Pool to scale
+    @param resize Whether to resize directly instead of pushing a formula
+    @param client Batch client to use
+    @return Number of nodes asked for, or None if not scaling
+    """
+    if deadline is None:
+        deadline = get_deadline()
+        if deadline is None:
+            return None
+    if client is None:
+        client = get_batch_client()
+    times = find_queued_times(job_id, dirs_fire, client=client)
+    target = find_target_nodes(times, deadline)
+    logging.info(f"Want {target} nodes to run {len(times)} tasks ({times.sum():0.0f}s) in {deadline}s")
+    if LAST_TARGET.get(pool_id, None) == (target, resize):
+        return target
+    num_low = max(0, target - _MIN_NODES) if _USE_LOW_PRIORITY else 0
+    if resize:
+        pool = client.pool.get(pool_id)
+        if pool.enable_auto_scale:
+            client.pool.disable_auto_scale(pool_id)
+        client.pool.resize(
+            pool_id,
+            batchmodels.PoolResizeParameter(
+                target_dedicated_nodes=target - num_low,
+                target_low_priority_nodes=num_low,
+                node_deallocation_option="taskcompletion",
+            ),
+        )
+    else:
+        client.pool.enable_auto_scale(
+            pool_id,
+            auto_scale_formula=make_formula(target),
+            auto_scale_evaluation_interval=_AUTO_SCALE_EVALUATION_INTERVAL,
+        )
+    LAST_TARGET[pool_id] = (target, resize)
+    return target
+
+
+def restore_autoscale(pool_id=POOL_ID, client=None):
+    """!
+    Put back the static formula if scale_for_tasks() changed how the pool scales
+    @param pool_id Pool to restore
+    @param client Batch client to use
+    @return Whether anything was restored
+    """
+    if LAST_TARGET.pop(pool_id, None) is None:
+        return False
+    if client is None:
+        client = get_batch_client()
+    logging.info(f"Restoring autoscale formula for {pool_id}")
+    # also turns autoscale back on if resizing turned it off
+    client.pool.enable_auto_scale(
+        pool_id,
+        auto_scale_formula=_AUTO_SCALE_FORMULA,
+        auto_scale_evaluation_interval=_AUTO_SCALE_EVALUATION_INTERVAL,
+    )
+    return True
+
+
+def replay_history(deadline, max_runs=HISTORY_RUNS):
+    """!
+    Compare static formula with work-aware scaling on past runs
+    @param deadline Seconds to finish each run in
+    @param max_runs Number of past runs to replay
+    @return DataFrame with makespan and node hours for each run and policy
+    """
+    df_all = read_sim_history(max_runs=max_runs + HISTORY_RUNS)
+    # already in order they ran in
+    runs = list(df_all["run"].unique())
+    rows = []
+    for i in range(max(0, len(runs) - max_runs), len(runs)):
+        run = runs[i]
+        df_run = df_all.loc[df_all["run"] == run]
+        times = pd.to_numeric(df_run["sim_time"]).to_numpy(dtype=float)
+        # only learn from what would have been known then
+        df_before = df_all.loc[df_all["run"].isin(runs[:i])]
+        predicted = predict_sim_times(df_run, df_before)
+        policies = {
+            # static formula asks for a node per pending task up to the max
+            "static": min(_MAX_NODES, len(times)),
+            "work": find_target_nodes(predicted, deadline),
+        }
+        for policy, num_nodes in policies.items():
+            rows.append(
+                {
+                    "run": run,
+                    "policy": policy,
+                    "tasks": len(times),
+                    "nodes": num_nodes,
+                    "makespan_min": find_makespan(times, num_nodes) / 60,
+                    "node_hours": find_node_cost(times, num_nodes) / 3600,
+                    "late": find_makespan(times, num_nodes) > deadline,
+                }
+            )
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    deadline_minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    max_runs = int(sys.argv[2]) if len(sys.argv) > 2 else HISTORY_RUNS
+    df = replay_history(deadline_minutes * 60, max_runs=max_runs)
+    if 0 == len(df):
+        print(f"No simulation history in {DIR_SIMS}")
+        sys.exit(-1)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(df.to_string(index=False, float_format="{:0.1f}".format))
+        print(df.groupby("policy")[["makespan_min", "node_hours", "late"]].agg(["mean", "sum"]))
@@ -1,7 +1,10 @@
 import datetime
+import itertools
 import os
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import azure.batch as batch
 import azure.batch.batch_auth as batchauth
@@ -124,8 +127,42 @@ RELATIVE_MOUNT_PATH = "firestarr_data"
 ABSOLUTE_MOUNT_PATH = f"/mnt/batch/tasks/fsmounts/{RELATIVE_MOUNT_PATH}"
 # check every 30s
 TASK_SLEEP = 30
+# how often the background poller lists the states of tasks in a job
+TASK_POLL_SLEEP = 10
+# list everything every so often so tasks deleted elsewhere drop out of the snapshot
+TASK_POLL_FULL_EVERY = 30
+# allow for clocks not matching the batch service when only listing changed tasks
+TASK_POLL_MARGIN = datetime.timedelta(minutes=1)
+# only need enough of each task to know what it's doing
+TASK_STATE_SELECT = "id,state,executionInfo"
+# batch won't take more than this many tasks in one add_collection call
+TASK_COLLECTION_LIMIT = 100
+# how many api calls to make at once when submitting or changing tasks
+TASK_SUBMIT_THREADS = 8
+TASK_SUBMIT_RETRIES = 5
 
 CLIENT = None
+# job_id -> {"time": time of last listing, "full": time of last full listing,
+#            "tasks": {task_id: task}, "touched": {task_id: time}}
+TASK_STATES = {}
+TASK_STATES_LOCK = threading.Lock()
+TASK_POLLERS = {}
+# only the process that loaded this polls, so forked workers don't each start their own
+TASK_POLLER_PID = os.getpid()
+
+
+def reset_after_fork():
+    global CLIENT, TASK_STATES_LOCK
+    # NOTE: lock could have been held by a thread that doesn't exist in the child
+    TASK_STATES_LOCK = threading.Lock()
+    TASK_STATES.clear()
+    TASK_POLLERS.clear()
+    # HACK: don't share the parent's connections, but keep anything set with set_batch_client()
+    if isinstance(CLIENT, batch.BatchServiceClient):
+        CLIENT = None
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
 
 
 def restart_unusable_nodes(pool_id=POOL_ID, client=None):
@@ -295,10 +332,96 @@ def add_monolithic_task(job_id, client=None):
     client.task.add_collection(job_id, tasks)
 
 
+def run_parallel(fct, values):
+    # NOTE: just waiting on api calls so threads are fine
+    with ThreadPoolExecutor(max_workers=TASK_SUBMIT_THREADS) as pool:
+        return list(pool.map(fct, values))
+
+
+def add_task_chunk(job_id, tasks, client=None):
+    if client is None:
+        client = get_batch_client()
+    for attempt in range(TASK_SUBMIT_RETRIES):
+        if attempt > 0:
+            time.sleep(2**attempt)
+        try:
+            result = client.task.add_collection(job_id, tasks)
+            failed = {
+                r.task_id: r.error
+                for r in (getattr(result, "value", None) or [])
+                if "success" != r.status and not (r.error is not None and "TaskExists" == r.error.code)
+            }
+            if not failed:
+                return []
+            logging.warning(f"Retrying {len(failed)} tasks that weren't added: {list(failed.values())[0]}")
+            tasks = [t for t in tasks if t.id in failed]
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            logging.warning(f"Retrying adding {len(tasks)} tasks after {ex}")
+            # some of them might have been added before it failed
+            existing = list_task_states(job_id, client=client) or {}
+            tasks = [t for t in tasks if t.id not in existing]
+            if not tasks:
+                return []
+    return tasks
+
+
 def schedule_job_tasks(job_id, tasks, client=None):
     if client is None:
         client = get_batch_client()
-    client.task.add_collection(job_id, tasks)
+    chunks = [tasks[i : i + TASK_COLLECTION_LIMIT] for i in range(0, len(tasks), TASK_COLLECTION_LIMIT)]
+    failed = list(
+        itertools.chain.from_iterable(run_parallel(lambda chunk: add_task_chunk(job_id, chunk, client=client), chunks))
+    )
+    # one listing instead of looking each of them up after
+    refresh_task_states(job_id, client=client)
+    if failed:
+        raise RuntimeError(f"Couldn't add {len(failed)} tasks to job {job_id}: {[t.id for t in failed]}")
+
+
+def wait_for_deleted(job_id, task_ids, client=None):
+    left = set(task_ids)
+    while left:
+        # one listing for everything instead of checking each task
+        left = left & set((list_task_states(job_id, client=client) or {}).keys())
+        if left:
+            print(".", end="", flush=True)
+            time.sleep(1)
+    for task_id in task_ids:
+        forget_task(job_id, task_id)
+
+
+def submit_simulation_tasks(job_id, dirs_fire, client=None):
+    if client is None:
+        client = get_batch_client()
+    tasks = refresh_task_states(job_id, client=client)
+    if tasks is None:
+        raise RuntimeError(f"Job {job_id} not found")
+    dirs_by_task = {get_task_name(dir_fire): dir_fire for dir_fire in dirs_fire}
+    existing = {k: tasks[k] for k in dirs_by_task.keys() if k in tasks}
+    failed = [k for k, task in existing.items() if is_failed(task)]
+    # HACK: since sim.sh will complete successfully without running if run already succeeded, there's no harm in running tasks again
+    done = [k for k, task in existing.items() if "completed" == task.state and k not in failed]
+    if failed:
+        logging.warning(f"Reactivating {len(failed)} failed tasks")
+
+        def reactivate(task_id):
+            client.task.reactivate(job_id, task_id)
+            forget_task(job_id, task_id)
+
+        run_parallel(reactivate, failed)
+    if done:
+        logging.warning(f"Deleting {len(done)} completed tasks to rerun")
+        run_parallel(lambda task_id: client.task.delete(job_id, task_id), done)
+        wait_for_deleted(job_id, done, client=client)
+    missing = [k for k in dirs_by_task.keys() if k not in existing or k in done]
+    schedule_job_tasks(
+        job_id,
+        [make_simulation_task(dirs_by_task[k], client=client) for k in missing],
+        client=client,
+    )
+    return list(dirs_by_task.keys())
 
 
 def get_task_name(dir_fire):
@@ -311,29 +434,196 @@ def get_task_name(dir_fire):
 #     return task_id.replace("-", "/")
 
 
-def find_tasks_running(job_id, dir_fire, client=None):
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def list_task_states(job_id, since=None, client=None):
     if client is None:
         client = get_batch_client()
+    task_filter = None
+    if since is not None:
+        # only need tasks that changed since the last listing
+        since = (since - TASK_POLL_MARGIN).strftime("%Y-%m-%dT%H:%M:%SZ")
+        task_filter = f"stateTransitionTime gt DateTime'{since}'"
+    try:
+        return {
+            task.id: task
+            for task in client.task.list(
+                job_id,
+                task_list_options=batchmodels.TaskListOptions(select=TASK_STATE_SELECT, filter=task_filter),
+            )
+        }
+    except batchmodels.BatchErrorException as ex:
+        if "JobNotFound" != ex.error.code:
+            raise ex
     # no tasks if job doesn't exist
-    jobs = [x.id for x in client.job.list()]
-    if job_id not in jobs:
-        return []
+    return None
+
+
+def refresh_task_states(job_id, full=False, client=None):
+    with TASK_STATES_LOCK:
+        entry = TASK_STATES.get(job_id, None)
+    have_tasks = entry is not None and entry["tasks"] is not None
+    since = entry["time"] if have_tasks and not full else None
+    t0 = utc_now()
+    tasks = list_task_states(job_id, since=since, client=client)
+    with TASK_STATES_LOCK:
+        entry = TASK_STATES.get(job_id, None)
+        have_tasks = entry is not None and entry["tasks"] is not None
+        # anything changed here while listing is newer than what the listing says
+        touched = {} if entry is None else {k: v for k, v in entry["touched"].items() if v > t0}
+        if tasks is None:
+            TASK_STATES[job_id] = {"time": t0, "full": t0, "tasks": None, "touched": touched}
+            return None
+        merged = {}
+        if have_tasks:
+            if since is None:
+                merged = {k: entry["tasks"][k] for k in touched if k in entry["tasks"]}
+            else:
+                merged = dict(entry["tasks"])
+        merged.update({k: v for k, v in tasks.items() if k not in touched})
+        time_full = t0
+        if since is not None:
+            # NOTE: snapshot could have been cleared while listing
+            time_full = entry["full"] if have_tasks else datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        TASK_STATES[job_id] = {"time": t0, "full": time_full, "tasks": merged, "touched": touched}
+        return merged
+
+
+def poll_task_states(job_id, stop, client=None):
+    n = 0
+    while not stop.wait(TASK_POLL_SLEEP):
+        try:
+            n = (n + 1) % TASK_POLL_FULL_EVERY
+            refresh_task_states(job_id, full=(0 == n), client=client)
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            # HACK: readers list directly if snapshot gets stale so just keep trying
+            logging.warning(f"Ignoring error polling tasks for {job_id}: {ex}")
+
+
+def start_task_poller(job_id, client=None):
+    if os.getpid() != TASK_POLLER_PID:
+        # forked workers just list when their snapshot is too old
+        return
+    if client is None:
+        client = get_batch_client()
+    with TASK_STATES_LOCK:
+        poller = TASK_POLLERS.get(job_id, None)
+        if poller is None or not poller[0].is_alive():
+            stop = threading.Event()
+            thread = threading.Thread(target=poll_task_states, args=[job_id, stop, client], daemon=True)
+            TASK_POLLERS[job_id] = (thread, stop)
+            thread.start()
+
+
+def stop_task_pollers():
+    with TASK_STATES_LOCK:
+        pollers = list(TASK_POLLERS.values())
+        TASK_POLLERS.clear()
+    for thread, stop in pollers:
+        stop.set()
+    for thread, stop in pollers:
+        thread.join()
+    with TASK_STATES_LOCK:
+        TASK_STATES.clear()
+
+
+def get_task_states(job_id, client=None, max_age=None):
+    if max_age is None:
+        max_age = 2 * TASK_POLL_SLEEP
+    start_task_poller(job_id, client=client)
+    with TASK_STATES_LOCK:
+        entry = TASK_STATES.get(job_id, None)
+    # list directly if there's nothing yet or poller isn't keeping up
+    if entry is None or entry["tasks"] is None or (utc_now() - entry["time"]).total_seconds() > max_age:
+        return refresh_task_states(job_id, client=client)
+    return entry["tasks"]
+
+
+def set_task_state(job_id, task_id, task):
+    with TASK_STATES_LOCK:
+        entry = TASK_STATES.get(job_id, None)
+        if entry is None or entry["tasks"] is None:
+            # next listing will pick it up
+            return
+        # NOTE: replace instead of changing so anything iterating over old snapshot is fine
+        tasks = dict(entry["tasks"])
+        if task is None:
+            tasks.pop(task_id, None)
+        else:
+            tasks[task_id] = task
+        entry["tasks"] = tasks
+        entry["touched"][task_id] = utc_now()
+
+
+def forget_task(job_id, task_id):
+    set_task_state(job_id, task_id, None)
+
+
+def wait_for_task(job_id, task_id, exists, client=None):
+    # wait on the shared snapshot instead of asking about the task every second
+    t0 = utc_now()
+    # NOTE: tasks that are gone only drop out of the snapshot on a full listing
+    key = "time" if exists else "full"
+    while True:
+        with TASK_STATES_LOCK:
+            entry = TASK_STATES.get(job_id, None)
+        if entry is not None and entry[key] > t0:
+            tasks = entry["tasks"] or {}
+            if exists == (task_id in tasks):
+                return
+        if entry is None or (utc_now() - entry[key]).total_seconds() > 2 * TASK_POLL_SLEEP:
+            # poller isn't keeping up, or this isn't the process that polls
+            refresh_task_states(job_id, full=not exists, client=client)
+            continue
+        print(".", end="", flush=True)
+        time.sleep(TASK_POLL_SLEEP)
+
+
+def get_task_state(job_id, task_id, client=None, refresh=False):
+    if not refresh:
+        tasks = get_task_states(job_id, client=client)
+        task = None if tasks is None else tasks.get(task_id, None)
+        if task is not None:
+            return task
+    if client is None:
+        client = get_batch_client()
+    # not in snapshot so might have just been added
+    try:
+        task = client.task.get(
+            job_id,
+            task_id,
+            task_get_options=batchmodels.TaskGetOptions(select=TASK_STATE_SELECT),
+        )
+    except batchmodels.BatchErrorException as ex:
+        if "TaskNotFound" != ex.error.code:
+            raise ex
+        task = None
+    set_task_state(job_id, task_id, task)
+    return task
+
+
+def find_tasks_running(job_id, dir_fire, client=None):
     # # HACK: want to check somewhere and this seems good enough for now
     # restart_unusable_nodes(client=client)
+    tasks = get_task_states(job_id, client=client)
+    # no tasks if job doesn't exist
+    if tasks is None:
+        return []
     task_name = get_task_name(dir_fire)
-    tasks = []
-    # try:
-    for task in client.task.list(job_id):
-        if task_name in task.id and "completed" != task.state:
-            tasks.append(task.id)
-    return tasks
-    # except batchmodels.BatchErrorException:
-    #     return False
+    return [task.id for task in tasks.values() if task_name in task.id and "completed" != task.state]
 
 
 def is_successful(obj):
-    return "active" != obj.state and (
-        "success" == obj.execution_info.result or "TaskEnded" == obj.execution_info.failure_info.code
+    # NOTE: running tasks don't have a result or failure_info yet
+    info = obj.execution_info
+    return (
+        "active" != obj.state
+        and info is not None
+        and ("success" == info.result or (info.failure_info is not None and "TaskEnded" == info.failure_info.code))
     )
 
 
@@ -342,29 +632,26 @@ def is_failed(obj):
 
 
 def check_successful(job_id, task_id=None, client=None):
-    if client is None:
-        client = get_batch_client()
     if task_id is not None:
-        return is_successful(client.task.get(job_id, task_id))
+        task = get_task_state(job_id, task_id, client=client)
+        if task is None:
+            raise RuntimeError(f"Task {task_id} not found in job {job_id}")
+        return is_successful(task)
     else:
+        tasks = get_task_states(job_id, client=client)
+        if tasks is None:
+            logging.error(f"Job {job_id} not found")
+            return False
         # check if all tasks in job are done
-        for task in client.task.list(job_id):
+        for task in tasks.values():
             if not is_successful(task):
                 logging.error(f"Task {task.id} not successful")
                 return False
         return True
 
 
-def task_exists(job_id, task_id, client=None):
-    if client is None:
-        client = get_batch_client()
-    try:
-        task = client.task.get(job_id, task_id)
-        return True
-    except batchmodels.BatchErrorException as ex:
-        if "TaskNotFound" != ex.error.code:
-            raise ex
-    return False
+def task_exists(job_id, task_id, client=None, refresh=False):
+    return get_task_state(job_id, task_id, client=client, refresh=refresh) is not None
 
 
 def job_exists(job_id, client=None):
@@ -379,29 +666,27 @@ def job_exists(job_id, client=None):
     return False
 
 
+def make_simulation_task(dir_fire, client=None):
+    return batch.models.TaskAddParameter(
+        id=get_task_name(dir_fire),
+        command_line="./sim.sh",
+        container_settings=get_container_settings(
+            _CONTAINER_BIN,
+            workdir=dir_fire,
+            client=client,
+        ),
+        user_identity=get_user_identity(),
+    )
+
+
 def make_or_get_simulation_task(job_id, dir_fire, client=None):
     if client is None:
         client = get_batch_client()
     task_id = get_task_name(dir_fire)
-    existed = False
-    task = None
-    try:
-        task = client.task.get(job_id, task_id)
-        existed = True
-    except batchmodels.BatchErrorException as ex:
-        if "TaskNotFound" != ex.error.code:
-            raise ex
+    task = get_task_state(job_id, task_id, client=client)
+    existed = task is not None
     if task is None:
-        task = batch.models.TaskAddParameter(
-            id=task_id,
-            command_line="./sim.sh",
-            container_settings=get_container_settings(
-                _CONTAINER_BIN,
-                workdir=dir_fire,
-                client=client,
-            ),
-            user_identity=get_user_identity(),
-        )
+        task = make_simulation_task(dir_fire, client=client)
     return task, existed
 
 
@@ -424,6 +709,7 @@ def add_simulation_task(job_id, dir_fire, wait=True, client=None, mark_as_done=F
                 # just return if no task but it's done already
                 # HACK: delete since can't mark as complete without showing as failure and still requesting nodes in AutoScale
                 client.task.delete(job_id, task.id)
+                forget_task(job_id, task.id)
                 return None
 
             # HACK: since sim.sh will complete successfully without running if run already succeeded, there's no harm in running tasks again
@@ -434,9 +720,8 @@ def add_simulation_task(job_id, dir_fire, wait=True, client=None, mark_as_done=F
                 #     client.job.enable(job.id)
                 logging.warning(f"Deleting completed task to rerun {dir_fire}")
                 client.task.delete(job_id, task.id)
-                while task_exists(job_id, task.id):
-                    print(".", end="", flush=True)
-                    time.sleep(1)
+                forget_task(job_id, task.id)
+                wait_for_task(job_id, task.id, False, client=client)
                 # remake task so it can be added
                 task, task_existed = make_or_get_simulation_task(job_id, dir_fire, client=client)
         if mark_as_done:
@@ -445,8 +730,7 @@ def add_simulation_task(job_id, dir_fire, wait=True, client=None, mark_as_done=F
         if not task_existed:
             client.task.add(job_id, task)
             # wait until task is added
-            while not task_exists(job_id, task.id, client):
-                time.sleep(1)
+            wait_for_task(job_id, task.id, True, client=client)
         if not check_successful(job_id, task.id, client=client):
             # need to get task again in case it was just added
             task, task_existed = make_or_get_simulation_task(job_id, dir_fire, client=client)
@@ -454,13 +738,15 @@ def add_simulation_task(job_id, dir_fire, wait=True, client=None, mark_as_done=F
             if wait:
                 while True:
                     while True:
-                        task = client.task.get(job_id, task.id)
+                        task = get_task_state(job_id, task.id, client=client)
                         if "active" == task.state:
                             time.sleep(TASK_SLEEP)
                         else:
                             break
                     if "failure" == task.execution_info.result:
                         client.task.reactivate(job_id, task.id)
+                        # snapshot still says it failed
+                        forget_task(job_id, task.id)
                     else:
                         break
         # # HACK: want to check somewhere and this seems good enough for now
@@ -582,24 +868,33 @@ def show_result(job_id=None, task_id=None):
 def wait_for_tasks_to_complete(job_id, client=None):
     if client is None:
         client = get_batch_client()
-    tasks = [x for x in client.task.list(job_id)]
+    tasks = get_task_states(job_id, client=client) or {}
     left = len(tasks)
     prev = left
     with tqdm(desc="Waiting for tasks", total=len(tasks)) as tq:
         while left > 0:
-            # does this update or do we need to get them again?
-            incomplete_tasks = [task for task in tasks if task.state != batchmodels.TaskState.completed]
+            incomplete_tasks = [task for task in tasks.values() if task.state != batchmodels.TaskState.completed]
             left = len(incomplete_tasks)
             tq.update(prev - left)
             prev = left
             print(".", end="", flush=True)
             time.sleep(1)
-            tasks = client.task.list(job_id)
+            # NOTE: poller keeps this up to date so it's not calling the api every time
+            tasks = get_task_states(job_id, client=client) or {}
         print("", flush=True)
 
 
 def have_batch_config():
-    return _BATCH_ACCOUNT_NAME and _BATCH_ACCOUNT_KEY
+    return CLIENT is not None or (_BATCH_ACCOUNT_NAME and _BATCH_ACCOUNT_KEY)
+
+
+def set_batch_client(client):
+    # use something like azurebatch_local.LocalBatchClient instead of connecting to batch
+    global CLIENT
+    # pollers are holding on to the old client
+    stop_task_pollers()
+    CLIENT = client
+    return CLIENT
 
 
 def get_batch_client():
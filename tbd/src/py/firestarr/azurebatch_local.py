@@ -0,0 +1,696 @@
+"""
+Local stand-in for azure.batch.BatchServiceClient
+
+Only covers the operations azurebatch.py uses, so jobs, tasks, pools and nodes
+can be exercised without a batch account. Tasks either run their command line
+(./sim.sh) in the directory given by --workdir in their container settings, or
+just take a fixed amount of time if run_commands is False. Every api call is
+counted and can be delayed to see how much the scheduling code talks to batch.
+Forked workers each get their own copy of everything, so tasks they submit run
+there and only they can see them.
+
+    from azurebatch import set_batch_client
+    from azurebatch_local import LocalBatchClient
+    set_batch_client(LocalBatchClient(num_nodes=4, run_commands=False))
+"""
+
+import copy
+import datetime
+import os
+import re
+import subprocess
+import threading
+import time
+import types
+import weakref
+from collections import Counter
+
+import azure.batch.models as batchmodels
+from common import logging
+
+# seconds between scheduler passes
+LOCAL_TICK = 0.05
+# seconds a simulated task takes when not running commands
+LOCAL_TASK_DURATION = 1.0
+# clients that need their scheduler started again in forked children
+LOCAL_CLIENTS = weakref.WeakSet()
+
+
+def restart_after_fork():
+    for client in list(LOCAL_CLIENTS):
+        client.restart_after_fork()
+
+
+os.register_at_fork(after_in_child=restart_after_fork)
+
+
+class LocalBatchError(batchmodels.BatchErrorException):
+    def __init__(self, code, message=None):
+        # NOTE: real exception wants a deserializer and response so skip its constructor
+        Exception.__init__(self, f"{code}: {message}" if message else code)
+        self.error = batchmodels.BatchError(code=code, message=batchmodels.ErrorMessage(value=message))
+
+
+def utc_now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def find_workdir(task):
+    options = getattr(getattr(task, "container_settings", None), "container_run_options", None) or ""
+    m = re.search(r"--workdir (\S+)", options)
+    return m.groups()[0] if m else None
+
+
+# tokens of the autoscale formula language: numbers, $variables, names, and operators
+FORMULA_TOKEN = re.compile(r"\s*(?:(\d+(?:\.\d*)?)|(\$\w+)|(\w+)|(\|\||&&|[<>=!]=|[-+*/()<>=!?:,.]))")
+
+
+def tokenize_formula(expr):
+    tokens = []
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        m = FORMULA_TOKEN.match(expr, pos)
+        if m is None:
+            raise RuntimeError(f"Can't parse formula at '{expr[pos:]}'")
+        number, variable, name, op = m.groups()
+        if number is not None:
+            tokens.append(("number", float(number) if "." in number else int(number)))
+        elif variable is not None:
+            tokens.append(("variable", variable[1:]))
+        elif name is not None:
+            tokens.append(("name", name))
+        else:
+            tokens.append(("op", op))
+        pos = m.end()
+    return tokens
+
+
+def evaluate_formula(formula, samples, values):
+    """!
+    Evaluate the subset of the autoscale formula language that _AUTO_SCALE_FORMULA uses
+    @param formula Formula to evaluate
+    @param samples Dictionary of sample values like PendingTasks
+    @param values Dictionary of current values like CurrentDedicatedNodes
+    @return Dictionary of all variables after evaluating
+    """
+    env = dict(values)
+    functions = {
+        "min": min,
+        "max": max,
+        "val": lambda x, default: default if x is None else x,
+    }
+    constants = {
+        "TimeInterval_Minute": 60,
+        "taskcompletion": "taskcompletion",
+        "requeue": "requeue",
+    }
+    # NOTE: every sample is as if it had been collected for the whole interval
+    methods = {
+        "GetSample": lambda name, *args: samples.get(name, 0),
+        "GetSamplePercent": lambda name, *args: 100,
+    }
+    binary = [
+        {"||": lambda a, b: a or b},
+        {"&&": lambda a, b: a and b},
+        {
+            "==": lambda a, b: a == b,
+            "!=": lambda a, b: a != b,
+            "<": lambda a, b: a < b,
+            "<=": lambda a, b: a <= b,
+            ">": lambda a, b: a > b,
+            ">=": lambda a, b: a >= b,
+        },
+        {"+": lambda a, b: a + b, "-": lambda a, b: a - b},
+        {"*": lambda a, b: a * b, "/": lambda a, b: a / b},
+    ]
+    tokens = []
+
+    def peek(value=None):
+        if not tokens:
+            return None
+        kind, token = tokens[0]
+        return token if value is None or ("op" == kind and value == token) else None
+
+    def expect(op):
+        if peek(op) is None:
+            raise RuntimeError(f"Expected '{op}' but got '{peek()}'")
+        tokens.pop(0)
+
+    def parse_args():
+        expect("(")
+        args = []
+        while peek(")") is None:
+            if args:
+                expect(",")
+            args.append(parse_condition())
+        expect(")")
+        return args
+
+    def parse_primary():
+        if not tokens:
+            raise RuntimeError("Formula ended early")
+        kind, token = tokens.pop(0)
+        if "number" == kind:
+            return token
+        if "variable" == kind:
+            if peek(".") is None:
+                if token not in env:
+                    raise RuntimeError(f"Unknown variable ${token}")
+                return env[token]
+            expect(".")
+            kind, method = tokens.pop(0)
+            if method not in methods:
+                raise RuntimeError(f"Method not supported: {method}")
+            return methods[method](token, *parse_args())
+        if "name" == kind:
+            if token in functions:
+                return functions[token](*parse_args())
+            if token in constants:
+                return constants[token]
+            raise RuntimeError(f"Unknown name {token}")
+        if "(" == token:
+            result = parse_condition()
+            expect(")")
+            return result
+        if "-" == token:
+            return -parse_primary()
+        if "!" == token:
+            return not parse_primary()
+        raise RuntimeError(f"Unexpected '{token}'")
+
+    def parse_binary(level=0):
+        if level == len(binary):
+            return parse_primary()
+        result = parse_binary(level + 1)
+        while peek() in binary[level] and "op" == tokens[0][0]:
+            op = tokens.pop(0)[1]
+            result = binary[level][op](result, parse_binary(level + 1))
+        return result
+
+    def parse_condition():
+        result = parse_binary()
+        if peek("?") is None:
+            return result
+        expect("?")
+        a = parse_condition()
+        expect(":")
+        b = parse_condition()
+        return a if result else b
+
+    for statement in formula.split(";"):
+        statement = statement.strip()
+        if not statement:
+            continue
+        tokens[:] = tokenize_formula(statement)
+        kind, name = tokens.pop(0)
+        if "variable" != kind:
+            raise RuntimeError(f"Expected variable to assign to in '{statement}'")
+        expect("=")
+        env[name] = parse_condition()
+        if tokens:
+            raise RuntimeError(f"Unexpected '{peek()}' in '{statement}'")
+    return env
+
+
+class LocalOperations:
+    # name of operation group on the real client
+    GROUP = None
+
+    def __init__(self, emulator):
+        self._emulator = emulator
+
+    def _call(self, name):
+        self._emulator.call(f"{self.GROUP}.{name}")
+
+
+class LocalJobOperations(LocalOperations):
+    GROUP = "job"
+
+    def list(self, *args, **kwargs):
+        self._call("list")
+        with self._emulator.lock:
+            return [copy.copy(j) for j in self._emulator.jobs.values()]
+
+    def get(self, job_id, *args, **kwargs):
+        self._call("get")
+        with self._emulator.lock:
+            return copy.copy(self._emulator.find_job(job_id))
+
+    def add(self, job, *args, **kwargs):
+        self._call("add")
+        with self._emulator.lock:
+            if job.id in self._emulator.jobs:
+                raise LocalBatchError("JobExists")
+            self._emulator.jobs[job.id] = types.SimpleNamespace(
+                id=job.id,
+                state="active",
+                pool_info=job.pool_info,
+                priority=getattr(job, "priority", None) or 0,
+                url=f"local/jobs/{job.id}",
+            )
+            self._emulator.tasks[job.id] = {}
+
+    def delete(self, job_id, *args, **kwargs):
+        self._call("delete")
+        with self._emulator.lock:
+            self._emulator.find_job(job_id)
+            del self._emulator.jobs[job_id]
+            del self._emulator.tasks[job_id]
+
+    def terminate(self, job_id, *args, **kwargs):
+        self._call("terminate")
+        with self._emulator.lock:
+            self._emulator.find_job(job_id).state = "completed"
+
+    def enable(self, job_id, *args, **kwargs):
+        self._call("enable")
+        with self._emulator.lock:
+            self._emulator.find_job(job_id).state = "active"
+
+
+class LocalTaskOperations(LocalOperations):
+    GROUP = "task"
+
+    def list(self, job_id, task_list_options=None, *args, **kwargs):
+        self._call("list")
+        task_filter = getattr(task_list_options, "filter", None)
+        with self._emulator.lock:
+            self._emulator.find_job(job_id)
+            # NOTE: copy so callers see a snapshot like they would from the real api
+            return [copy.copy(t) for t in self._emulator.tasks[job_id].values() if self._emulator.matches(t, task_filter)]
+
+    def get(self, job_id, task_id, *args, **kwargs):
+        self._call("get")
+        with self._emulator.lock:
+            return copy.copy(self._emulator.find_task(job_id, task_id))
+
+    def add(self, job_id, task, *args, **kwargs):
+        self._call("add")
+        with self._emulator.lock:
+            self._emulator.add_task(job_id, task)
+
+    def add_collection(self, job_id, tasks, *args, **kwargs):
+        self._call("add_collection")
+        # NOTE: real api only takes 100 at a time
+        if len(tasks) > 100:
+            raise LocalBatchError("RequestBodyTooLarge", f"{len(tasks)} tasks in one collection")
+        results = []
+        with self._emulator.lock:
+            self._emulator.find_job(job_id)
+            for task in tasks:
+                try:
+                    self._emulator.add_task(job_id, task)
+                    results.append(batchmodels.TaskAddResult(status="success", task_id=task.id))
+                except LocalBatchError as ex:
+                    results.append(batchmodels.TaskAddResult(status="clientError", task_id=task.id, error=ex.error))
+        return batchmodels.TaskAddCollectionResult(value=results)
+
+    def delete(self, job_id, task_id, *args, **kwargs):
+        self._call("delete")
+        with self._emulator.lock:
+            task = self._emulator.find_task(job_id, task_id)
+            task.deleted = True
+            del self._emulator.tasks[job_id][task_id]
+
+    def reactivate(self, job_id, task_id, *args, **kwargs):
+        self._call("reactivate")
+        with self._emulator.lock:
+            task = self._emulator.find_task(job_id, task_id)
+            if "completed" != task.state or "failure" != task.execution_info.result:
+                raise LocalBatchError("TaskNotFailed")
+            self._emulator.set_state(task, "active")
+            task.execution_info = batchmodels.TaskExecutionInformation(retry_count=0, requeue_count=0)
+
+
+class LocalPoolOperations(LocalOperations):
+    GROUP = "pool"
+
+    def exists(self, pool_id, *args, **kwargs):
+        self._call("exists")
+        with self._emulator.lock:
+            return pool_id in self._emulator.pools
+
+    def list(self, *args, **kwargs):
+        self._call("list")
+        with self._emulator.lock:
+            return list(self._emulator.pools.values())
+
+    def get(self, pool_id, *args, **kwargs):
+        self._call("get")
+        with self._emulator.lock:
+            return self._emulator.find_pool(pool_id)
+
+    def add(self, pool, *args, **kwargs):
+        self._call("add")
+        with self._emulator.lock:
+            self._emulator.add_pool(
+                pool.id,
+                auto_scale_formula=pool.auto_scale_formula if pool.enable_auto_scale else None,
+                target_dedicated=pool.target_dedicated_nodes,
+                target_low=pool.target_low_priority_nodes,
+            )
+
+    def delete(self, pool_id, *args, **kwargs):
+        self._call("delete")
+        with self._emulator.lock:
+            self._emulator.find_pool(pool_id)
+            del self._emulator.pools[pool_id]
+            del self._emulator.nodes[pool_id]
+
+    def patch(self, pool_id, *args, **kwargs):
+        self._call("patch")
+
+    def enable_auto_scale(self, pool_id, auto_scale_formula=None, *args, **kwargs):
+        self._call("enable_auto_scale")
+        with self._emulator.lock:
+            pool = self._emulator.find_pool(pool_id)
+            pool.enable_auto_scale = True
+            pool.auto_scale_formula = auto_scale_formula
+            self._emulator.autoscale(pool)
+
+    def disable_auto_scale(self, pool_id, *args, **kwargs):
+        self._call("disable_auto_scale")
+        with self._emulator.lock:
+            pool = self._emulator.find_pool(pool_id)
+            pool.enable_auto_scale = False
+            pool.auto_scale_formula = None
+
+    def resize(self, pool_id, pool_resize_parameter, *args, **kwargs):
+        self._call("resize")
+        with self._emulator.lock:
+            pool = self._emulator.find_pool(pool_id)
+            if pool.enable_auto_scale:
+                raise LocalBatchError("AutoScalingEnabled")
+            pool.target = {
+                False: pool_resize_parameter.target_dedicated_nodes or 0,
+                True: pool_resize_parameter.target_low_priority_nodes or 0,
+            }
+
+    def evaluate_auto_scale(self, pool_id, auto_scale_formula, *args, **kwargs):
+        self._call("evaluate_auto_scale")
+        with self._emulator.lock:
+            result = self._emulator.evaluate_pool(self._emulator.find_pool(pool_id), auto_scale_formula)
+        return types.SimpleNamespace(results=";".join(f"${k}={v}" for k, v in result.items()))
+
+
+class LocalComputeNodeOperations(LocalOperations):
+    GROUP = "compute_node"
+
+    def list(self, pool_id, *args, **kwargs):
+        self._call("list")
+        with self._emulator.lock:
+            self._emulator.find_pool(pool_id)
+            return list(self._emulator.nodes[pool_id].values())
+
+    def get(self, pool_id, node_id, *args, **kwargs):
+        self._call("get")
+        with self._emulator.lock:
+            self._emulator.find_pool(pool_id)
+            node = self._emulator.nodes[pool_id].get(node_id, None)
+            if node is None:
+                raise LocalBatchError("NodeNotFound")
+            return node
+
+    def reboot(self, pool_id, node_id, *args, **kwargs):
+        self._call("reboot")
+
+
+class LocalJobScheduleOperations(LocalOperations):
+    GROUP = "job_schedule"
+
+    def list(self, *args, **kwargs):
+        self._call("list")
+        return []
+
+    def exists(self, *args, **kwargs):
+        self._call("exists")
+        return False
+
+
+class LocalBatchClient:
+    """!
+    In-memory batch service with a simulated pool of single-slot nodes
+    @param num_nodes Number of nodes for pools that aren't autoscaling
+    @param run_commands Whether to run task command lines or just wait task_duration
+    @param task_duration Seconds (or function of task) a task takes if not running commands
+    @param api_latency Seconds each api call takes
+    @param node_start_latency Seconds a node takes before it can run tasks
+    @param autoscale_interval Seconds between evaluating autoscale formulas
+    @param max_nodes Most nodes a pool can have no matter what the formula says
+    """
+
+    def __init__(
+        self,
+        num_nodes=1,
+        run_commands=True,
+        task_duration=LOCAL_TASK_DURATION,
+        api_latency=0,
+        node_start_latency=0,
+        autoscale_interval=1,
+        max_nodes=None,
+    ):
+        self.num_nodes = num_nodes
+        self.run_commands = run_commands
+        self.task_duration = task_duration
+        self.api_latency = api_latency
+        self.node_start_latency = node_start_latency
+        self.autoscale_interval = autoscale_interval
+        self.max_nodes = max_nodes
+        self.lock = threading.RLock()
+        self.calls = Counter()
+        self.jobs = {}
+        self.tasks = {}
+        self.pools = {}
+        self.nodes = {}
+        self.order = 0
+        self.num_created = 0
+        self.job = LocalJobOperations(self)
+        self.task = LocalTaskOperations(self)
+        self.pool = LocalPoolOperations(self)
+        self.compute_node = LocalComputeNodeOperations(self)
+        self.job_schedule = LocalJobScheduleOperations(self)
+        self._stop = threading.Event()
+        self._start_scheduler()
+        LOCAL_CLIENTS.add(self)
+
+    def _start_scheduler(self):
+        self._scheduler = threading.Thread(target=self._schedule, daemon=True)
+        self._scheduler.start()
+
+    def restart_after_fork(self):
+        # NOTE: threads don't survive fork, so a child gets its own copy of the service
+        #       that runs what it submits, but the parent never sees those tasks
+        self.lock = threading.RLock()
+        stopped = self._stop.is_set()
+        self._stop = threading.Event()
+        for nodes in self.nodes.values():
+            for node in list(nodes.values()):
+                # whatever these were running is still running in the parent
+                if node.task is not None:
+                    del nodes[node.id]
+        if stopped:
+            self._stop.set()
+        else:
+            self._start_scheduler()
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def close(self):
+        self._stop.set()
+        self._scheduler.join()
+
+    def find_job(self, job_id):
+        job = self.jobs.get(job_id, None)
+        if job is None:
+            raise LocalBatchError("JobNotFound")
+        return job
+
+    def find_task(self, job_id, task_id):
+        self.find_job(job_id)
+        task = self.tasks[job_id].get(task_id, None)
+        if task is None:
+            raise LocalBatchError("TaskNotFound")
+        return task
+
+    def find_pool(self, pool_id):
+        pool = self.pools.get(pool_id, None)
+        if pool is None:
+            raise LocalBatchError("PoolNotFound")
+        return pool
+
+    def set_state(self, obj, state):
+        obj.state = state
+        obj.state_transition_time = utc_now()
+
+    def matches(self, task, task_filter):
+        if not task_filter:
+            return True
+        m = re.fullmatch(r"stateTransitionTime gt DateTime'([^']*)'", task_filter)
+        if m:
+            return task.state_transition_time > datetime.datetime.fromisoformat(m.groups()[0].replace("Z", "+00:00"))
+        m = re.fullmatch(r"state (eq|ne) '(\w+)'", task_filter)
+        if m:
+            op, state = m.groups()
+            return (state == task.state) == ("eq" == op)
+        raise RuntimeError(f"Filter not supported: {task_filter}")
+
+    def add_task(self, job_id, task):
+        self.find_job(job_id)
+        if task.id in self.tasks[job_id]:
+            raise LocalBatchError("TaskExists")
+        self.order += 1
+        now = utc_now()
+        self.tasks[job_id][task.id] = types.SimpleNamespace(
+            id=task.id,
+            command_line=task.command_line,
+            container_settings=task.container_settings,
+            state="active",
+            creation_time=now,
+            state_transition_time=now,
+            execution_info=batchmodels.TaskExecutionInformation(retry_count=0, requeue_count=0),
+            url=f"local/jobs/{job_id}/tasks/{task.id}",
+            order=self.order,
+            deleted=False,
+        )
+
+    def add_pool(self, pool_id, auto_scale_formula=None, target_dedicated=None, target_low=None):
+        if pool_id in self.pools:
+            raise LocalBatchError("PoolExists")
+        if auto_scale_formula is None and not (target_dedicated or target_low):
+            target_dedicated = self.num_nodes
+        self.pools[pool_id] = types.SimpleNamespace(
+            id=pool_id,
+            state="active",
+            enable_auto_scale=auto_scale_formula is not None,
+            auto_scale_formula=auto_scale_formula,
+            target={False: target_dedicated or 0, True: target_low or 0},
+            last_scale=None,
+        )
+        self.nodes[pool_id] = {}
+
+    def count_tasks(self, pool_id):
+        counts = Counter()
+        for job in self.jobs.values():
+            if "active" == job.state and pool_id == job.pool_info.pool_id:
+                counts.update(t.state for t in self.tasks[job.id].values())
+        return counts
+
+    def evaluate_pool(self, pool, formula):
+        counts = self.count_tasks(pool.id)
+        nodes = Counter(n.low_priority for n in self.nodes[pool.id].values())
+        samples = {
+            "PendingTasks": counts["active"] + counts["running"],
+            "ActiveTasks": counts["active"],
+            "RunningTasks": counts["running"],
+            "PreemptedNodeCount": 0,
+        }
+        # NOTE: low priority nodes never get preempted here
+        values = {"CurrentDedicatedNodes": nodes[False], "CurrentLowPriorityNodes": nodes[True]}
+        result = evaluate_formula(formula, samples, values)
+        return {k: result[k] for k in ["TargetDedicatedNodes", "TargetLowPriorityNodes", "NodeDeallocationOption"]}
+
+    def count_nodes(self, pool, low_priority):
+        return sum(low_priority == n.low_priority for n in self.nodes[pool.id].values())
+
+    def autoscale(self, pool):
+        result = self.evaluate_pool(pool, pool.auto_scale_formula)
+        pool.target = {False: result["TargetDedicatedNodes"], True: result["TargetLowPriorityNodes"]}
+        pool.last_scale = time.monotonic()
+
+    def _resize(self, pool):
+        now = time.monotonic()
+        if pool.enable_auto_scale and (
+            pool.last_scale is None or (now - pool.last_scale) >= self.autoscale_interval
+        ):
+            self.autoscale(pool)
+        nodes = self.nodes[pool.id]
+        for low_priority, target in pool.target.items():
+            if self.max_nodes is not None:
+                target = min(target, self.max_nodes - (len(nodes) - self.count_nodes(pool, low_priority)))
+            while self.count_nodes(pool, low_priority) < target:
+                self.num_created += 1
+                node_id = f"node_{self.num_created}"
+                nodes[node_id] = types.SimpleNamespace(
+                    id=node_id,
+                    state="starting",
+                    low_priority=low_priority,
+                    ready=now + self.node_start_latency,
+                    task=None,
+                )
+            # NOTE: deallocate on task completion so only remove nodes that aren't doing anything
+            for node in list(nodes.values()):
+                if self.count_nodes(pool, low_priority) <= target:
+                    break
+                if low_priority == node.low_priority and node.task is None:
+                    del nodes[node.id]
+        for node in nodes.values():
+            if "starting" == node.state and node.ready <= now:
+                node.state = "idle"
+
+    def _schedule(self):
+        while not self._stop.wait(LOCAL_TICK):
+            with self.lock:
+                for pool in self.pools.values():
+                    self._resize(pool)
+                    idle = [n for n in self.nodes[pool.id].values() if "idle" == n.state]
+                    if not idle:
+                        continue
+                    jobs = sorted(
+                        [j for j in self.jobs.values() if "active" == j.state and pool.id == j.pool_info.pool_id],
+                        key=lambda j: -j.priority,
+                    )
+                    waiting = [
+                        (job.id, t)
+                        for job in jobs
+                        for t in sorted(self.tasks[job.id].values(), key=lambda t: t.order)
+                        if "active" == t.state
+                    ]
+                    for node, (job_id, task) in zip(idle, waiting):
+                        self._start(node, job_id, task)
+
+    def _start(self, node, job_id, task):
+        node.state = "running"
+        node.task = task
+        self.set_state(task, "running")
+        task.execution_info = batchmodels.TaskExecutionInformation(
+            start_time=utc_now(), retry_count=0, requeue_count=0
+        )
+        threading.Thread(target=self._run, args=[node, task], daemon=True).start()
+
+    def _run(self, node, task):
+        exit_code = 0
+        try:
+            if self.run_commands:
+                exit_code = subprocess.run(["/bin/sh", "-c", task.command_line], cwd=find_workdir(task)).returncode
+            else:
+                time.sleep(self.task_duration(task) if callable(self.task_duration) else self.task_duration)
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            logging.error(f"Local task {task.id} failed: {ex}")
+            exit_code = -1
+        with self.lock:
+            node.task = None
+            if "running" == node.state:
+                node.state = "idle"
+            if task.deleted:
+                return
+            task.execution_info = batchmodels.TaskExecutionInformation(
+                start_time=task.execution_info.start_time,
+                end_time=utc_now(),
+                exit_code=exit_code,
+                result="success" if 0 == exit_code else "failure",
+                failure_info=(
+                    None
+                    if 0 == exit_code
+                    else batchmodels.TaskFailureInformation(category="userError", code="FailureExitCode")
+                ),
+                retry_count=0,
+                requeue_count=0,
+            )
+            self.set_state(task, "completed")
@@ -0,0 +1,334 @@
+"""Timing comparisons for changes to processing steps
+
+Usage: python benchmark.py <name> [args...]
+"""
+
+import os
+import sys
+import timeit
+
+import numpy as np
+from common import DIR_TMP, ensure_dir, list_dirs, listdir_sorted, logging
+from osgeo import gdal, osr
+
+DIR_BENCHMARK = os.path.join(DIR_TMP, "benchmark")
+# how many times to repeat each timing
+NUM_REPEATS = 5
+
+
+def time_fct(fct, *args, repeats=NUM_REPEATS, **kwargs):
+    # use best time since anything slower is interference from something else
+    times = timeit.repeat(lambda: fct(*args, **kwargs), number=1, repeat=repeats)
+    return min(times)
+
+
+def show_times(title, rows):
+    print(title)
+    width = max(len(str(k)) for k in rows.keys())
+    for k, v in rows.items():
+        print(f"\t{k:<{width}} {v:10.4f}s")
+
+
+def make_probability_raster(path, xsize=5000, ysize=5000, cell_size=100, crs=3978, options=None):
+    """!
+    Make a raster that looks like a probability output for a fire
+    @param path Path to save raster to
+    @param xsize Number of columns
+    @param ysize Number of rows
+    @param cell_size Cell size (m)
+    @param crs EPSG code to use for raster
+    @param options Creation options to use
+    @return Path that raster was saved to
+    """
+    if options is None:
+        # same as what project_raster() uses by default
+        options = ["COMPRESS=LZW", "TILED=YES"]
+    ensure_dir(os.path.dirname(path))
+    y, x = np.mgrid[0:ysize, 0:xsize]
+    # mostly zero with a blob in the middle like a fire would have
+    d = ((x - xsize / 2) / (xsize / 6)) ** 2 + ((y - ysize / 2) / (ysize / 6)) ** 2
+    data = np.where(d < 1, np.exp(-d), 0).astype(np.float32)
+    dst = gdal.GetDriverByName("GTiff").Create(path, xsize, ysize, 1, gdal.GDT_Float32, options=options)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(crs)
+    dst.SetProjection(srs.ExportToWkt())
+    dst.SetGeoTransform([-1000000, cell_size, 0, 1000000, 0, -cell_size])
+    band = dst.GetRasterBand(1)
+    band.SetNoDataValue(0)
+    band.WriteArray(data)
+    del band
+    del dst
+    return path
+
+
+def benchmark_tiff(*files):
+    from gis import is_invalid_tiff
+
+    if not files:
+        files = [
+            make_probability_raster(os.path.join(DIR_BENCHMARK, f"probability_{n}.tif"), xsize=n, ysize=n)
+            for n in [1000, 5000, 10000]
+        ]
+    for f in files:
+        if is_invalid_tiff(f, test_read=True, full_read=True) or is_invalid_tiff(f, test_read=True):
+            logging.error(f"Skipping invalid tiff {f}")
+            continue
+        show_times(
+            f"{f} ({os.path.getsize(f) / 1024 / 1024:0.1f}MB)",
+            {
+                "full read": time_fct(is_invalid_tiff, f, test_read=True, full_read=True),
+                "block index": time_fct(is_invalid_tiff, f, test_read=True),
+            },
+        )
+
+
+def make_fire_season(num_fires=5000, fraction_points=0.2, seed=42):
+    """!
+    Make fires that look like a season's worth of perimeters and points
+    @param num_fires Number of fires to make
+    @param fraction_points Fraction of fires that are only points
+    @param seed Seed for random numbers so runs are comparable
+    @return GeoDataFrame of fires
+    """
+    import geopandas as gpd
+    from gis import CRS_COMPARISON
+
+    rng = np.random.default_rng(seed)
+    # clustered around a few hundred ignition areas over roughly the extent of canada
+    num_clusters = max(1, num_fires // 20)
+    centers = np.column_stack([rng.uniform(-2.3e6, 3.0e6, num_clusters), rng.uniform(-0.7e6, 3.8e6, num_clusters)])
+    which = rng.integers(0, num_clusters, num_fires)
+    xy = centers[which] + rng.normal(0, 25000, (num_fires, 2))
+    pts = gpd.points_from_xy(xy[:, 0], xy[:, 1], crs=CRS_COMPARISON)
+    # most fires are small but a few are huge
+    radius = np.minimum(30000, 100 * np.exp(rng.normal(2, 1.5, num_fires)))
+    is_point = rng.random(num_fires) < fraction_points
+    geometry = [p if point else p.buffer(r) for p, r, point in zip(pts, radius, is_point)]
+    return gpd.GeoDataFrame({"fire_name": [f"fire_{i:05d}" for i in range(num_fires)]}, geometry=geometry, crs=CRS_COMPARISON)
+
+
+def benchmark_grouping(num_fires=5000):
+    from fires import group_fires_by_buffer, group_fires_by_dissolve
+
+    df_fires = make_fire_season(int(num_fires))
+    # previous approach drops points so compare on polygons only for that
+    df_polys = df_fires.loc[df_fires.geom_type != "Point"]
+    n_old = len(group_fires_by_dissolve(df_polys))
+    n_new = len(group_fires_by_buffer(df_polys))
+    if n_old != n_new:
+        logging.error(f"Number of groups doesn't match: {n_old} vs {n_new}")
+    show_times(
+        f"Grouping {len(df_fires)} fires ({len(df_polys)} polygons into {n_new} groups)",
+        {
+            "dissolve": time_fct(group_fires_by_dissolve, df_polys, repeats=1),
+            "strtree": time_fct(group_fires_by_buffer, df_polys),
+            "strtree with points": time_fct(group_fires_by_buffer, df_fires),
+        },
+    )
+
+
+def benchmark_circles(num_points=2000, seed=42):
+    import geopandas as gpd
+    from gis import CRS_COMPARISON, area_ha_to_radius_m, make_circles
+
+    # roughly how many fires ciffc has at peak of a bad season
+    num_points = int(num_points)
+    rng = np.random.default_rng(seed)
+    xy = np.column_stack([rng.uniform(-2.3e6, 3.0e6, num_points), rng.uniform(-0.7e6, 3.8e6, num_points)])
+    df = gpd.GeoDataFrame(
+        {"area": np.exp(rng.normal(3, 3, num_points))},
+        geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]),
+        crs=CRS_COMPARISON,
+    )
+
+    def by_row():
+        return df.apply(
+            lambda x: x.geometry.buffer(max(0.1, area_ha_to_radius_m(max(0, x["area"])))),
+            axis=1,
+        ).simplify(100)
+
+    def vectorized():
+        return make_circles(df.geometry, np.maximum(0.1, area_ha_to_radius_m(np.maximum(0, df["area"]))))
+
+    def count_vertices(geoms):
+        import shapely
+
+        return shapely.get_num_coordinates(np.array(geoms)).sum()
+
+    show_times(
+        f"Making circles for {num_points} points "
+        f"(vertices {count_vertices(by_row())} by row vs {count_vertices(vectorized())} vectorized)",
+        {
+            "by row": time_fct(by_row),
+            "vectorized": time_fct(vectorized),
+        },
+    )
+
+
+def benchmark_batch(num_fires=500, num_nodes=20, task_duration=0.5, api_latency=0.01):
+    from concurrent.futures import ThreadPoolExecutor
+
+    import azurebatch
+    from azurebatch import (
+        add_simulation_task,
+        create_container_pool,
+        make_or_get_job,
+        set_batch_client,
+        submit_simulation_tasks,
+    )
+    from azurebatch_local import LocalBatchClient
+
+    num_fires = int(num_fires)
+    client = LocalBatchClient(
+        run_commands=False,
+        task_duration=float(task_duration),
+        api_latency=float(api_latency),
+        max_nodes=int(num_nodes),
+    )
+    set_batch_client(client)
+    # HACK: don't want to wait as long as we would for real simulations
+    task_sleep = azurebatch.TASK_SLEEP
+    azurebatch.TASK_SLEEP = float(task_duration) / 2
+    dirs_fire = [os.path.join(DIR_BENCHMARK, "sims", f"fire_{i:05d}") for i in range(num_fires)]
+    times = {}
+    calls = {}
+
+    def timed(name, fct):
+        before = sum(client.calls.values())
+        times[name] = time_fct(fct, repeats=1)
+        calls[name] = sum(client.calls.values()) - before
+
+    def run_task(dir_fire):
+        try:
+            return add_simulation_task(job_id, dir_fire, client=client)
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            return ex
+
+    def wait():
+        # like running each fire on its own and waiting for it
+        with ThreadPoolExecutor(max_workers=num_fires) as pool:
+            results = list(pool.map(run_task, dirs_fire))
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            logging.error(f"{len(failed)} tasks failed: {failed[0]}")
+
+    job_id = "job_benchmark"
+    try:
+        create_container_pool(client=client)
+        timed("make job", lambda: make_or_get_job(job_id=job_id, client=client))
+        timed("submit", lambda: submit_simulation_tasks(job_id, dirs_fire, client=client))
+        timed("wait", wait)
+        # everything is completed now so this deletes and adds them all again
+        timed("resubmit", lambda: submit_simulation_tasks(job_id, dirs_fire, client=client))
+    finally:
+        client.close()
+        set_batch_client(None)
+        azurebatch.TASK_SLEEP = task_sleep
+    total = sum(times.values())
+    show_times(
+        f"Running {num_fires} tasks of {task_duration}s on {num_nodes} local nodes "
+        f"({num_fires / total:0.2f} tasks/s, best possible {int(num_nodes) / float(task_duration):0.2f} tasks/s)",
+        times,
+    )
+    print("api calls by step")
+    for k, v in calls.items():
+        print(f"\t{k} {v}")
+    print("api calls by operation")
+    for k, v in client.calls.most_common():
+        print(f"\t{k} {v}")
+
+
+def find_sim_outputs(dir_sims):
+    # for_date -> fire_name -> raw probability output from simulation
+    by_date = {}
+    for fire_name in list_dirs(dir_sims):
+        dir_fire = os.path.join(dir_sims, fire_name)
+        # interim sorts first so final output replaces it
+        for f in listdir_sorted(dir_fire):
+            if f.endswith(".tif") and "probability" in f:
+                # same as how copy_fire_outputs() finds the date
+                for_date = f[(f.rindex("_") + 1) : f.rindex(".tif")].replace("-", "")
+                by_date.setdefault(for_date, {})[fire_name] = os.path.join(dir_fire, f)
+    return by_date
+
+
+def benchmark_sparse(dir_output=None, for_date=None):
+    import shutil
+
+    from common import CREATION_OPTIONS, DIR_SIMS, force_remove
+    from gdal_merge_max import gdal_merge_max
+    from gis import GRID_CELL_SIZE, GRID_CRS, crop_to_data, project_raster, sum_raster
+    from publish import find_latest_outputs
+    from sparse import to_sparse_name, write_sparse
+
+    dir_output = find_latest_outputs(dir_output)
+    # reprojected/ is already cropped, so start from what simulations output
+    dir_sims = os.path.join(DIR_SIMS, os.path.basename(dir_output))
+    by_date = find_sim_outputs(dir_sims)
+    if not by_date:
+        logging.error(f"No simulation outputs in {dir_sims}")
+        return
+    if for_date is None:
+        # use whichever day has the most fires
+        for_date = max(by_date.keys(), key=lambda x: len(by_date[x]))
+    dir_bench = os.path.join(DIR_BENCHMARK, "sparse", os.path.basename(dir_output), for_date)
+    dirs = {k: ensure_dir(os.path.join(dir_bench, k)) for k in ["full", "cropped", "sparse", "merged"]}
+    files = {"full": [], "cropped": [], "sparse": []}
+    for fire_name, f in by_date[for_date].items():
+        # same warp onto merge grid as project_raster_to_grid() but without cropping
+        f_full = os.path.join(dirs["full"], f"{fire_name}.tif")
+        force_remove(f_full, verbose=False)
+        bounds = project_raster(
+            f,
+            f_full,
+            nodata=0,
+            crs=f"EPSG:{GRID_CRS}",
+            resolution=GRID_CELL_SIZE,
+            target_aligned=True,
+        )
+        if bounds is None:
+            logging.error(f"Skipping invalid output {f}")
+            continue
+        files["full"].append(f_full)
+        f_crop = os.path.join(dirs["cropped"], os.path.basename(f_full))
+        shutil.copy(f_full, f_crop)
+        crop_to_data(f_crop)
+        files["cropped"].append(f_crop)
+        f_sparse = os.path.join(dirs["sparse"], to_sparse_name(os.path.basename(f_full)))
+        files["sparse"].append(write_sparse(f_full, f_sparse))
+    times = {}
+    sums = {}
+    for k, names in files.items():
+        file_out = os.path.join(dirs["merged"], f"{k}.tif")
+
+        def merge():
+            # merge updates existing file instead of making new one
+            force_remove(file_out, verbose=False)
+            gdal_merge_max(file_out=file_out, names=names, creation_options=CREATION_OPTIONS, a_nodata=-1)
+
+        times[f"merge {k}"] = time_fct(merge, repeats=1)
+        sums[k] = sum_raster(file_out)
+    show_times(f"Merging {len(files['full'])} rasters for {for_date} from {dir_sims}", times)
+    print("disk used")
+    for k, names in files.items():
+        print(f"\t{k:<8} {sum(os.path.getsize(f) for f in names) / 1024 / 1024:10.2f}MB")
+    if len(set(round(float(v), 3) for v in sums.values())) != 1:
+        logging.error(f"Merged outputs don't match: {sums}")
+
+
+BENCHMARKS = {
+    "tiff": benchmark_tiff,
+    "grouping": benchmark_grouping,
+    "circles": benchmark_circles,
+    "batch": benchmark_batch,
+    "sparse": benchmark_sparse,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: {sys.argv[0]} [{'|'.join(BENCHMARKS.keys())}] [args...]")
+        sys.exit(-1)
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -1,6 +1,7 @@
 """Shared code"""
 
 import configparser
+import copy
 import datetime
 import inspect
 import itertools
@@ -8,8 +9,10 @@ import json
 import os
 import re
 import shutil
+import struct
 import subprocess
 import sys
+import threading
 import time
 import zipfile
 from contextlib import contextmanager
@@ -30,6 +33,14 @@ FLAG_IGNORE_PERIM_OUTPUTS = True
 FLAG_DEBUG = True
 FLAG_DEBUG_LOCKS = False
 FLAG_SAVE_PREPARED = False
+# project fire outputs straight onto the merge grid instead of to EPSG:4326 and then again for merging
+FLAG_SINGLE_WARP = True
+# rasterize perimeters clipped to fire extent plus this buffer (m) instead of whole zone (None to disable)
+PERIMETER_RASTER_BUFFER_M = 1000
+# make VRT views instead of merged rasters for merges queued while fires are still running
+FLAG_LAZY_MERGE = True
+# keep per-fire rasters in reprojected/ as just the cells with data (see sparse.py) instead of GeoTIFFs
+FLAG_SPARSE_MERGE = False
 
 FMT_DATETIME = "%Y-%m-%d %H:%M:%S"
 FMT_DATE_YMD = "%Y%m%d"
@@ -57,6 +68,8 @@ FILE_CURRENT = f"/appl/data/{WX_MODEL}_current"
 FILE_LATEST = f"/appl/data/{WX_MODEL}_latest"
 
 PUBLISH_AZURE_WAIT_TIME_SECONDS = 10
+# already compressed so just store these in archives
+ZIP_STORED_EXTENSIONS = [".tif", ".tiff", ".zip", ".gz", ".png", ".jpg"]
 
 FORMAT_OUTPUT = "COG"
 # FORMAT_OUTPUT = "GTiff"
@@ -87,6 +100,8 @@ gdal.UseExceptions()
 gdal.SetConfigOption("CPL_LOG", "/dev/null")
 gdal.SetConfigOption("CPL_DEBUG", "OFF")
 gdal.PushErrorHandler("CPLQuietErrorHandler")
+# only let VRTs run the max pixel function from gdal_merge_max.py (for GDAL before 3.8)
+gdal.SetConfigOption("GDAL_VRT_PYTHON_TRUSTED_MODULES", "gdal_merge_max")
 
 getLogger("gdal").setLevel(logging.WARNING)
 getLogger("fiona").setLevel(logging.WARNING)
@@ -133,6 +148,8 @@ FILE_TBD_BINARY = os.path.join(DIR_TBD, "tbd")
 FILE_TBD_SETTINGS = os.path.join(DIR_TBD, "settings.ini")
 DIR_SCRIPTS = os.path.join(DIR_TBD, "scripts")
 FILE_SIM_LOG = "firestarr.log"
+# added to names of interim outputs from runs that haven't finished
+TMP_SUFFIX = "__tmp__"
 
 DIR_DATA = ensure_dir(os.path.abspath("/appl/data"))
 DIR_DOWNLOAD = ensure_dir(os.path.join(DIR_DATA, "download"))
@@ -163,6 +180,9 @@ FILE_LOCK_PUBLISH = os.path.join(DIR_OUTPUT, "publish")
 FILE_LOCK_PREPUBLISH = os.path.join(DIR_OUTPUT, "prepublish")
 FILE_LOCK_MODEL = os.path.join(DIR_OUTPUT, "model")
 
+# writers can create a file with this appended to the name when output is complete
+SUFFIX_WRITE_MARKER = ".done"
+
 
 def listdir_sorted(path, ignore_locks=True):
     paths = []
@@ -313,6 +333,66 @@ def copy_file(filename, toname):
     os.utime(toname, (filetime, filetime))
 
 
+def file_signature(path):
+    """!
+    Get something that changes whenever the contents of a file are rewritten
+    @param path Path to get signature for
+    @return Tuple of (size, mtime) or None if file doesn't exist
+    """
+    try:
+        s = os.stat(path)
+        return s.st_size, s.st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def is_write_complete(path, settle_seconds, marker_suffix=SUFFIX_WRITE_MARKER):
+    """!
+    Check if a file is done being written to without reading its contents
+    @param path Path to check
+    @param settle_seconds Time file must be unchanged for to be considered complete
+    @param marker_suffix Suffix for marker file writer can create when done
+    @return Whether file looks like it is complete
+    """
+    sig = file_signature(path)
+    if sig is None:
+        return False
+    # if writer marked it as done after last change then trust that
+    file_marker = f"{path}{marker_suffix}"
+    if os.path.isfile(file_marker) and not is_newer_than(path, file_marker):
+        return True
+    age = time.time() - sig[1] / 1e9
+    if age < settle_seconds:
+        # recently modified so see if it's still changing
+        time.sleep(settle_seconds - age)
+    return sig == file_signature(path)
+
+
+def link_or_copy(filename, toname):
+    """!
+    Make toname have the same contents as filename without copying data if possible
+    @param filename Source path to link or copy from
+    @param toname Destination path
+    @return Destination path
+    """
+    force_remove(toname, verbose=False)
+    # clone blocks if filesystem supports it, since that's an actual snapshot
+    try:
+        subprocess.run(
+            ["cp", "--reflink=always", "--preserve=timestamps", filename, toname],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return toname
+    except (OSError, subprocess.CalledProcessError):
+        force_remove(toname, verbose=False)
+    # NOTE: no hardlink since writes in place would show up in what should be a snapshot
+    # copy2() keeps mtime exactly so signatures still match
+    shutil.copy2(filename, toname)
+    return toname
+
+
 def filterXY(data):
     data = data[data[:, :, 0] >= BOUNDS["latitude"]["min"]]
     data = data[data[:, 0] <= BOUNDS["latitude"]["max"]]
@@ -441,6 +521,183 @@ def zip_folder(zip_name, path, ignore_locks=True):
         return zip_name
 
 
+def find_zip_members(path, ignore_locks=True):
+    # relative name -> file, with directories ending in / like zipfile does it
+    members = {}
+    for root, dirs, files in os.walk(path):
+        for d in dirs:
+            dir = os.path.join(root, d)
+            members[dir.replace(path, "").lstrip("/") + "/"] = dir
+        for f in files:
+            if not f.endswith(".lock") or not ignore_locks:
+                file = os.path.join(root, f)
+                members[file.replace(path, "").lstrip("/")] = file
+    return members
+
+
+def find_zip_compression(path):
+    return zipfile.ZIP_STORED if os.path.splitext(path)[1].lower() in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def is_same_zip_member(info, path):
+    if info.is_dir():
+        return os.path.isdir(path)
+    st = os.stat(path)
+    t = time.localtime(st.st_mtime)[:6]
+    # NOTE: zip only keeps time to 2 seconds
+    return (
+        info.file_size == st.st_size
+        and info.date_time[:5] == t[:5]
+        and info.date_time[5] // 2 == t[5] // 2
+        and info.compress_type == find_zip_compression(path)
+    )
+
+
+def write_zip_member(zf, path, name):
+    zf.write(path, name, None if os.path.isdir(path) else find_zip_compression(path))
+
+
+def strip_zip64_extra(extra):
+    # header gets its own zip64 field if it needs one so drop any that's already there
+    result = b""
+    i = 0
+    while i + 4 <= len(extra):
+        field, size = struct.unpack("<HH", extra[i : (i + 4)])
+        if 1 != field:
+            result += extra[i : (i + 4 + size)]
+        i += 4 + size
+    return result
+
+
+def copy_zip_member(zf_in, zf_out, info):
+    if info.is_dir():
+        zf_out.writestr(info, b"")
+        return
+    # NOTE: copy compressed bytes as they are instead of decompressing and compressing again
+    # HACK: zipfile has no way to do this so write member the same way ZipFile.write() does
+    zf_in.fp.seek(info.header_offset)
+    header = zf_in.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad header for {info.filename}")
+    name_size, extra_size = struct.unpack("<HH", header[26:30])
+    zf_in.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_size + extra_size)
+    info_out = copy.copy(info)
+    # sizes are known so they go in header instead of after data
+    info_out.flag_bits &= ~0x08
+    info_out.extra = strip_zip64_extra(info.extra)
+    info_out.header_offset = zf_out.fp.tell()
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    zf_out.fp.write(info_out.FileHeader(zip64))
+    left = info.compress_size
+    while 0 < left:
+        data = zf_in.fp.read(min(left, 1024 * 1024))
+        if not data:
+            raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+        zf_out.fp.write(data)
+        left -= len(data)
+    zf_out.start_dir = zf_out.fp.tell()
+    zf_out.filelist.append(info_out)
+    zf_out.NameToInfo[info_out.filename] = info_out
+    zf_out._didModify = True
+
+
+def update_zip(zip_name, path, ignore_locks=True):
+    """!
+    Make zip_name match path without redoing members that haven't changed
+    @param zip_name Archive to update
+    @param path Directory to archive
+    @param ignore_locks Whether to leave out .lock files
+    @return Whether anything in path changed while archiving it
+    """
+    members = find_zip_members(path, ignore_locks)
+    stats = {k: os.stat(v).st_mtime_ns for k, v in members.items()}
+    with locks_for(zip_name):
+        existing = {}
+        if os.path.isfile(zip_name):
+            try:
+                with zipfile.ZipFile(zip_name) as zf:
+                    existing = {x.filename: x for x in zf.infolist()}
+            except zipfile.BadZipFile:
+                logging.warning(f"Rebuilding invalid archive {zip_name}")
+                force_remove(zip_name)
+        keep = [k for k in members.keys() if k in existing and is_same_zip_member(existing[k], members[k])]
+        added = [k for k in members.keys() if k not in existing]
+        if len(keep) == len(existing) and not added:
+            return False
+        if len(keep) == len(existing):
+            # only new files so just add them onto the end
+            logging.info(f"Adding {len(added)} files to {zip_name}")
+            with zipfile.ZipFile(zip_name, "a") as zf:
+                for k in added:
+                    write_zip_member(zf, members[k], k)
+        else:
+            logging.info(f"Updating {len(members) - len(keep)} of {len(members)} files in {zip_name}")
+            file_tmp = f"{zip_name}.tmp"
+            with zipfile.ZipFile(file_tmp, "w") as zf_out, zipfile.ZipFile(zip_name) as zf_in:
+                for k, f in members.items():
+                    if k in keep:
+                        copy_zip_member(zf_in, zf_out, existing[k])
+                    else:
+                        write_zip_member(zf_out, f, k)
+            os.replace(file_tmp, zip_name)
+    # HACK: merged files get moved into place so check if anything moved while reading
+    return any(not os.path.exists(v) or os.stat(v).st_mtime_ns != stats[k] for k, v in members.items())
+
+
+# zip_name -> {"thread": thread updating it, "pending": whether to go again when done}
+ZIP_BACKGROUND = {}
+ZIP_BACKGROUND_LOCK = threading.Lock()
+
+
+def reset_zips_after_fork():
+    global ZIP_BACKGROUND_LOCK
+    # NOTE: threads updating archives don't exist in the child and could have been holding the lock
+    ZIP_BACKGROUND_LOCK = threading.Lock()
+    ZIP_BACKGROUND.clear()
+
+
+os.register_at_fork(after_in_child=reset_zips_after_fork)
+
+
+def update_zip_background(zip_name, path, ignore_locks=True):
+    with ZIP_BACKGROUND_LOCK:
+        job = ZIP_BACKGROUND.get(zip_name, None)
+        if job is not None and job["thread"].is_alive():
+            # already working on it so just make sure it goes again after
+            job["pending"] = True
+            return job["thread"]
+        job = {"pending": False}
+
+        def run():
+            while True:
+                changed = False
+                try:
+                    changed = update_zip(zip_name, path, ignore_locks=ignore_locks)
+                except KeyboardInterrupt as ex:
+                    raise ex
+                except Exception as ex:
+                    logging.error(f"Couldn't update {zip_name}")
+                    logging.error(get_stack(ex))
+                with ZIP_BACKGROUND_LOCK:
+                    if not (changed or job["pending"]):
+                        del ZIP_BACKGROUND[zip_name]
+                        return
+                    job["pending"] = False
+
+        # NOTE: not daemon so exiting waits for archive to be finished
+        job["thread"] = threading.Thread(target=run, name=f"zip_{os.path.basename(zip_name)}")
+        ZIP_BACKGROUND[zip_name] = job
+        job["thread"].start()
+        return job["thread"]
+
+
+def wait_for_zips():
+    with ZIP_BACKGROUND_LOCK:
+        threads = [job["thread"] for job in ZIP_BACKGROUND.values()]
+    for thread in threads:
+        thread.join()
+
+
 def dump_json(data, path):
     dir_out = os.path.dirname(path)
     base = os.path.splitext(os.path.basename(path))[0]
@@ -3,6 +3,7 @@ from typing import final
 
 import geopandas as gpd
 import numpy as np
+import shapely
 from gis import CRS_WGS84, make_empty_gdf
 
 COLUMNS_STATION = ["lat", "lon"]
@@ -97,6 +98,11 @@ class Source(ABC):
     def __init__(self, bounds) -> None:
         # this applies to anything in the bounds
         self._bounds = bounds if bounds is None else bounds.dissolve()
+        # prepared in lat/lon so checking points doesn't need to project them
+        self._bounds_prepared = None
+        if self._bounds is not None:
+            self._bounds_prepared = self._bounds.to_crs(CRS_WGS84).geometry.iloc[0]
+            shapely.prepare(self._bounds_prepared)
 
     @classmethod
     @abstractmethod
@@ -124,7 +130,12 @@ class Source(ABC):
         return check_columns(df, cls._provides())
 
     def applies_to(self, lat, lon) -> bool:
-        return self._bounds is None or np.any(self._bounds.contains(make_point(lat, lon, self._bounds.crs)))
+        return self._bounds is None or bool(shapely.contains_xy(self._bounds_prepared, lon, lat))
+
+    def applies_to_all(self, lats, lons) -> np.ndarray:
+        if self._bounds is None:
+            return np.full(len(lats), True)
+        return shapely.contains_xy(self._bounds_prepared, np.asarray(lons), np.asarray(lats))
 
 
 class SourceFeature(Source):
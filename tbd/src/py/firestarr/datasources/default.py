@@ -3,17 +3,19 @@ import os
 from functools import cache
 
 import datasources.spotwx
+import geopandas as gpd
 import numpy as np
 import pandas as pd
+import shapely
 from common import (
     DEFAULT_M3_UNMATCHED_LAST_ACTIVE_IN_DAYS,
     DIR_SRC_PY_FIRSTARR,
+    FLAG_DEBUG,
     listdir_sorted,
     logging,
     pick_max,
     pick_max_by_column,
     to_utc,
-    tqdm_util,
 )
 from datasources.cwfis import SourceFeatureM3, SourceFireCiffc, SourceFwiCwfis
 from datasources.datatypes import (
@@ -31,10 +33,17 @@ from gis import (
     area_ha,
     area_ha_to_radius_m,
     gdf_to_file,
+    make_circles,
     to_gdf,
 )
+from shapely import STRtree
 
 STATUS_RANK = ["OUT", "UC", "BH", "OC", "UNK"]
+# features further than this from every fire don't get assigned to one
+MAX_ASSIGN_DISTANCE = 1 * KM_TO_M
+FLAG_DEBUG_ASSIGNMENT = False
+# HACK: so we can change just the value but it also requires FLAG_DEBUG
+FLAG_DEBUG_ASSIGNMENT = FLAG_DEBUG and FLAG_DEBUG_ASSIGNMENT
 
 
 def wx_interpolate(df):
@@ -60,9 +69,10 @@ def wx_interpolate(df):
     return df_filled
 
 
-def find_rank(x):
+def find_ranks(status):
+    codes = pd.Categorical(status, categories=STATUS_RANK).codes
     # rank is highest if unknown value
-    return STATUS_RANK.index(x) if x in STATUS_RANK else (len(STATUS_RANK) - 1)
+    return np.where(0 > codes, len(STATUS_RANK) - 1, codes)
 
 
 def assign_fires(
@@ -74,8 +84,16 @@ def assign_fires(
     # do this to make an index column
     df_features = df_features.reset_index().to_crs(CRS_COMPARISON)
     df_fires = df_fires.reset_index().to_crs(CRS_COMPARISON)
-    df_join = df_features.sjoin_nearest(df_fires, how="left", max_distance=1 * KM_TO_M)
-    df_join["status_rank"] = tqdm_util.apply(df_join["status"], find_rank, desc="Ranking by status")
+    df_join = df_features.sjoin_nearest(df_fires, how="left", max_distance=MAX_ASSIGN_DISTANCE)
+    return assign_joined(origin, df_join, days_to_keep_unmatched)
+
+
+def assign_joined(
+    origin,
+    df_join,
+    days_to_keep_unmatched=DEFAULT_M3_UNMATCHED_LAST_ACTIVE_IN_DAYS,
+):
+    df_join["status_rank"] = find_ranks(df_join["status"])
     df_unmatched = df_join[df_join["fire_name"].isna()][["datetime_left", "geometry"]].rename(
         columns={"datetime_left": "datetime"}
     )
@@ -109,6 +127,115 @@ def assign_fires(
     )
 
 
+def join_source(df_features, df_fires, pairs):
+    # same columns that sjoin_nearest() would give for (feature, fire) pairs
+    df_right = df_fires.reset_index().drop(columns="geometry")
+    df_right.index = np.arange(len(df_right))
+    df_right = df_right.rename(
+        columns={x: f"{x}_right" for x in df_right.columns if x in df_features.columns and "geometry" != x}
+    )
+    df_left = df_features.rename(
+        columns={x: f"{x}_left" for x in df_features.columns if f"{x}_right" in df_right.columns}
+    )
+    # features without a fire still need a row like with how="left"
+    matched = set(pairs["feature"])
+    unmatched = [x for x in range(len(df_features)) if x not in matched]
+    feature = np.concatenate([pairs["feature"].values, unmatched]).astype(int)
+    fire = np.concatenate([pairs["fire"].values, np.full(len(unmatched), -1)]).astype(int)
+    order = np.argsort(feature, kind="stable")
+    feature, fire = feature[order], fire[order]
+    df_join = df_left.iloc[feature].reset_index(drop=True)
+    df_fire = df_right.reindex(fire).reset_index(drop=True)
+    df_fire.insert(0, "index_right", np.where(0 <= fire, fire, np.nan))
+    df_join = pd.concat([df_join, df_fire], axis=1)
+    df_join.index = df_left.index[feature]
+    return df_join
+
+
+def assign_fires_from_sources(
+    origin,
+    sources,
+    df_fires,
+    days_to_keep_unmatched=DEFAULT_M3_UNMATCHED_LAST_ACTIVE_IN_DAYS,
+):
+    """!
+    Assign features from every source to fires using one spatial index
+    @param origin Origin to use for deciding what unmatched features are too old
+    @param sources Features from each source, with later sources overriding earlier ones
+    @param df_fires Fires to assign features to
+    @param days_to_keep_unmatched Days since unmatched features were active to keep them for
+    @return Tuple of fires after overriding them and features that didn't match any fire
+    """
+    # do this to make an index column
+    sources = [df.reset_index().to_crs(CRS_COMPARISON) for df in sources]
+    geoms_fires = np.array(df_fires.to_crs(CRS_COMPARISON).geometry)
+    geoms_features = np.concatenate([np.array(df.geometry) for df in sources])
+    num_fires = len(geoms_fires)
+    sizes = [len(df) for df in sources]
+    starts = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+    source_of = np.repeat(np.arange(len(sources)), sizes)
+    # a feature can only match a fire or a feature from an earlier source that replaced a fire
+    tree = STRtree(np.concatenate([geoms_fires, geoms_features]))
+    idx_feature, idx_target = tree.query(geoms_features, predicate="dwithin", distance=MAX_ASSIGN_DISTANCE)
+    source_target = np.where(
+        num_fires > idx_target,
+        -1,
+        source_of[np.maximum(0, idx_target - num_fires)],
+    )
+    keep = source_target < source_of[idx_feature]
+    df_pairs = pd.DataFrame(
+        {
+            "feature": idx_feature[keep],
+            "target": idx_target[keep],
+            "source_target": source_target[keep],
+            "distance": shapely.distance(
+                geoms_features[idx_feature[keep]],
+                tree.geometries[idx_target[keep]],
+            ),
+        }
+    )
+    # which source the geometry for each fire came from, or -1 for the original
+    source_geometry = np.full(num_fires, -1)
+    # (feature, fire) for features that replaced the geometry of a fire
+    df_assigned = pd.DataFrame({"target": [], "fire": []}, dtype=int)
+    df_unmatched = None
+    for i, df_src in enumerate(sources):
+        df_cur = df_pairs[source_of[df_pairs["feature"]] == i]
+        is_fire = num_fires > df_cur["target"]
+        df_cur = pd.concat(
+            [
+                df_cur[is_fire].assign(fire=df_cur["target"][is_fire]),
+                df_cur[~is_fire].merge(df_assigned, on="target"),
+            ]
+        )
+        # distance to a fire is distance to closest part of what it currently is
+        df_cur = df_cur[source_geometry[df_cur["fire"].astype(int)] == df_cur["source_target"]]
+        df_cur = df_cur.groupby(["feature", "fire"], as_index=False)["distance"].min()
+        # keep ties like sjoin_nearest() does
+        df_cur = df_cur[df_cur["distance"] == df_cur.groupby("feature")["distance"].transform("min")]
+        df_cur["feature"] -= starts[i]
+        df_join = join_source(df_src, df_fires, df_cur)
+        df_join = gpd.GeoDataFrame(df_join, geometry="geometry", crs=CRS_COMPARISON)
+        df_src_fires, df_unmatched_cur = assign_joined(origin, df_join, days_to_keep_unmatched)
+        # each source numbers unmatched from 0 so renumber or names would repeat
+        df_unmatched = pd.concat([df_unmatched, df_unmatched_cur], ignore_index=True)
+        df_fires = override_fires(df_fires, df_src_fires)
+        replaced = np.isin(df_fires.index, df_src_fires.index)
+        source_geometry[replaced] = i
+        df_assigned = pd.concat(
+            [
+                df_assigned,
+                pd.DataFrame(
+                    {
+                        "target": df_cur["feature"].values + starts[i] + num_fires,
+                        "fire": df_cur["fire"].values,
+                    }
+                ),
+            ]
+        )
+    return df_fires, df_unmatched
+
+
 def override_fires(df_fires, df_override):
     if df_override is not None and 0 < len(df_override):
         if df_fires.crs != df_override.crs:
@@ -185,6 +312,8 @@ class SourceFireActive(SourceFire):
     @cache
     def _get_fires(self):
         def save_fires(df, file_root):
+            if not FLAG_DEBUG_ASSIGNMENT or df is None:
+                return
             df_points = df[df.geometry.type == "Point"]
             df_polygons = df[df.geometry.type != "Point"]
             if 0 < len(df_points):
@@ -202,39 +331,39 @@ class SourceFireActive(SourceFire):
 
         df_ciffc = self._source_ciffc.get_fires()
         df_fires = df_ciffc.loc[:]
-        gdf_to_file(df_fires, self._dir_out, "df_fires_ciffc")
+        if FLAG_DEBUG_ASSIGNMENT:
+            gdf_to_file(df_fires, self._dir_out, "df_fires_ciffc")
         df_circles = df_fires.loc[df_fires.geometry.type == "Point"].to_crs(CRS_COMPARISON)
         # HACK: put in circles of proper area so spatial join should hopefully
         # overlap actual polygons
-        df_circles["geometry"] = tqdm_util.apply(
-            df_circles,
-            lambda x: x.geometry.buffer(max(0.1, area_ha_to_radius_m(max(0, x["area"])))),
-            desc="Converting points with area to circles",
-        ).simplify(100)
+        # NOTE: NaN area would make NaN radius so treat it as no area
+        radius = np.maximum(0.1, area_ha_to_radius_m(np.maximum(0, df_circles["area"].astype(float).fillna(0))))
+        df_circles["geometry"] = make_circles(df_circles.geometry, radius)
         df_circles = df_circles.to_crs(CRS_WGS84)
-        gdf_to_file(df_circles, self._dir_out, "df_fires_circles")
+        if FLAG_DEBUG_ASSIGNMENT:
+            gdf_to_file(df_circles, self._dir_out, "df_fires_circles")
         df_fires = self.check_columns(df_circles.iloc[:])
         df_unmatched = None
-        # override with each source in the order they appear
+        features = []
         for i, src in enumerate(self._source_features):
             df_src = src.get_features()
             if 0 < len(df_src):
                 save_fires(df_src, f"df_fires_from_feature_source_{i:02d}")
-                df_src_fires, df_unmatched_cur = assign_fires(self._origin, df_src, df_fires)
-                save_fires(df_src_fires, f"df_fires_assigned_feature_source_{i:02d}")
-                save_fires(df_unmatched_cur, f"df_fires_umatched_feature_source_{i:02d}")
-                df_unmatched = pd.concat([df_unmatched, df_unmatched_cur])
-                df_fires = override_fires(df_fires, df_src_fires)
-            save_fires(df_fires, f"df_fires_after_feature_source_{i:02d}")
+                features.append(df_src)
+        if features:
+            # later sources still match what earlier ones changed fires to
+            df_fires, df_unmatched = assign_fires_from_sources(self._origin, features, df_fires)
+            save_fires(df_unmatched, "df_fires_umatched_feature_sources")
+        save_fires(df_fires, "df_fires_after_feature_sources")
         for i, src in enumerate(self._source_fires):
             df_src_fires = src.get_fires()
-            save_fires(df_src, f"df_fires_from_fire_source_{i:02d}")
+            save_fires(df_src_fires, f"df_fires_from_fire_source_{i:02d}")
             df_fires = override_fires(df_fires, df_src_fires)
             save_fires(df_fires, f"df_fires_after_fire_source_{i:02d}")
         df_fires = df_fires.reset_index()
         logging.info(
             "Have %d polygons that are not tied to a fire",
-            len(df_unmatched),
+            0 if df_unmatched is None else len(df_unmatched),
         )
         if self._status_include:
             df_fires = df_fires.loc[df_fires.status.isin(self._status_include)]
@@ -252,14 +381,35 @@ class SourceFireActive(SourceFire):
                 self._status_omit,
             )
         save_fires(df_fires, "df_fires_after_status_omit")
-        # pretty sure U is unknown status
-        df_unmatched["status"] = "U"
-        df_unmatched["fire_name"] = [f"UNMATCHED_{x}" for x in df_unmatched.index]
+        if df_unmatched is not None:
+            # pretty sure U is unknown status
+            df_unmatched["status"] = "U"
+            df_unmatched["fire_name"] = [f"UNMATCHED_{x}" for x in df_unmatched.index]
         df_all = pd.concat([df_fires, df_unmatched])
         save_fires(df_fires, "df_fires_after_concat")
         return df_all
 
 
+def find_first_sources(sources, lats, lons):
+    # check every location against every source at once
+    applies = np.array([src.applies_to_all(lats, lons) for src in sources])
+    # last source gets used if nothing applies
+    return np.where(applies.any(axis=0), applies.argmax(axis=0), len(sources) - 1)
+
+
+def assign_first_sources(source_for, sources, lats, lons):
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    for lat, lon, i in zip(lats, lons, find_first_sources(sources, lats, lons)):
+        source_for[(lat, lon)] = sources[i]
+
+
+def find_first_source(source_for, sources, lat, lon):
+    if (lat, lon) not in source_for:
+        assign_first_sources(source_for, sources, [lat], [lon])
+    return source_for[(lat, lon)]
+
+
 class SourceFwiBest(SourceFwi):
     def __init__(
         self,
@@ -271,13 +421,15 @@ class SourceFwiBest(SourceFwi):
         self._sources = [s(self._dir_out) for s in find_sources(SourceFwi, private_first=True)] + [
             SourceFwiCwfis(self._dir_out)
         ]
+        # first source that applies to each location
+        self._source_for = {}
+
+    def assign_sources(self, lats, lons):
+        assign_first_sources(self._source_for, self._sources, lats, lons)
 
     @cache
     def _get_fwi(self, lat, lon, date):
-        # find first fwi source that applies to this
-        for src in self._sources:
-            if src.applies_to(lat, lon):
-                break
+        src = find_first_source(self._source_for, self._sources, lat, lon)
         return src._get_fwi(lat, lon, date)
 
 
@@ -315,11 +467,13 @@ class SourceHourlyBest(SourceHourly):
             # need some default hourly weather source
             SourceHourlyEmpty()
         ]
+        # first source that applies to each location
+        self._source_for = {}
+
+    def assign_sources(self, lats, lons):
+        assign_first_sources(self._source_for, self._sources, lats, lons)
 
     @cache
     def _get_wx_hourly(self, lat, lon, datetime_start, datetime_end=None):
-        # find first fwi source that applies to this
-        for src in self._sources:
-            if src.applies_to(lat, lon):
-                break
+        src = find_first_source(self._source_for, self._sources, lat, lon)
         return src._get_wx_hourly(lat, lon, datetime_start, datetime_end)
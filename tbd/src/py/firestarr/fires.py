@@ -1,19 +1,33 @@
+import hashlib
+import itertools
 import os
+import shutil
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 import pyproj
 import tqdm_util
-from common import DEFAULT_GROUP_DISTANCE_KM, logging
+from common import DEFAULT_GROUP_DISTANCE_KM, DIR_TMP, ensure_dir, force_remove, logging
 from gis import (
     CRS_COMPARISON,
     CRS_SIMINPUT,
     KM_TO_M,
-    GetSpatialReference,
+    find_raster_info,
     find_raster_meridians,
     gdf_from_file,
 )
+from shapely import STRtree
+from tqdm_util import pmap
+
+# read with arrow if available since it's much faster
+try:
+    import pyarrow  # noqa: F401
+    import pyogrio  # noqa: F401
+
+    USE_ARROW = True
+except ImportError:
+    USE_ARROW = False
 
 
 def separate_points(f):
@@ -22,7 +36,64 @@ def separate_points(f):
     return pts, polys
 
 
+def find_components(n, left, right):
+    # union-find over pairs of connected indices, returning a component number for each index
+    parent = np.arange(n)
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        # path compression so later lookups are quick
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for a, b in zip(left, right):
+        root_a = find(a)
+        root_b = find(b)
+        if root_a != root_b:
+            # always keep lowest index as root so numbering is stable
+            if root_a < root_b:
+                parent[root_b] = root_a
+            else:
+                parent[root_a] = root_b
+    roots = np.array([find(i) for i in range(n)], dtype=int)
+    return np.unique(roots, return_inverse=True)[1]
+
+
 def group_fires_by_buffer(df_fires, group_distance_km=DEFAULT_GROUP_DISTANCE_KM):
+    df_fires = df_fires.to_crs(CRS_COMPARISON)
+    group_distance = group_distance_km * KM_TO_M
+    crs = df_fires.crs
+    geoms = df_fires.geometry.reset_index(drop=True)
+    if 0 == len(geoms):
+        return None
+    # same simplification as buffering approach used so groups match
+    simplified = geoms.simplify(100)
+    tree = STRtree(simplified.values)
+    # pairs of (input, tree) indices that are close enough to be in the same group
+    left, right = tree.query(simplified.values, predicate="dwithin", distance=group_distance)
+    df = gpd.GeoDataFrame(
+        {
+            "group": find_components(len(geoms), left, right),
+            "is_point": geoms.geom_type == "Point",
+        },
+        geometry=geoms,
+        crs=crs,
+    )
+    # points near polygons are the same fire, so only keep points where there are no polygons
+    has_polygon = ~df.groupby("group")["is_point"].transform("all")
+    df = df.loc[~(has_polygon & df["is_point"])]
+    # points would dissolve into a MultiPoint but simulations start from a single Point
+    df = df.loc[~(df["is_point"] & df.duplicated("group"))]
+    logging.info("Grouped %d fires into %d groups", len(geoms), df["group"].nunique())
+    df_groups = df[["group", "geometry"]].dissolve(by="group")
+    return df_groups.reset_index(drop=True)
+
+
+# NOTE: previous approach that's O(groups * fires), kept to compare against in benchmark.py
+def group_fires_by_dissolve(df_fires, group_distance_km=DEFAULT_GROUP_DISTANCE_KM):
     df_fires = df_fires.to_crs(CRS_COMPARISON)
     # buffer half distance because buffers will just touch at the original distance
     group_distance = group_distance_km * KM_TO_M / 2
@@ -103,53 +174,53 @@ def name_groups(df):
         return df
     zone_rasters = find_raster_meridians()
     zone_rasters = {k: v for k, v in zone_rasters.items() if not v.endswith("_5.tif")}
+    rasters = np.array(list(zone_rasters.values()))
+    meridians = np.array(list(zone_rasters.keys()), dtype=float)
+    # keep dictionary order as tie-breaker so results match looping over it
+    order = np.argsort(meridians, kind="stable")
+    meridians_sorted = meridians[order]
 
-    def find_best_zone_raster(lon):
-        best = 9999
-        for i in zone_rasters.keys():
-            if abs(best - lon) > abs(i - lon):
-                best = i
-        return zone_rasters[best]
+    def find_best_zone_rasters(lon):
+        if 1 == len(meridians_sorted):
+            return np.repeat(rasters, len(lon))
+        # closest is always one of the meridians on either side
+        i = np.clip(np.searchsorted(meridians_sorted, lon), 1, len(meridians_sorted) - 1)
+        lower = order[i - 1]
+        upper = order[i]
+        dist_lower = np.abs(meridians[lower] - lon)
+        dist_upper = np.abs(meridians[upper] - lon)
+        use_upper = (dist_upper < dist_lower) | ((dist_upper == dist_lower) & (upper < lower))
+        return rasters[np.where(use_upper, upper, lower)]
 
-    df_groups = df.loc[:]
+    df_groups = df.reset_index(drop=True)
     # HACK: can't just convert to lat/long crs and use centroids from that
     # because it causes a warning
-    centroids = df_groups.centroid.to_crs(CRS_SIMINPUT)
+    centroids_crs = df_groups.centroid
+    centroids = centroids_crs.to_crs(CRS_SIMINPUT)
     df_groups["lon"] = centroids.x
     df_groups["lat"] = centroids.y
     # HACK: name based on UTM coordinates
-    df_groups["raster"] = tqdm_util.apply(df_groups["lon"], find_best_zone_raster, desc="Finding zone rasters")
-    df_rasters = pd.DataFrame({"raster": np.unique(df_groups[["raster"]])})
-    df_rasters["wkt"] = tqdm_util.apply(
-        df_rasters["raster"],
-        lambda r: GetSpatialReference(r).ExportToWkt(),
-        desc="Finding zone wkt",
-    )
-    df_rasters["zone"] = tqdm_util.apply(
-        df_rasters["raster"],
-        lambda r: int(os.path.basename(r).split("_")[1]),
-        desc="Finding zone numbers",
-    )
-    df_groups = pd.merge(df_groups, df_rasters)
-    df_centroids = df_groups.loc[:]
-    df_centroids["geometry"] = df_centroids.centroid
-
-    def find_zone_basemap(zone, lat, centroid_utm):
-        BM_MULT = 10000
-        easting = int((centroid_utm.x) // BM_MULT)
-        northing = int((centroid_utm.y) // BM_MULT)
-        basemap = easting * 1000 + northing
-        n_or_s = "N" if lat >= 0 else "S"
-        return f"{zone:02d}{n_or_s}_{basemap:05d}"
-
-    for i, g in tqdm_util.apply(df_centroids.groupby(["zone"]), desc="Naming groups by zone"):
-        wkt = g["wkt"].iloc[0]
-        g_zone = g.to_crs(wkt)
-        df_groups.loc[g_zone.index, "fire_name"] = tqdm_util.apply(
-            g_zone,
-            lambda x: find_zone_basemap(x["zone"], x["lat"], x["geometry"]),
-            desc="Naming groups",
-        )
+    df_groups["raster"] = find_best_zone_rasters(df_groups["lon"].values)
+    df_rasters = pd.DataFrame({"raster": np.unique(df_groups["raster"])})
+    info = [find_raster_info(r) for r in df_rasters["raster"]]
+    df_rasters["wkt"] = [x["wkt"] for x in info]
+    df_rasters["zone"] = [x["zone"] for x in info]
+    df_groups = df_groups.join(df_rasters.set_index("raster"), on="raster")
+    BM_MULT = 10000
+    df_groups["fire_name"] = None
+    x_crs = centroids_crs.x.values
+    y_crs = centroids_crs.y.values
+    for wkt, idx in tqdm_util.apply(df_groups.groupby("wkt").indices.items(), desc="Naming groups by zone"):
+        # project all centroids for zone at once
+        transformer = pyproj.Transformer.from_crs(df_groups.crs, wkt, always_xy=True)
+        x, y = transformer.transform(x_crs[idx], y_crs[idx])
+        easting = np.floor_divide(x, BM_MULT).astype(int)
+        northing = np.floor_divide(y, BM_MULT).astype(int)
+        g = df_groups.iloc[idx]
+        # str.zfill() keeps sign in front like f"{basemap:05d}" would
+        basemap = pd.Series(easting * 1000 + northing, index=g.index).astype(str).str.zfill(5)
+        n_or_s = np.where(g["lat"] >= 0, "N", "S")
+        df_groups.loc[g.index, "fire_name"] = g["zone"].astype(str).str.zfill(2) + n_or_s + "_" + basemap
     # it should be impossible for 2 groups to be in the same basemap
     # because they are grouped within > 10km
     logging.info("Created %d groups", len(df))
@@ -161,13 +232,55 @@ def group_fires(df_fires, group_distance_km=DEFAULT_GROUP_DISTANCE_KM):
     return name_groups(df_groups)
 
 
+def read_fires_file(file_shp):
+    kwargs = {}
+    if USE_ARROW:
+        kwargs = {"engine": "pyogrio", "use_arrow": True}
+    return gdf_from_file(file_shp, **kwargs)
+
+
+def find_shapefile_parts(file_shp):
+    # .shp is only the geometry, so attributes and projection are in files beside it
+    dir_shp = os.path.dirname(file_shp)
+    base = os.path.splitext(os.path.basename(file_shp))[0]
+    return sorted(os.path.join(dir_shp, f) for f in os.listdir(dir_shp) if f.startswith(f"{base}."))
+
+
 def get_fires_folder(dir_fires, crs=CRS_COMPARISON):
     proj = pyproj.CRS(crs)
-    df_fires = None
-    for root, dirs, files in os.walk(dir_fires):
-        for f in [x for x in files if x.lower().endswith(".shp")]:
-            file_shp = os.path.join(root, f)
-            df_fire = gdf_from_file(file_shp).to_crs(proj)
-            df_fires = pd.concat([df_fires, df_fire])
+    files_shp = sorted(
+        [os.path.join(root, f) for root, dirs, files in os.walk(dir_fires) for f in files if f.lower().endswith(".shp")]
+    )
+    if not files_shp:
+        raise RuntimeError(f"No fires found in {dir_fires}")
+    # reuse combined fires if none of the files changed
+    h = hashlib.sha256(proj.to_wkt().encode())
+    for f in itertools.chain.from_iterable(find_shapefile_parts(x) for x in files_shp):
+        stat = os.stat(f)
+        h.update(f"{f},{stat.st_mtime_ns},{stat.st_size}".encode())
+    dir_cache = ensure_dir(os.path.join(DIR_TMP, "fires_folder"))
+    # one cache file for each folder and crs so old ones can be removed when anything changes
+    prefix = hashlib.sha256(f"{os.path.abspath(dir_fires)},{proj.to_wkt()}".encode()).hexdigest()[:16]
+    file_cache = os.path.join(dir_cache, f"{prefix}_{h.hexdigest()[:16]}.parquet")
+    if os.path.isfile(file_cache):
+        try:
+            return gdf_from_file(file_cache)
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception:
+            logging.warning(f"Ignoring invalid cache {file_cache}")
+    df_files = pmap(read_fires_file, files_shp, desc="Reading fires")
+    # only reproject once for each crs that files are in
+    by_crs = {}
+    for df_fire in df_files:
+        by_crs[df_fire.crs] = by_crs.get(df_fire.crs, []) + [df_fire]
+    df_fires = pd.concat([pd.concat(dfs).to_crs(proj) for dfs in by_crs.values()])
     df_fires["fire_name"] = df_fires["FIRENUMB"]
+    file_tmp = f"{file_cache}.tmp"
+    force_remove(file_tmp, verbose=False)
+    df_fires.to_parquet(file_tmp)
+    shutil.move(file_tmp, file_cache)
+    for f in os.listdir(dir_cache):
+        if f.startswith(f"{prefix}_") and f.endswith(".parquet") and os.path.join(dir_cache, f) != file_cache:
+            force_remove(os.path.join(dir_cache, f), verbose=False)
     return df_fires
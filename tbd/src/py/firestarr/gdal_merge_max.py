@@ -33,12 +33,16 @@
 
 import math
 import os
+import tempfile
+import xml.etree.ElementTree as ET
 
 import numpy as np
+from common import DIR_TMP, force_remove
 from gis import with_gdal_exceptions_off
 from osgeo import gdal
 from osgeo_utils.auxiliary.util import GetOutputDriverFor
 from redundancy import call_safe
+from sparse import is_sparse, open_sparse
 
 # import logging
 from tqdm import tqdm
@@ -123,6 +127,8 @@ class file_info_max(object):
 
         Returns 1 on success or 0 if the file can't be opened.
         """
+        if is_sparse(filename):
+            return self.init_from_sparse(filename)
         fh = gdal.Open(filename)
         if fh is None:
             return 0
@@ -147,6 +153,27 @@ class file_info_max(object):
 
         return 1
 
+    def init_from_sparse(self, filename):
+        """
+        Initialize file_info from a file made by sparse.write_sparse()
+
+        Returns 1 on success.
+        """
+        sr = open_sparse(filename)
+        self.filename = filename
+        self.bands = 1
+        self.xsize = sr.xsize
+        self.ysize = sr.ysize
+        self.band_type = sr.band_type
+        self.projection = sr.projection
+        self.geotransform = sr.geotransform
+        self.ulx = self.geotransform[0]
+        self.uly = self.geotransform[3]
+        self.lrx = self.ulx + self.geotransform[1] * self.xsize
+        self.lry = self.uly + self.geotransform[5] * self.ysize
+        self.ct = None
+        return 1
+
     def copy_into(self, t_fh, s_band=1, t_band=1, nodata_arg=None):
         """
         Copy this files image into target file.
@@ -234,6 +261,219 @@ class file_info_max(object):
 # =============================================================================
 
 
+# built-in max pixel function for VRTs needs GDAL 3.8+ so use vrt_max() from here before that
+HAS_VRT_MAX = int(gdal.VersionInfo()) >= 3080000
+# merge canvas in strips of rows that match the tiff block size
+CANVAS_STRIP_ROWS = 512
+
+
+def find_canvas_dtype(band_type):
+    """
+    Find a float type that holds every value of band_type exactly.
+
+    Canvas needs to be floating point so nan can be used for no data.
+
+    Returns numpy dtype, or None if no float type can hold band_type.
+    """
+    if band_type in (gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_Int16, gdal.GDT_Float32) or band_type == getattr(
+        gdal, "GDT_Int8", None
+    ):
+        return np.float32
+    if band_type in (gdal.GDT_UInt32, gdal.GDT_Int32, gdal.GDT_Float64):
+        return np.float64
+    # 64 bit integers and complex types don't fit
+    return None
+
+
+def find_canvas(file_infos, tolerance=1e-6):
+    """
+    Find the canvas that covers all files if they're all on the same grid.
+
+    file_infos -- list of file_info objects to merge.
+
+    Returns (geotransform, xsize, ysize, offsets) with the integer pixel offset
+    of each file on the canvas, or None if any file would need resampling or
+    the output type can't be held on a canvas.
+    """
+    fi_first = file_infos[0]
+    if find_canvas_dtype(fi_first.band_type) is None:
+        return None
+    psize_x = fi_first.geotransform[1]
+    psize_y = fi_first.geotransform[5]
+    ulx = min(fi.ulx for fi in file_infos)
+    uly = max(fi.uly for fi in file_infos)
+    lrx = max(fi.lrx for fi in file_infos)
+    lry = min(fi.lry for fi in file_infos)
+
+    def to_pixels(v):
+        i = round(v)
+        return i if abs(v - i) < tolerance else None
+
+    offsets = []
+    for fi in file_infos:
+        g = fi.geotransform
+        if (
+            g[1] != psize_x
+            or g[5] != psize_y
+            or g[2] != 0
+            or g[4] != 0
+            or fi.bands != fi_first.bands
+            or fi.projection != fi_first.projection
+        ):
+            return None
+        xoff = to_pixels((fi.ulx - ulx) / psize_x)
+        yoff = to_pixels((fi.uly - uly) / psize_y)
+        if xoff is None or yoff is None:
+            return None
+        offsets.append((xoff, yoff))
+    xsize = round((lrx - ulx) / psize_x)
+    ysize = round((lry - uly) / psize_y)
+    return [ulx, psize_x, 0, uly, 0, psize_y], xsize, ysize, offsets
+
+
+def merge_onto_canvas(file_out, file_infos, canvas, driver, creation_options, a_nodata=None, description=None):
+    """
+    Merge files that are all on the same grid by taking the max of each cell.
+
+    Since every file is an integer offset on the canvas this is just np.fmax()
+    on slices, so nothing gets resampled. The canvas is a memmap so workers
+    can each fill a separate strip of rows in place. Only strips that some
+    file overlaps are on the canvas, since everything else is no data.
+    """
+    geotransform, xsize, ysize, offsets = canvas
+    bands = file_infos[0].bands
+    band_type = file_infos[0].band_type
+    dtype = find_canvas_dtype(band_type)
+    # HACK: strips are far apart when fires are so don't allocate the space between them
+    strips = [
+        row_start
+        for row_start in range(0, ysize, CANVAS_STRIP_ROWS)
+        if any(
+            yoff < row_start + CANVAS_STRIP_ROWS and row_start < yoff + fi.ysize
+            for fi, (xoff, yoff) in zip(file_infos, offsets)
+        )
+    ]
+    index = {row_start: i for i, row_start in enumerate(strips)}
+    fd, file_canvas = tempfile.mkstemp(dir=DIR_TMP, suffix=".canvas")
+    os.close(fd)
+    try:
+        shape = (len(strips), bands, CANVAS_STRIP_ROWS, xsize)
+        # allocate whole file so workers can all open it
+        np.memmap(file_canvas, dtype=dtype, mode="w+", shape=shape).flush()
+
+        def merge_strip(row_start):
+            row_end = min(ysize, row_start + CANVAS_STRIP_ROWS)
+            data = np.memmap(file_canvas, dtype=dtype, mode="r+", shape=shape)[index[row_start]]
+            # nan is no data so fmax() ignores it
+            data[:] = np.nan
+            for fi, (xoff, yoff) in zip(file_infos, offsets):
+                r0 = max(row_start, yoff)
+                r1 = min(row_end, yoff + fi.ysize)
+                if r0 >= r1:
+                    continue
+                if is_sparse(fi.filename):
+                    # only has cells with data so nothing else needs to be looked at
+                    rows, cols, values = open_sparse(fi.filename).read_rows(r0 - yoff, r1 - yoff)
+                    rows = rows + (yoff - row_start)
+                    cols = cols + xoff
+                    data[0, rows, cols] = np.fmax(data[0, rows, cols], values)
+                    continue
+                s_fh = gdal.Open(fi.filename)
+                if s_fh is None:
+                    raise RuntimeError(f"Couldn't open file {fi.filename}")
+                for b in range(bands):
+                    s_band = s_fh.GetRasterBand(b + 1)
+                    src = s_band.ReadAsArray(0, r0 - yoff, fi.xsize, r1 - r0).astype(dtype)
+                    nodata = s_band.GetNoDataValue()
+                    if nodata is not None:
+                        src[src == nodata] = np.nan
+                    view = data[b, (r0 - row_start) : (r1 - row_start), xoff : (xoff + fi.xsize)]
+                    np.fmax(view, src, out=view)
+                s_fh = None
+            data.flush()
+            return row_start
+
+        pmap(
+            merge_strip,
+            strips,
+            desc=f"Merging into {file_out}",
+        )
+        t_fh = driver.Create(file_out, xsize, ysize, bands, band_type, creation_options)
+        if t_fh is None:
+            raise RuntimeError("Creation failed, terminating gdal_merge.")
+        t_fh.SetGeoTransform(geotransform)
+        t_fh.SetProjection(file_infos[0].projection)
+        data = np.memmap(file_canvas, dtype=dtype, mode="r", shape=shape)
+        fill = np.nan if a_nodata is None else a_nodata
+        for b in range(bands):
+            t_band = t_fh.GetRasterBand(b + 1)
+            if a_nodata is not None:
+                t_band.SetNoDataValue(a_nodata)
+            if description:
+                t_band.SetDescription(description)
+            for row_start in range(0, ysize, CANVAS_STRIP_ROWS):
+                h = min(CANVAS_STRIP_ROWS, ysize - row_start)
+                if row_start in index:
+                    strip = data[index[row_start], b, :h, :]
+                    if a_nodata is not None:
+                        strip = np.where(np.isnan(strip), a_nodata, strip)
+                else:
+                    strip = np.full((h, xsize), fill, dtype=dtype)
+                t_band.WriteArray(strip, 0, row_start)
+        if description:
+            t_fh.SetDescription(description)
+        t_fh = None
+        data = None
+    finally:
+        force_remove(file_canvas, verbose=False)
+
+
+def vrt_max(in_ar, out_ar, *args, **kwargs):
+    """
+    Python pixel function for VRTs that takes the max of all sources.
+
+    Sources start as VRT nodata and only get cells that aren't source nodata, so
+    the max is nodata only where nothing has data.
+    """
+    np.max(in_ar, axis=0, out=out_ar)
+
+
+def build_max_vrt(file_vrt, names, src_nodata=0, a_nodata=-1, description=None):
+    """
+    Build a VRT that gives the max of all files for each cell when it's read.
+
+    file_vrt -- path to save VRT to.
+    names -- list of files that are all on the same grid.
+
+    Returns path to VRT.
+    """
+    # setting nodata makes every source a ComplexSource that skips nodata
+    vrt = call_safe(gdal.BuildVRT, file_vrt, names, srcNodata=src_nodata, VRTNodata=a_nodata)
+    if vrt is None:
+        raise RuntimeError(f"Couldn't build VRT {file_vrt}")
+    vrt = None
+    tree = ET.parse(file_vrt)
+    for band in tree.getroot().iter("VRTRasterBand"):
+        # derived band gets each source as a separate input instead of painting over them
+        band.set("subClass", "VRTDerivedRasterBand")
+        pixel_function = ET.Element("PixelFunctionType")
+        band.insert(0, pixel_function)
+        if HAS_VRT_MAX:
+            pixel_function.text = "max"
+        else:
+            # needs GDAL_VRT_PYTHON_TRUSTED_MODULES to include this module (see common.py)
+            pixel_function.text = "gdal_merge_max.vrt_max"
+            pixel_language = ET.Element("PixelFunctionLanguage")
+            pixel_language.text = "Python"
+            band.insert(1, pixel_language)
+        if description:
+            band_description = ET.Element("Description")
+            band_description.text = description
+            band.insert(0, band_description)
+    tree.write(file_vrt)
+    return file_vrt
+
+
 def gdal_merge_max(
     file_out,
     names,
@@ -292,6 +532,24 @@ def gdal_merge_max(
             except Exception:
                 pass
 
+            if t_fh is None:
+                # if everything is on the same grid then no need to go through gdal to copy
+                canvas = find_canvas(file_infos)
+                if canvas is not None:
+                    merge_onto_canvas(
+                        file_out,
+                        file_infos,
+                        canvas,
+                        driver,
+                        creation_options,
+                        a_nodata=a_nodata,
+                        description=description,
+                    )
+                    return files_invalid
+
+            if any(is_sparse(fi.filename) for fi in file_infos):
+                raise RuntimeError("Sparse rasters can only be merged into a new file on the same grid")
+
             # Create output file if it does not already exist.
             if t_fh is None:
                 # logging.info("Creating new file %s", file_out)
@@ -12,13 +12,16 @@ import geopandas as gpd
 import numpy as np
 import pandas as pd
 import pyproj
+import shapely
 from common import (
+    CELL_SIZE,
     CREATION_OPTIONS,
     DIR_DOWNLOAD,
     DIR_EXTRACTED,
     DIR_RASTER,
     DIR_TMP,
     do_nothing,
+    dump_json,
     ensure_dir,
     ensure_string_list,
     force_remove,
@@ -26,6 +29,7 @@ from common import (
     listdir_sorted,
     locks_for,
     logging,
+    read_json_safe,
     unzip,
 )
 from multiprocess import Lock
@@ -43,6 +47,13 @@ CRS_LAMBERT_ATLAS = 3978
 CRS_COMPARISON = CRS_LAMBERT_ATLAS
 CRS_NAD83 = 4269
 CRS_SIMINPUT = CRS_NAD83
+# national grid that every output gets projected onto so merging never resamples
+# NOTE: gdal targetAlignedPixels snaps to multiples of the cell size, so origin has to be (0, 0)
+GRID_CRS = CRS_COMPARISON
+GRID_CELL_SIZE = CELL_SIZE
+GRID_ORIGIN = (0, 0)
+# circles are only used to find overlaps so don't need many vertices
+CIRCLE_QUAD_SEGS = 4
 VALID_GEOMETRY_EXTENSIONS = [f".{x}" for x in sorted(fiona.drvsupport.vector_driver_extensions().keys())]
 VECTOR_FILE_EXTENSION = "gpkg"
 
@@ -223,19 +234,57 @@ def GetCellSize(raster):
     return pixelSizeX
 
 
-def Rasterize(file_lyr, raster, reference, datatype=gdal.GDT_Byte, creation_options=CREATION_OPTIONS):
+def find_clipped_grid(lyr, ref_info, buffer):
+    """!
+    Find grid aligned to reference raster that covers layer extent plus buffer
+    @param lyr Layer to find extent of
+    @param ref_info Metadata for reference raster to align to
+    @param buffer Distance to add around layer extent (m)
+    @return Tuple of geotransform, columns, and rows, or None if outside of reference
+    """
+    srs_ref = osr.SpatialReference(wkt=ref_info["wkt"])
+    srs_ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    srs_lyr = lyr.GetSpatialRef()
+    minx, maxx, miny, maxy = lyr.GetExtent()
+    if srs_lyr is not None and not srs_lyr.IsSame(srs_ref):
+        srs_lyr = srs_lyr.Clone()
+        srs_lyr.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(srs_lyr, srs_ref)
+        # densify edges so curved projected bounds still cover everything
+        minx, miny, maxx, maxy = transform.TransformBounds(minx, miny, maxx, maxy, 21)
+    gt = ref_info["geotransform"]
+    cell_size = gt[1]
+    col_min = max(0, math.floor((minx - buffer - gt[0]) / cell_size))
+    col_max = min(ref_info["xsize"], math.ceil((maxx + buffer - gt[0]) / cell_size))
+    row_min = max(0, math.floor((gt[3] - (maxy + buffer)) / cell_size))
+    row_max = min(ref_info["ysize"], math.ceil((gt[3] - (miny - buffer)) / cell_size))
+    if col_min >= col_max or row_min >= row_max:
+        return None
+    geotransform = [gt[0] + col_min * cell_size, cell_size, 0, gt[3] - row_min * cell_size, 0, -cell_size]
+    return geotransform, col_max - col_min, row_max - row_min
+
+
+def Rasterize(
+    file_lyr,
+    raster,
+    reference,
+    datatype=gdal.GDT_Byte,
+    creation_options=CREATION_OPTIONS,
+    buffer=None,
+):
     """!
     Convert a shapefile into a raster with the given spatial reference
     # @param shp Shapefile to convert to raster
     @param raster Raster file path to save result to
     @param reference Reference raster to use for extents and alignment
+    @param buffer Clip to extent of features plus this distance (m) instead of whole reference if not None
     @return None
     """
 
     def do_rasterize():
-        # Get projection info from reference image
-        ref_raster = call_safe(gdal.Open, reference, gdal.GA_ReadOnly)
-        gt = ref_raster.GetGeoTransform()
+        # Get projection info from reference image without opening it if it's in the catalog
+        ref_info = find_raster_info(reference) or describe_raster(reference)
+        gt = ref_info["geotransform"]
         pixelSizeX = gt[1]
         pixelSizeY = -gt[5]
         if pixelSizeX != pixelSizeY:
@@ -254,17 +303,24 @@ def Rasterize(file_lyr, raster, reference, datatype=gdal.GDT_Byte, creation_opti
         # Rasterise
         # ~ print("Rasterising shapefile...")
         # crs = osr.SpatialReference(wkt=ref_raster.GetProjectionRef())
-        crs = ref_raster.GetProjectionRef()
+        crs = ref_info["wkt"]
+        grid = None
+        if buffer is not None:
+            # still aligned to reference, but size depends on features and not whole reference
+            grid = find_clipped_grid(lyr, ref_info, buffer)
+        if grid is None:
+            grid = gt, ref_info["xsize"], ref_info["ysize"]
+        geotransform, xsize, ysize = grid
         output = gdal.GetDriverByName(gdalformat).Create(
             raster,
-            ref_raster.RasterXSize,
-            ref_raster.RasterYSize,
+            xsize,
+            ysize,
             1,
             datatype,
             options=creation_options,
         )
         output.SetProjection(crs)
-        output.SetGeoTransform(ref_raster.GetGeoTransform())
+        output.SetGeoTransform(geotransform)
         # Write data to band 1
         band = output.GetRasterBand(1)
         band.SetNoDataValue(0)
@@ -272,7 +328,6 @@ def Rasterize(file_lyr, raster, reference, datatype=gdal.GDT_Byte, creation_opti
         # Close datasets
         del band
         del output
-        del ref_raster
         del lyr
         del feature
         # del src_ds
@@ -307,28 +362,65 @@ def sum_raster(raster, band_number=1):
     src = gdal.Open(raster)
     band = src.GetRasterBand(band_number)
     nodata = band.GetNoDataValue()
-    r_array = np.array(band.ReadAsArray())
-    r_array[r_array == nodata] = 0.0
-    result = r_array.sum()
-    del r_array
+    result = 0.0
+    for _, _, r_array in iter_blocks(band):
+        if nodata is not None:
+            r_array = r_array[r_array != nodata]
+        result += r_array.sum(dtype=np.float64)
     del band
     del src
     return result
 
 
-# Dictionary of meridians to the rasters they are for
-MERIDIANS = None
+def iter_blocks(band, min_cells=1024 * 1024, window=None):
+    """!
+    Read band a block at a time so it never needs to all be in memory
+    @param band Band to read
+    @param min_cells Read rows of blocks together until there are at least this many cells
+    @param window (xoff, yoff, xsize, ysize) of part of band to read (None for all of it)
+    @return Generator of (xoff, yoff, array) for each part of band, with offsets relative to window
+    """
+    x0, y0, x_size, y_size = window or (0, 0, band.XSize, band.YSize)
+    block_x, block_y = band.GetBlockSize()
+    # HACK: striped files have blocks that are a single row, so read a bunch at once
+    if block_x >= band.XSize:
+        block_y *= max(1, min_cells // (x_size * block_y))
+    for yoff in range(0, y_size, block_y):
+        h = min(block_y, y_size - yoff)
+        for xoff in range(0, x_size, block_x):
+            w = min(block_x, x_size - xoff)
+            yield xoff, yoff, band.ReadAsArray(x0 + xoff, y0 + yoff, w, h)
 
 
-def find_raster_meridians(year=None):
+# Dictionary of (file, crs) to mtime of file and bounds and spatial index for them
+BOUNDS_INDEX = {}
+
+
+def find_bounds_index(file_bounds, crs=CRS_COMPARISON):
     """!
-    Find the meridians of input rasters for the given year
-    @param year Year to find raster meridians for
-    @return Dictionary of meridians to raster with each meridian
+    Load bounds and index them, reusing what's already loaded if possible
+    @param file_bounds Bounds file to load
+    @param crs CRS to project bounds to
+    @return Tuple of bounds and STRtree of prepared bounds geometries
     """
-    global MERIDIANS
-    if MERIDIANS:
-        return MERIDIANS
+    key = (file_bounds, str(crs))
+    mtime = os.path.getmtime(file_bounds)
+    cached = BOUNDS_INDEX.get(key, None)
+    # reload if bounds file changed since it was loaded
+    if cached is None or cached[0] != mtime:
+        df_bounds = gdf_from_file(file_bounds).to_crs(crs).reset_index(drop=True)
+        geoms = np.array(df_bounds.geometry)
+        shapely.prepare(geoms)
+        cached = (mtime, (df_bounds, shapely.STRtree(geoms)))
+        BOUNDS_INDEX[key] = cached
+    return cached[1]
+
+
+# Dictionary of raster directories to catalog of rasters in them
+RASTER_CATALOG = {}
+
+
+def find_raster_root(year=None):
     raster_root = None
     for folder in ["default", str(year)]:
         dir_check = os.path.join(DIR_RASTER, folder)
@@ -336,23 +428,108 @@ def find_raster_meridians(year=None):
             raster_root = dir_check
     if not raster_root:
         raise RuntimeError(f"Could not find raster directories in {DIR_RASTER}")
-    rasters = [
-        os.path.join(raster_root, x)
-        for x in listdir_sorted(raster_root)
-        if x[-4:].lower() == ".tif" and -1 != x.find("fuel")
-    ]
-    result = {}
-    for r in rasters:
-        raster = gdal.Open(r)
-        prj = raster.GetProjection()
-        srs = osr.SpatialReference(wkt=prj)
-        result[srs.GetProjParm("CENTRAL_MERIDIAN")] = r
-        del srs
-        del prj
-        del raster
-    MERIDIANS = result
+    return raster_root
+
+
+def describe_raster(path):
+    """!
+    Read what we need to know about a grid raster without keeping it open
+    @param path Raster to describe
+    @return Dictionary of raster metadata
+    """
+    raster = call_safe(gdal.Open, path)
+    prj = raster.GetProjection()
+    srs = osr.SpatialReference(wkt=prj)
+    gt = raster.GetGeoTransform()
+    name = os.path.basename(path)
+    try:
+        zone = int(name.split("_")[1])
+    except (IndexError, ValueError):
+        zone = None
+    result = {
+        "path": path,
+        "meridian": srs.GetProjParm("CENTRAL_MERIDIAN"),
+        "zone": zone,
+        "wkt": prj,
+        "geotransform": list(gt),
+        "xsize": raster.RasterXSize,
+        "ysize": raster.RasterYSize,
+        "extent": [
+            gt[0],
+            gt[3] + gt[5] * raster.RasterYSize,
+            gt[0] + gt[1] * raster.RasterXSize,
+            gt[3],
+        ],
+        "dtype": gdal.GetDataTypeName(raster.GetRasterBand(1).DataType),
+    }
+    del srs
+    del raster
+    return result
+
+
+def read_raster_catalog(year=None):
+    """!
+    Find metadata for all rasters in grid directory for the given year
+    @param year Year to find rasters for
+    @return List of raster metadata in same order as directory listing
+    """
+    raster_root = find_raster_root(year)
+    # directory mtime changes whenever rasters are added or removed
+    mtime = os.path.getmtime(raster_root)
+    catalog = RASTER_CATALOG.get(raster_root, None)
+    if catalog is None or catalog["mtime"] != mtime:
+        # NOTE: keep out of raster directory so writing it doesn't change the mtime
+        file_catalog = os.path.join(os.path.dirname(raster_root), f"catalog_{os.path.basename(raster_root)}.json")
+        catalog = None
+        if os.path.isfile(file_catalog):
+            try:
+                catalog = read_json_safe(file_catalog)
+            except KeyboardInterrupt as ex:
+                raise ex
+            except Exception as ex:
+                logging.warning(f"Ignoring invalid raster catalog {file_catalog}")
+                logging.debug(get_stack(ex))
+        if catalog is None or catalog.get("mtime", None) != mtime:
+            logging.info(f"Cataloging rasters in {raster_root}")
+            rasters = [os.path.join(raster_root, x) for x in listdir_sorted(raster_root) if x[-4:].lower() == ".tif"]
+            catalog = {"mtime": mtime, "rasters": [describe_raster(r) for r in rasters]}
+            try:
+                dump_json(catalog, file_catalog)
+            except KeyboardInterrupt as ex:
+                raise ex
+            except Exception as ex:
+                # still works without saving, it's just slower next time
+                logging.warning(f"Couldn't save raster catalog {file_catalog}")
+                logging.debug(get_stack(ex))
+        RASTER_CATALOG[raster_root] = catalog
+    return catalog["rasters"]
+
+
+def find_raster_info(path):
+    """!
+    Find catalog entry for raster if it's a grid raster
+    @param path Raster to find entry for
+    @return Dictionary of raster metadata, or None if not in catalog
+    """
+    path = os.path.abspath(path)
+    if os.path.dirname(os.path.dirname(path)) == os.path.abspath(DIR_RASTER):
+        year = os.path.basename(os.path.dirname(path))
+        for r in read_raster_catalog(None if "default" == year else year):
+            if os.path.abspath(r["path"]) == path:
+                return r
+    return None
+
+
+def find_raster_meridians(year=None):
+    """!
+    Find the meridians of input rasters for the given year
+    @param year Year to find raster meridians for
+    @return Dictionary of meridians to raster with each meridian
+    """
+    rasters = [r for r in read_raster_catalog(year) if -1 != os.path.basename(r["path"]).find("fuel")]
+    result = {r["meridian"]: r["path"] for r in rasters}
     if is_empty(result):
-        logging.error("Error: missing rasters in directory {}".format(raster_root))
+        logging.error("Error: missing rasters in directory {}".format(find_raster_root(year)))
     return result
 
 
@@ -382,6 +559,7 @@ def project_raster(
     crs="EPSG:4326",
     resolution=None,
     format=None,
+    target_aligned=False,
 ):
     if is_invalid_tiff(filename, test_read=True):
         # NOTE: DO NOT DELETE SINCE SOMETHING ELSE COULD BE WRITING CONCURRENTLY
@@ -405,17 +583,19 @@ def project_raster(
         def do_save(_):
             force_remove(_)
             ensure_dir(os.path.dirname(_))
+            # NOTE: keywords beside options=gdal.WarpOptions() get ignored so nodata has to go in there
             warp = gdal.Warp(
                 _,
                 input_raster,
-                dstNodata=nodata,
                 options=gdal.WarpOptions(
+                    dstNodata=nodata,
                     dstSRS=crs,
                     format=format,
                     xRes=resolution,
                     yRes=resolution,
                     outputBounds=outputBounds,
                     creationOptions=options,
+                    targetAlignedPixels=target_aligned,
                 ),
             )
             geoTransform = warp.GetGeoTransform()
@@ -449,6 +629,121 @@ def project_raster(
         return call_safe(do_save, output_raster)
 
 
+def project_raster_to_grid(filename, output_raster=None, nodata=0, options=None):
+    """!
+    Project raster directly onto the grid that outputs get merged on
+    @param filename Raster to project
+    @param output_raster Path to save projected raster to
+    @param nodata Nodata value to use for output
+    @param options Creation options to use for output
+    @return Bounds of projected and cropped raster, or None if input was invalid
+    """
+    if options is None:
+        options = ["COMPRESS=LZW", "TILED=YES"]
+    bounds = project_raster(
+        filename,
+        output_raster,
+        nodata=nodata,
+        options=options,
+        crs=f"EPSG:{GRID_CRS}",
+        resolution=GRID_CELL_SIZE,
+        target_aligned=True,
+    )
+    if bounds is None:
+        return bounds
+    if output_raster is None:
+        output_raster = filename[:-4] + ".tif"
+    # outputs are mostly empty so don't make everything after this read all of it
+    with locks_for(output_raster):
+        return crop_to_data(output_raster, options=options)
+
+
+def find_data_mask(data, nodata):
+    mask = ~np.isnan(data) if np.issubdtype(data.dtype, np.floating) else np.ones(data.shape, dtype=bool)
+    if nodata is not None and not np.isnan(nodata):
+        mask &= data != nodata
+    return mask
+
+
+def find_data_window(band):
+    """!
+    Find smallest window that has every cell with data in it
+    @param band Band to check
+    @return (xoff, yoff, xsize, ysize) of window, or None if nothing has data
+    """
+    nodata = band.GetNoDataValue()
+    x0, y0, x1, y1 = band.XSize, band.YSize, 0, 0
+    for xoff, yoff, data in iter_blocks(band):
+        mask = find_data_mask(data, nodata)
+        cols = np.flatnonzero(mask.any(axis=0))
+        if 0 == len(cols):
+            continue
+        rows = np.flatnonzero(mask.any(axis=1))
+        x0, x1 = min(x0, xoff + cols[0]), max(x1, xoff + cols[-1] + 1)
+        y0, y1 = min(y0, yoff + rows[0]), max(y1, yoff + rows[-1] + 1)
+    if x0 >= x1:
+        return None
+    return int(x0), int(y0), int(x1 - x0), int(y1 - y0)
+
+
+def crop_to_data(filename, options=None):
+    """!
+    Crop raster to the cells with data so later steps don't read empty space
+    @param filename Raster to crop in place
+    @param options Creation options to use for cropped raster
+    @return Bounds of raster after cropping
+    """
+    if options is None:
+        options = ["COMPRESS=LZW", "TILED=YES"]
+    src = call_safe(gdal.Open, filename)
+    try:
+        # keep a single cell if there's nothing so there's still a file to merge
+        window = find_data_window(src.GetRasterBand(1)) or (0, 0, 1, 1)
+        gt = src.GetGeoTransform()
+        if window != (0, 0, src.RasterXSize, src.RasterYSize):
+            file_tmp = f"{filename}.tmp"
+            force_remove(file_tmp, verbose=False)
+            call_safe(gdal.Translate, file_tmp, src, format="GTiff", srcWin=list(window), creationOptions=options)
+            src = None
+            os.replace(file_tmp, filename)
+    finally:
+        src = None
+    xoff, yoff, xsize, ysize = window
+    minx = gt[0] + xoff * gt[1]
+    maxy = gt[3] + yoff * gt[5]
+    return [minx, maxy + ysize * gt[5], minx + xsize * gt[1], maxy]
+
+
+def is_on_grid(filename, crs=GRID_CRS, resolution=GRID_CELL_SIZE, origin=GRID_ORIGIN):
+    """!
+    Check if raster is already aligned to the grid that outputs get merged on
+    @param filename Raster to check
+    @param crs EPSG code of grid
+    @param resolution Cell size of grid
+    @param origin Coordinates of grid origin
+    @return Whether raster can be merged without projecting it
+    """
+    ds = call_safe(gdal.Open, filename)
+    try:
+        srs = ds.GetSpatialRef()
+        if srs is None:
+            return False
+        srs.AutoIdentifyEPSG()
+        if str(crs) != srs.GetAuthorityCode(None):
+            return False
+        ulx, psize_x, rot_x, uly, rot_y, psize_y = ds.GetGeoTransform()
+        return (
+            0 == rot_x
+            and 0 == rot_y
+            and resolution == psize_x
+            and -resolution == psize_y
+            and 0 == math.fmod(ulx - origin[0], resolution)
+            and 0 == math.fmod(uly - origin[1], resolution)
+        )
+    finally:
+        ds = None
+
+
 def save_geojson(df, path):
     dir = os.path.dirname(path)
     base = os.path.splitext(os.path.basename(path))[0]
@@ -554,7 +849,20 @@ def area_ha(df):
 
 
 def area_ha_to_radius_m(a):
-    return math.sqrt(a * HA_TO_MSQ / math.pi)
+    # works on arrays too
+    return np.sqrt(a * HA_TO_MSQ / np.pi)
+
+
+def make_circles(points, radius, quad_segs=CIRCLE_QUAD_SEGS):
+    """!
+    Turn points into circles all at once
+    @param points GeoSeries of points in a CRS that uses meters
+    @param radius Radius for each point (m)
+    @param quad_segs Number of segments per quarter circle
+    @return GeoSeries of circles with same index and CRS as points
+    """
+    circles = shapely.buffer(np.array(points), np.asarray(radius, dtype=float), quad_segs=quad_segs)
+    return gpd.GeoSeries(circles, index=points.index, crs=points.crs)
 
 
 def make_empty_gdf(columns):
@@ -587,11 +895,130 @@ def with_gdal_exceptions_off(fct, *args, **kwargs):
                 gdal.UseExceptions()
 
 
-def is_invalid_tiff(path, bands=[1], test_read=False):
+# size in bytes of each TIFF field type
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+TIFF_TYPE_UNSIGNED = {3: "u2", 4: "u4", 16: "u8"}
+TIFF_TAG_STRIP_OFFSETS = 273
+TIFF_TAG_STRIP_BYTE_COUNTS = 279
+TIFF_TAG_TILE_OFFSETS = 324
+TIFF_TAG_TILE_BYTE_COUNTS = 325
+# no real file has anywhere near this many overviews
+TIFF_MAX_IFDS = 64
+
+
+def read_tiff_block_index(path):
+    """!
+    Check TIFF header and every IFD without decoding any image data
+    @param path Path of TIFF to check
+    @return List of (offsets, byte_counts) arrays for each IFD
+    """
+    size_file = os.path.getsize(path)
+    result = []
+    with open(path, "rb") as f:
+
+        def read_at(offset, n):
+            if offset < 0 or offset + n > size_file:
+                raise RuntimeError(f"Offset {offset} + {n} is past end of {path} ({size_file})")
+            f.seek(offset)
+            return f.read(n)
+
+        header = read_at(0, 16 if 16 <= size_file else 8)
+        if header[:2] not in (b"II", b"MM"):
+            raise RuntimeError(f"Invalid byte order for {path}")
+        bo = "<" if header[:2] == b"II" else ">"
+        version = np.frombuffer(header[2:4], dtype=f"{bo}u2")[0]
+        if 42 == version:
+            fmt_count, size_entry, fmt_offset = "u2", 12, "u4"
+            offset_ifd = int(np.frombuffer(header[4:8], dtype=f"{bo}u4")[0])
+        elif 43 == version:
+            fmt_count, size_entry, fmt_offset = "u8", 20, "u8"
+            offset_ifd = int(np.frombuffer(header[8:16], dtype=f"{bo}u8")[0])
+        else:
+            raise RuntimeError(f"Invalid TIFF version {version} for {path}")
+        size_count = np.dtype(fmt_count).itemsize
+        size_offset = np.dtype(fmt_offset).itemsize
+        dtype_entry = np.dtype(
+            [
+                ("tag", f"{bo}u2"),
+                ("type", f"{bo}u2"),
+                ("count", f"{bo}{fmt_offset}"),
+                ("value", f"V{size_offset}"),
+            ]
+        )
+        seen = set()
+        while 0 != offset_ifd:
+            if offset_ifd in seen or len(seen) >= TIFF_MAX_IFDS:
+                raise RuntimeError(f"Invalid IFD chain in {path}")
+            seen.add(offset_ifd)
+            n = int(np.frombuffer(read_at(offset_ifd, size_count), dtype=f"{bo}{fmt_count}")[0])
+            offset_entries = offset_ifd + size_count
+            entries = np.frombuffer(read_at(offset_entries, n * size_entry), dtype=dtype_entry)
+            offset_ifd = int(
+                np.frombuffer(read_at(offset_entries + n * size_entry, size_offset), dtype=f"{bo}{fmt_offset}")[0]
+            )
+
+            def read_values(tag):
+                e = entries[entries["tag"] == tag]
+                if 0 == len(e):
+                    return None
+                e = e[0]
+                t = int(e["type"])
+                if t not in TIFF_TYPE_UNSIGNED:
+                    raise RuntimeError(f"Unexpected type {t} for tag {tag} in {path}")
+                count = int(e["count"])
+                n_bytes = count * TIFF_TYPE_SIZES[t]
+                if n_bytes <= size_offset:
+                    data = e["value"].tobytes()[:n_bytes]
+                else:
+                    offset = int(np.frombuffer(e["value"].tobytes(), dtype=f"{bo}{fmt_offset}")[0])
+                    data = read_at(offset, n_bytes)
+                return np.frombuffer(data, dtype=f"{bo}{TIFF_TYPE_UNSIGNED[t]}").astype(np.uint64)
+
+            offsets = read_values(TIFF_TAG_TILE_OFFSETS)
+            counts = read_values(TIFF_TAG_TILE_BYTE_COUNTS)
+            if offsets is None:
+                offsets = read_values(TIFF_TAG_STRIP_OFFSETS)
+                counts = read_values(TIFF_TAG_STRIP_BYTE_COUNTS)
+            if offsets is None or counts is None or len(offsets) != len(counts):
+                raise RuntimeError(f"Missing block index in {path}")
+            # sparse blocks have 0 for both offset and size
+            if np.any((offsets + counts) > size_file):
+                raise RuntimeError(f"Block data is past end of {path}")
+            result.append((offsets, counts))
+    if not result:
+        raise RuntimeError(f"No IFDs in {path}")
+    return result
+
+
+def read_last_block(band, block_index):
+    """!
+    Decode the block that was written last based on its position in the file
+    @param band Band to read block from
+    @param block_index Index of block to read
+    @return None
+    """
+    xblock, yblock = band.GetBlockSize()
+    nx = math.ceil(band.XSize / xblock)
+    ny = math.ceil(band.YSize / yblock)
+    # separate planes have all blocks for each band one after another
+    by, bx = divmod(int(block_index) % (nx * ny), nx)
+    xoff = bx * xblock
+    yoff = by * yblock
+    data = band.ReadRaster(xoff, yoff, min(xblock, band.XSize - xoff), min(yblock, band.YSize - yoff))
+    if data is None:
+        raise RuntimeError("Unable to read block")
+
+
+def is_invalid_tiff(path, bands=[1], test_read=False, full_read=False):
     def do_check():
         # HACK: all these checks for None only apply when not using exceptions?
         if not os.path.isfile(path):
             return False
+        idx_last = None
+        if test_read and not full_read:
+            # if the structure is fine then everything that was supposed to be written is in the file
+            offsets, counts = read_tiff_block_index(path)[0]
+            idx_last = np.argmax(offsets + counts)
         src = gdal.Open(path)
         if src is None:
             return False
@@ -604,10 +1031,14 @@ def is_invalid_tiff(path, bands=[1], test_read=False):
                 # HACK: just avoid not used warning
                 pass
             if test_read:
-                r_array = np.array(band.ReadAsArray())
-                if r_array is not None:
+                if full_read:
+                    r_array = np.array(band.ReadAsArray())
+                    if r_array is not None:
+                        return False
+                    del r_array
+                else:
+                    read_last_block(band, idx_last)
                     return False
-                del r_array
             del band
         del src
         return True
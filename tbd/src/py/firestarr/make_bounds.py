@@ -1,10 +1,14 @@
+import hashlib
+import inspect
 import os
+import shutil
 
 import numpy as np
 import pandas as pd
 import shapely.geometry
-from common import DIR_GENERATED, ensures
+from common import DIR_GENERATED, ensure_dir, ensures, force_remove, logging
 from gis import CRS_WGS84, gdf_from_file, gdf_to_file, load_geometry_file, vector_path
+from tqdm_util import pmap
 
 KM_TO_M = 1000
 BY_NAME = {}
@@ -16,6 +20,9 @@ centroids_canada = None
 DIR_BOUNDS = os.path.join(DIR_GENERATED, "bounds")
 FILE_BOUNDS = "bounds.geojson"
 COLUMN_ENGLISH_NAME = "PRENAME"
+DIR_STAGES = os.path.join(DIR_BOUNDS, "stages")
+# features for canada by arguments used to make them
+FEATURES_CANADA = {}
 
 
 def to_file_dir(df, name, dir_out, centroids_compare=None):
@@ -92,6 +99,76 @@ def dist(c1, c2):
     return np.sum([v.distance(c2[k]) for k, v in c1.items()])
 
 
+def hash_gdf(df):
+    h = hashlib.sha256()
+    h.update(str(df.crs).encode())
+    h.update(",".join([str(x) for x in list(df.index.names) + list(df.columns)]).encode())
+    h.update(pd.util.hash_pandas_object(df.drop(columns=["geometry"]), index=True).values.tobytes())
+    for wkb in df.geometry.to_wkb():
+        h.update(wkb if wkb is not None else b"")
+    return h.hexdigest()
+
+
+def run_stage(df, name, fct, *args, dir_cache=DIR_STAGES):
+    # output only depends on input, arguments, and code for step so reuse it if those match
+    h = hashlib.sha256()
+    h.update(hash_gdf(df).encode())
+    h.update(repr(args).encode())
+    h.update(inspect.getsource(fct).encode())
+    file_out = os.path.join(ensure_dir(dir_cache), f"{name}_{h.hexdigest()[:16]}.parquet")
+    if os.path.isfile(file_out):
+        try:
+            return gdf_from_file(file_out)
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception:
+            logging.warning(f"Recalculating {name} since {file_out} is invalid")
+    df = fct(df, *args)
+    file_tmp = f"{file_out}.tmp"
+    force_remove(file_tmp, verbose=False)
+    df.to_parquet(file_tmp)
+    shutil.move(file_tmp, file_out)
+    return df
+
+
+def run_stages(df, stages, dir_cache=DIR_STAGES):
+    for name, fct, args in stages:
+        df = run_stage(df, name, fct, *args, dir_cache=dir_cache)
+    return df
+
+
+def run_stages_by_id(df, stages, dir_cache=DIR_STAGES):
+    # every stage works within a single ID so do each of them separately
+    groups = [g for _, g in df.groupby("ID", sort=False)]
+    results = pmap(
+        lambda g: run_stages(g, stages, dir_cache=dir_cache),
+        groups,
+        desc="Running stages",
+    )
+    return pd.concat(results).sort_values("EN")
+
+
+# stages for turning exact bounds into simplified buffered bounds
+STAGES_BOUNDS = [
+    ("explode", explode, []),
+    ("buffer", buffer, [100]),
+    ("buffer_simplify_dissolve", dissolve, []),
+    ("explode_dissolve", explode, []),
+    ("buffer_simplify_dissolve_fill", fill, []),
+    ("redissolve", dissolve, []),
+    ("simplify_10km", simplify, [10]),
+    ("simplify_100km", simplify, [100]),
+]
+# stages for making bounds for a single id
+STAGES_ID = [
+    ("explode", explode, []),
+    ("buffer", buffer, [100]),
+    ("fill", fill, []),
+    ("dissolve", dissolve, []),
+    ("simplify_1km", simplify, [1]),
+]
+
+
 def get_features_canada(
     file_canada=URL_CANADA,
     dir_out=DIR_BOUNDS,
@@ -99,6 +176,8 @@ def get_features_canada(
     col_name=COLUMN_ENGLISH_NAME,
 ):
     file_out = vector_path(dir_out, "canada")
+    if file_out in FEATURES_CANADA:
+        return FEATURES_CANADA[file_out].loc[:]
 
     @ensures(file_out, True, fct_process=gdf_from_file, mkdirs=True)
     def do_create(_):
@@ -112,7 +191,8 @@ def get_features_canada(
         df.reset_index().to_file(_)
         return _
 
-    return do_create(file_out)
+    FEATURES_CANADA[file_out] = do_create(file_out)
+    return FEATURES_CANADA[file_out].loc[:]
 
 
 def get_bounds_from_id(id, dir_out=DIR_BOUNDS, *args, **kwargs):
@@ -122,10 +202,9 @@ def get_bounds_from_id(id, dir_out=DIR_BOUNDS, *args, **kwargs):
     @ensures(file_out, True, fct_process=gdf_from_file, mkdirs=True)
     def do_create(_):
         gdf_ca = get_features_canada(dir_out=dir_out, *args, **kwargs)
-        gdf = gdf_ca.set_index(["ID"]).loc[[id]]
-        gdf = dissolve(fill(buffer(explode(gdf), 100)))
-        gdf = simplify(gdf, 1)
-        gdf.reset_index().to_file(_)
+        gdf = gdf_ca.loc[gdf_ca["ID"] == id]
+        gdf = run_stages(gdf, STAGES_ID)
+        gdf.reset_index(drop=True).to_file(_)
         return _
 
     return do_create(file_out)
@@ -163,14 +242,8 @@ def update_bounds(
         df = pd.concat([df, df_parks_all]).sort_index()
     df.loc[df_canada.index, "geometry"] = df_canada["geometry"]
     df = to_file(df.reset_index(), "bounds_exact")
-    df = to_file(explode(df), "explode")
-    df = to_file(buffer(df, 100), "buffer")
-    df = to_file(dissolve(df), "buffer_simplify_dissolve")
-    df = to_file(explode(df), "explode_dissolve")
-    df = to_file(fill(df), "buffer_simplify_dissolve_fill")
-    df = to_file(dissolve(df), "redissolve")
-    df = to_file(simplify(df, 10), "simplify_10km")
-    df = to_file(simplify(df, 100), "simplify_100km")
+    # only recalculates stages for areas where something changed
+    df = to_file(run_stages_by_id(df, STAGES_BOUNDS), "simplify_100km")
     assert list(df["EN"]) == list(df_bounds["EN"])
     bounds = (
         df.reset_index()[["ID", "EN", "FR", "PRIORITY", "DURATION", "geometry"]].set_index(["ID"]).to_crs(CRS_WGS84)
@@ -1,7 +1,9 @@
+import atexit
 import datetime
 import os
 import shutil
 import time
+from queue import Empty
 
 import numpy as np
 from common import (
@@ -11,26 +13,42 @@ from common import (
     DIR_ZIP,
     FILE_LOCK_PUBLISH,
     FLAG_IGNORE_PERIM_OUTPUTS,
+    FLAG_LAZY_MERGE,
+    FLAG_SPARSE_MERGE,
     FMT_DATE_YMD,
     FORMAT_OUTPUT,
     PUBLISH_AZURE_WAIT_TIME_SECONDS,
+    TMP_SUFFIX,
     ensure_dir,
     force_remove,
     is_newer_than,
+    link_or_copy,
     list_dirs,
     listdir_sorted,
     locks_for,
     logging,
-    zip_folder,
+    update_zip_background,
+    wait_for_zips,
 )
-from gdal_merge_max import gdal_merge_max
-from gis import CRS_COMPARISON, find_invalid_tiffs, project_raster
+from gdal_merge_max import build_max_vrt, gdal_merge_max
+from gis import find_invalid_tiffs, is_on_grid, project_raster_to_grid
+from multiprocess import Process, Queue, Value
 from osgeo import gdal
 from redundancy import call_safe, get_stack
+from sparse import is_sparse, to_sparse_name, write_sparse
 from tqdm_util import keep_trying, pmap, tqdm
 
-from tbd import TMP_SUFFIX
-
+# queue of (dir_output, arguments for publish_all()) for the publishing process
+PUBLISH_QUEUE = None
+# process that keeps publishing whatever is queued, if it's been started
+PUBLISH_PROCESS = None
+# process that started PUBLISH_PROCESS, since children can't use it
+PUBLISH_PID = None
+# how many requests have been queued and how many the publishing process has finished
+PUBLISH_SENT = 0
+PUBLISH_DONE = None
+# how long to wait between checks for queued publishing being done
+PUBLISH_POLL_SLEEP = 1
 
 def publish_all(
     dir_output=None,
@@ -39,6 +57,7 @@ def publish_all(
     force_project=False,
     force_publish=False,
     merge_only=False,
+    lazy=False,
 ):
     dir_output = find_latest_outputs(dir_output)
     # check_copy_interim(dir_output, include_interim)
@@ -48,13 +67,37 @@ def publish_all(
             changed_only=changed_only,
             force=force,
             force_project=force_project,
+            # only need actual rasters when publishing
+            lazy=lazy and merge_only,
         )
+        try:
+            # only reads rasters that changed since last time
+            from zonal import make_zonal_stats
+
+            make_zonal_stats(dir_output)
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            logging.error("Ignoring zonal statistics error")
+            logging.error(get_stack(ex))
         if merge_only:
             logging.info(f"Stopping after merge for {dir_output}")
             return
+        try:
+            # does nothing unless TILE_MAX_ZOOM is set
+            from tiles import make_tiles
+
+            changed = make_tiles(dir_output) or changed
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            logging.error("Ignoring tile error")
+            logging.error(get_stack(ex))
         if changed or force or force_publish:
             import publish_azure
 
+            # don't publish before archive of what's being published is done
+            wait_for_zips()
             publish_azure.upload_dir(dir_output)
             # HACK: might be my imagination, but maybe there's a delay so wait a bit
             time.sleep(PUBLISH_AZURE_WAIT_TIME_SECONDS)
@@ -65,6 +108,113 @@ def publish_all(
             logging.info(f"No changes for {os.path.basename(dir_output)} so not publishing")
 
 
+def run_publish(dir_output, kwargs):
+    try:
+        publish_all(dir_output, **kwargs)
+    except KeyboardInterrupt as ex:
+        raise ex
+    except Exception as ex:
+        logging.error(f"Couldn't publish {dir_output}")
+        logging.error(get_stack(ex))
+
+
+def publish_queued(queue, done):
+    # dir_output -> (arguments for publish_all(), number of requests) that haven't been done yet
+    pending = {}
+    stop = False
+    while pending or not stop:
+        # only block if there's nothing to do already
+        items = [] if pending else [queue.get()]
+        # anything queued while busy gets done in one go
+        while True:
+            try:
+                items.append(queue.get_nowait())
+            except Empty:
+                break
+        for item in items:
+            if item is None:
+                stop = True
+                continue
+            dir_output, kwargs = item
+            prev_kwargs, count = pending.get(dir_output, (None, 0))
+            # anything still waiting gets replaced since this is the latest state, but don't lose a force
+            if prev_kwargs is not None:
+                kwargs["force"] = kwargs["force"] or prev_kwargs["force"]
+            pending[dir_output] = (kwargs, count + 1)
+        if pending:
+            dir_output, (kwargs, count) = pending.popitem()
+            run_publish(dir_output, kwargs)
+            with done.get_lock():
+                done.value += count
+
+
+def start_publish_process():
+    """!
+    Start the process that publishes queued requests if it isn't running
+    @return None
+    """
+    global PUBLISH_QUEUE
+    global PUBLISH_PROCESS
+    global PUBLISH_PID
+    global PUBLISH_SENT
+    global PUBLISH_DONE
+    if PUBLISH_PROCESS is not None and PUBLISH_PID == os.getpid():
+        if PUBLISH_PROCESS.is_alive():
+            return
+        PUBLISH_PROCESS.join()
+        logging.error(f"Publishing ended with exit code {PUBLISH_PROCESS.exitcode}")
+    # NOTE: merging and tiling fork pools, so do it in a process started from here
+    #       instead of a thread that would be forking beside the main loop, and keep
+    #       that process so what it caches and archives in the background carries on
+    PUBLISH_QUEUE = Queue()
+    PUBLISH_SENT = 0
+    PUBLISH_DONE = Value("i", 0)
+    PUBLISH_PID = os.getpid()
+    PUBLISH_PROCESS = Process(target=publish_queued, args=[PUBLISH_QUEUE, PUBLISH_DONE], name="publish")
+    PUBLISH_PROCESS.start()
+
+
+def queue_publish(dir_output=None, force=False, merge_only=False):
+    global PUBLISH_SENT
+    dir_output = find_latest_outputs(dir_output)
+    start_publish_process()
+    # merges while fires are still running only need views, but whatever runs last won't be lazy
+    kwargs = {"changed_only": False, "force": force, "merge_only": merge_only, "lazy": FLAG_LAZY_MERGE}
+    PUBLISH_QUEUE.put((dir_output, kwargs))
+    PUBLISH_SENT += 1
+
+
+def wait_for_publish():
+    """!
+    Wait until everything that was queued has been published
+    @return None
+    """
+    if PUBLISH_PROCESS is None or PUBLISH_PID != os.getpid():
+        return
+    while PUBLISH_DONE.value < PUBLISH_SENT and PUBLISH_PROCESS.is_alive():
+        time.sleep(PUBLISH_POLL_SLEEP)
+
+
+def stop_publish():
+    """!
+    Finish everything that was queued and stop the publishing process
+    @return None
+    """
+    global PUBLISH_PROCESS
+    if PUBLISH_PROCESS is None or PUBLISH_PID != os.getpid():
+        return
+    if PUBLISH_PROCESS.is_alive():
+        PUBLISH_QUEUE.put(None)
+    # exiting also waits for any archives it was updating
+    PUBLISH_PROCESS.join()
+    if 0 != PUBLISH_PROCESS.exitcode:
+        logging.error(f"Publishing ended with exit code {PUBLISH_PROCESS.exitcode}")
+    PUBLISH_PROCESS = None
+
+
+# process isn't a daemon since it needs pools, so it has to be told to stop before exiting
+atexit.register(stop_publish)
+
 def find_latest_outputs(dir_output=None):
     if dir_output is None:
         dir_default = DIR_OUTPUT
@@ -86,6 +236,7 @@ def merge_dirs(
     force=False,
     force_project=False,
     creation_options=CREATION_OPTIONS,
+    lazy=False,
 ):
     any_change = False
     dir_input = find_latest_outputs(dir_input)
@@ -124,24 +275,32 @@ def merge_dirs(
         def reproject(f):
             changed = False
             f_crs = os.path.join(dir_crs, os.path.basename(f))
+            if FLAG_SPARSE_MERGE:
+                f_crs = to_sparse_name(f_crs)
             # don't project if file isn't newer, but keep track of file for merge
             if force_project or is_newer_than(f, f_crs):
+                if is_on_grid(f):
+                    # already projected onto merge grid so don't resample it again
+                    if FLAG_SPARSE_MERGE:
+                        call_safe(write_sparse, f, f_crs)
+                    else:
+                        call_safe(link_or_copy, f, f_crs)
+                    return True, f_crs
                 # FIX: this is super slow for perim tifs
                 #       (because they're the full exz\\V tent of the UTM zone?)
                 # do this to temp directory and then copy so it's faster (?)
                 f_tmp = os.path.join(dir_tmp, os.path.basename(f))
                 force_remove(f_tmp)
-                b = project_raster(
-                    f,
-                    f_tmp,
-                    resolution=100,
-                    nodata=0,
-                    crs=f"EPSG:{CRS_COMPARISON}",
-                )
+                # target aligned so everything in here is on the merge grid
+                b = project_raster_to_grid(f, f_tmp, nodata=0)
                 if b is None:
                     return b
                 force_remove(f_crs)
-                call_safe(shutil.move, f_tmp, f_crs)
+                if FLAG_SPARSE_MERGE:
+                    call_safe(write_sparse, f_tmp, f_crs)
+                    force_remove(f_tmp)
+                else:
+                    call_safe(shutil.move, f_tmp, f_crs)
                 changed = True
             return changed, f_crs
 
@@ -172,8 +331,17 @@ def merge_dirs(
             file_root = os.path.join(f"firestarr_{run_id}_{dir_for_what}_{date_cur.strftime('%Y%m%d')}")
             dir_tmp = ensure_dir(os.path.join(DIR_TMP, dir_merge.replace(dir_parent, "").strip("/")))
 
+            # HACK: VRT can't read sparse files so those always get merged
+            if lazy and not FLAG_SPARSE_MERGE:
+                # view that takes max when read so nothing gets written until publishing
+                file_vrt = os.path.join(ensure_dir(os.path.join(dir_parent, "views")), f"{file_root}.vrt")
+                if not (force or changed or not os.path.isfile(file_vrt)):
+                    return changed, file_vrt
+                return True, build_max_vrt(file_vrt, files_crs, description=description)
             file_tmp = os.path.join(dir_tmp, f"{file_root}_tmp.tif")
             file_base = os.path.join(ensure_dir(dir_merge), f"{file_root}.tif")
+            # inputs could have changed during lazy merges since this was made
+            changed = changed or any(is_newer_than(f, file_base) for f in files_crs)
             # no point in doing this if nothing was added
             if force or changed or not os.path.isfile(file_base):
                 force_remove(file_tmp)
@@ -196,7 +364,7 @@ def merge_dirs(
                 else:
                     # HACK: don't get locks because it takes forever
                     # with locks_for(files_merge):
-                    if 1 == len(files_merge):
+                    if 1 == len(files_merge) and not is_sparse(files_merge[0]):
                         f = files_merge[0]
                         if f == file_tmp:
                             logging.warning(f"Ignoring trying to merge file into iteslf: {f}")
@@ -273,13 +441,17 @@ def merge_dirs(
         #     changed, file_base = merge_files(all_files, dir_combined, verbose=True)
 
         any_change = any_change or changed
+    if lazy:
+        logging.info("Views of merge are in %s", os.path.join(dir_parent, "views"))
+        return any_change
     logging.info("Final results of merge are in %s", dir_combined)
     try:
         run_id = os.path.basename(dir_input)
         file_zip = os.path.join(DIR_ZIP, f"{run_name}.zip")
         if any_change or not os.path.isfile(file_zip):
-            logging.info("Creating archive %s", file_zip)
-            zip_folder(file_zip, dir_combined)
+            # only redoes what changed and doesn't hold up next merge
+            logging.info("Updating archive %s", file_zip)
+            update_zip_background(file_zip, dir_combined)
     except KeyboardInterrupt as ex:
         raise ex
     except Exception as ex:
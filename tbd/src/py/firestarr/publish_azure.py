@@ -1,10 +1,13 @@
 import datetime
+import hashlib
 import os
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
-from azure.storage.blob import BlobServiceClient, ExponentialRetry
+from azure.storage.blob import BlobServiceClient, ContentSettings, ExponentialRetry
 from common import (
     CONFIG,
     DIR_OUTPUT,
@@ -17,10 +20,25 @@ from common import (
     listdir_sorted,
     logging,
 )
+from tiles import TILE_EXTENSIONS
 
 AZURE_URL = None
 AZURE_TOKEN = None
 AZURE_CONTAINER = None
+# use this instead of connecting if set (like publish_azure_local.LocalContainerClient)
+CONTAINER = None
+# how many files to push at once
+PUBLISH_THREADS = 8
+# how many blocks of each file to push at once
+BLOB_BLOCK_THREADS = 4
+# metadata key for hash of contents so unchanged files don't get pushed again
+KEY_MD5 = "content_md5"
+# path -> (mtime, size, md5) so files are only read once
+FILE_MD5 = {}
+# how often to check on copies that are still going
+COPY_POLL_SLEEP = 1
+# how long to wait for a copy before uploading instead
+COPY_MAX_WAIT = 300
 
 
 def get_token():
@@ -43,6 +61,8 @@ def read_config():
     except ValueError as ex:
         logging.error(ex)
         logging.warning("Unable to read azure config")
+    if CONTAINER is not None:
+        return True
     return np.all(bool(x) for x in [AZURE_URL, AZURE_TOKEN, AZURE_CONTAINER])
 
 
@@ -51,7 +71,15 @@ def get_blob_service_client():
     return BlobServiceClient(account_url=AZURE_URL, credential=AZURE_TOKEN, retry_policy=retry)
 
 
+def set_container(container):
+    global CONTAINER
+    CONTAINER = container
+    return CONTAINER
+
+
 def get_container():
+    if CONTAINER is not None:
+        return CONTAINER
     logging.info("Getting container")
     blob_service_client = get_blob_service_client()
     container = blob_service_client.get_container_client(AZURE_CONTAINER)
@@ -65,6 +93,41 @@ def show_blobs(container):
         print(f"{container.container_name}: {blob.name}")
 
 
+def find_md5(path):
+    stat = os.stat(path)
+    cached = FILE_MD5.get(path, None)
+    if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+        h = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        cached = (stat.st_mtime_ns, stat.st_size, h.hexdigest())
+        FILE_MD5[path] = cached
+    return cached[2]
+
+
+def forget_md5(keep):
+    # only keep what's still being published so this doesn't grow with every run
+    for path in set(FILE_MD5.keys()).difference(keep):
+        del FILE_MD5[path]
+
+
+def run_parallel(fct, values):
+    # NOTE: just waiting on network so threads are fine
+    with ThreadPoolExecutor(max_workers=PUBLISH_THREADS) as pool:
+        return list(pool.map(fct, values))
+
+
+def find_tile_files(dir_tiles):
+    files = []
+    for root, _, names in os.walk(dir_tiles):
+        for name in names:
+            # ignore manifests and anything still being written
+            if os.path.splitext(name)[1][1:] in TILE_EXTENSIONS.values():
+                files.append(os.path.relpath(os.path.join(root, name), dir_tiles))
+    return sorted(files)
+
+
 def find_latest():
     zips = [x for x in listdir_sorted(DIR_ZIP) if x.endswith(".zip")]
     return os.path.join(DIR_OUTPUT, os.path.splitext(zips[-1])[0])
@@ -143,46 +206,112 @@ def upload_dir(dir_run=None):
     file_root = "df_fires_prioritized"
     files_group = [x for x in listdir_sorted(dir_sim_data) if x.startswith(f"{file_root}.")]
 
-    delete_after = []
+    existing = {}
 
-    def add_delete(match_start):
-        nonlocal delete_after
-        blob_list = [x for x in container.list_blobs(name_starts_with=match_start)]
-        delete_after += blob_list
-
-    def upload(path, name):
-        nonlocal delete_after
-        logging.info(f"Pushing {name}")
-        with open(path, "rb") as data:
-            container.upload_blob(name=name, data=data, metadata=metadata, overwrite=True)
-        # remove from list of files to delete if overwritten
-        delete_after = [x for x in delete_after if x.name != name]
+    def add_existing(match_start):
+        blob_list = container.list_blobs(name_starts_with=match_start, include=["metadata"])
+        existing.update({x.name: x for x in blob_list})
 
     # get old blobs for delete after
     logging.info("Finding current blobs")
-    add_delete(f"{dir_shp}/{file_root}")
-    add_delete("current/firestarr")
+    add_existing(f"{dir_shp}/{file_root}")
+    add_existing("current/firestarr")
+    add_existing("current/tiles/")
+    delete_after = set(existing.keys())
+    # don't delete archive but don't want to copy it again either
+    add_existing(f"archive/{run_id}/")
+
+    def is_unchanged(name, metadata):
+        blob = existing.get(name, None)
+        if blob is None or (blob.metadata or {}).get(KEY_MD5, None) != metadata[KEY_MD5]:
+            return False
+        if blob.metadata != metadata:
+            # same contents so just need new run information
+            container.get_blob_client(name).set_blob_metadata(metadata)
+        logging.debug(f"Not pushing unchanged {name}")
+        return True
+
+    paths = set()
+
+    def upload(path, name, metadata, content_settings=None):
+        paths.add(path)
+        metadata = {**metadata, KEY_MD5: find_md5(path)}
+        if not is_unchanged(name, metadata):
+            logging.info(f"Pushing {name}")
+            with open(path, "rb") as data:
+                container.upload_blob(
+                    name=name,
+                    data=data,
+                    metadata=metadata,
+                    overwrite=True,
+                    max_concurrency=BLOB_BLOCK_THREADS,
+                    content_settings=content_settings,
+                )
+        return metadata
 
-    for f in files_group:
-        upload(os.path.join(dir_sim_data, f), f"{dir_shp}/{f}")
+    def copy(name_from, name, metadata, path):
+        if is_unchanged(name, metadata):
+            return
+        logging.info(f"Copying {name_from} to {name}")
+        blob = container.get_blob_client(name)
+        status = None
+        try:
+            result = blob.start_copy_from_url(
+                container.get_blob_client(name_from).url,
+                metadata=metadata,
+            )
+            status = result.get("copy_status", None)
+            # NOTE: copy keeps going on the server after this returns so wait for it
+            t0 = time.time()
+            while "pending" == status and (time.time() - t0) < COPY_MAX_WAIT:
+                time.sleep(COPY_POLL_SLEEP)
+                status = blob.get_blob_properties().copy.status
+            if "pending" == status:
+                blob.abort_copy(result["copy_id"])
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            logging.warning(f"Error copying {name_from} to {name}: {ex}")
+        if "success" != status:
+            logging.warning(f"Copying {name_from} to {name} ended with status {status} so uploading instead")
+            upload(path, name, metadata)
 
-    for f in files:
+    def publish_file(f):
         if "perim.tif" == f:
             for_date = origin
         else:
             for_date = origin + datetime.timedelta(days=(days[f] - 1))
-        metadata["for_date"] = for_date.strftime(FMT_DATE_YMD)
         path = os.path.join(dir_combined, f)
-        # HACK: just upload into archive too so we don't have to move later
-        upload(path, f"current/{f}")
-        # FIX: copy from container link instead of uploading multiple times
-        # upload into folder for this run, but don't keep multiple versions
-        upload(path, f"archive/{run_id}/{f}")
+        name = f"current/{f}"
+        metadata_file = upload(path, name, {**metadata, "for_date": for_date.strftime(FMT_DATE_YMD)})
+        # copy on server into folder for this run instead of uploading again
+        copy(name, f"archive/{run_id}/{f}", metadata_file, path)
+        return name
+
+    dir_tiles = os.path.join(dir_run, "tiles")
+    files_tiles = find_tile_files(dir_tiles) if os.path.isdir(dir_tiles) else []
+
+    def publish_tile(f):
+        name = f"current/tiles/{f}"
+        # NOTE: no run information on tiles so unchanged ones don't need any calls at all
+        upload(
+            os.path.join(dir_tiles, f),
+            name,
+            {},
+            ContentSettings(content_type=f"image/{os.path.splitext(f)[1][1:]}"),
+        )
+        return name
+
+    run_parallel(lambda f: upload(os.path.join(dir_sim_data, f), f"{dir_shp}/{f}", metadata), files_group)
+    published = (
+        [f"{dir_shp}/{f}" for f in files_group] + run_parallel(publish_file, files) + run_parallel(publish_tile, files_tiles)
+    )
 
+    forget_md5(paths)
     # delete old blobs that weren't overwritten
-    for f in delete_after:
-        logging.info(f"Removing {f.name}")
-        container.delete_blob(f)
+    for name in sorted(delete_after.difference(published)):
+        logging.info(f"Removing {name}")
+        container.delete_blob(name)
 
 
 if "__main__" == __name__:
@@ -0,0 +1,133 @@
+"""
+Local stand-in for azure.storage.blob.ContainerClient
+
+Keeps blobs as files under a directory so publishing can be run and checked
+without a storage account. Only covers what publish_azure.py uses. Calls and
+bytes uploaded are counted so it's easy to see what a publish cost.
+
+    import publish_azure
+    from publish_azure_local import LocalContainerClient
+    publish_azure.set_container(LocalContainerClient("/appl/data/tmp/blobs"))
+"""
+
+import datetime
+import os
+import shutil
+import threading
+import types
+from collections import Counter
+
+from common import ensure_dir
+
+PREFIX_URL = "local://"
+
+
+class LocalBlobClient:
+    def __init__(self, container, name):
+        self._container = container
+        self.blob_name = name
+        self.url = f"{PREFIX_URL}{container.container_name}/{name}"
+
+    def get_blob_properties(self, *args, **kwargs):
+        self._container.call("get_blob_properties")
+        return self._container.find_blob(self.blob_name)
+
+    def set_blob_metadata(self, metadata=None, *args, **kwargs):
+        self._container.call("set_blob_metadata")
+        with self._container.lock:
+            self._container.find_blob(self.blob_name).metadata = dict(metadata or {})
+
+    def start_copy_from_url(self, source_url, metadata=None, *args, **kwargs):
+        self._container.call("start_copy_from_url")
+        prefix = f"{PREFIX_URL}{self._container.container_name}/"
+        if not source_url.startswith(prefix):
+            raise RuntimeError(f"Can only copy within {self._container.container_name}: {source_url}")
+        source = self._container.find_blob(source_url[len(prefix) :])
+        with self._container.lock:
+            shutil.copyfile(self._container.find_path(source.name), self._container.find_path(self.blob_name))
+            self._container.set_blob(
+                self.blob_name,
+                source.size,
+                dict(source.metadata if metadata is None else metadata),
+                copy_status="success",
+            )
+        return {"copy_status": "success", "copy_id": f"{source.name}->{self.blob_name}"}
+
+    def abort_copy(self, copy_id, *args, **kwargs):
+        self._container.call("abort_copy")
+        # copies finish right away so there's never anything to abort
+        raise RuntimeError(f"No pending copy {copy_id} for {self.blob_name}")
+
+
+class LocalContainerClient:
+    """!
+    Container that keeps blobs as files
+    @param root Directory to keep blobs in
+    @param container_name Name to use for container
+    """
+
+    def __init__(self, root, container_name="local"):
+        self.root = ensure_dir(root)
+        self.container_name = container_name
+        self.lock = threading.RLock()
+        self.calls = Counter()
+        self.bytes_uploaded = 0
+        self.blobs = {}
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def find_path(self, name):
+        path = os.path.join(self.root, name)
+        ensure_dir(os.path.dirname(path))
+        return path
+
+    def find_blob(self, name):
+        with self.lock:
+            blob = self.blobs.get(name, None)
+        if blob is None:
+            raise FileNotFoundError(f"Blob not found: {name}")
+        return blob
+
+    def set_blob(self, name, size, metadata, copy_status=None):
+        self.blobs[name] = types.SimpleNamespace(
+            name=name,
+            size=size,
+            metadata=metadata,
+            last_modified=datetime.datetime.now(datetime.timezone.utc),
+            copy=types.SimpleNamespace(status=copy_status),
+        )
+
+    def list_blobs(self, name_starts_with=None, include=None, *args, **kwargs):
+        self.call("list_blobs")
+        with self.lock:
+            return [
+                types.SimpleNamespace(**{**vars(b), "metadata": dict(b.metadata)})
+                for k, b in sorted(self.blobs.items())
+                if name_starts_with is None or k.startswith(name_starts_with)
+            ]
+
+    def upload_blob(self, name, data, metadata=None, overwrite=False, *args, **kwargs):
+        self.call("upload_blob")
+        with self.lock:
+            if not overwrite and name in self.blobs:
+                raise FileExistsError(f"Blob already exists: {name}")
+        content = data.read() if hasattr(data, "read") else data
+        with self.lock:
+            with open(self.find_path(name), "wb") as f:
+                f.write(content)
+            self.set_blob(name, len(content), dict(metadata or {}))
+            self.bytes_uploaded += len(content)
+        return self.get_blob_client(name)
+
+    def delete_blob(self, blob, *args, **kwargs):
+        self.call("delete_blob")
+        name = getattr(blob, "name", blob)
+        with self.lock:
+            self.find_blob(name)
+            del self.blobs[name]
+            os.remove(self.find_path(name))
+
+    def get_blob_client(self, blob, *args, **kwargs):
+        return LocalBlobClient(self, getattr(blob, "name", blob))
@@ -37,6 +37,7 @@ from common import (
     logging,
     read_json_safe,
     try_remove,
+    wait_for_zips,
 )
 from datasources.cwfis import FLAG_DEBUG_PERIMETERS
 from datasources.datatypes import SourceFire
@@ -48,6 +49,7 @@ from gis import (
     CRS_SIMINPUT,
     CRS_WGS84,
     area_ha,
+    find_bounds_index,
     find_invalid_tiffs,
     gdf_from_file,
     gdf_to_file,
@@ -55,8 +57,9 @@ from gis import (
     vector_path,
 )
 from log import LOGGER_NAME, add_log_file
-from publish import merge_dirs, publish_all
+from publish import merge_dirs, publish_all, queue_publish, wait_for_publish
 from redundancy import call_safe, get_stack
+from shapely import STRtree
 from simulation import Simulation
 from tqdm_util import (
     apply,
@@ -75,10 +78,10 @@ from tbd import (
     check_running,
     copy_fire_outputs,
     finish_job,
+    finish_tasks,
     get_job_id,
     get_simulation_file,
-    get_simulation_task,
-    schedule_tasks,
+    submit_tasks,
 )
 
 LOGGER_FIRE_ORDER = logging.getLogger(f"{LOGGER_NAME}_order.log")
@@ -294,6 +297,8 @@ class Run(object):
     ):
         if no_publish is None:
             no_publish = not self.check_do_publish()
+        # don't publish at the same time as anything queued
+        wait_for_publish()
 
         df_fires = self.load_fires()
 
@@ -497,6 +502,8 @@ class Run(object):
                 if not was_running:
                     # publish didn't work, but nothing is running, so retry running?
                     logging.error("Changes found when publishing, but nothing running so retry")
+        # archives are updated in the background so make sure they're done before saying run is
+        wait_for_zips()
         self.save_rundata()
         logging.info(f"Finished simulation for {self._id}")
 
@@ -578,6 +585,17 @@ class Run(object):
 
         list_rows = list(zip(*list(df_fires.reset_index().iterrows())))[1]
         logging.info(f"Setting up simulation inputs for {len(df_fires)} groups")
+        try:
+            self._simulation.assign_sources(df_fires)
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            # sources still get found for each fire as it's prepared if this fails
+            logging.warning("Couldn't assign sources for all groups at once")
+            logging.warning(get_stack(ex))
+        # look up timezones before workers start so they all inherit them
+        utcoffsets = self._simulation.find_utcoffset_hours(df_fires)
+        logging.info(f"Groups have UTC offsets of {sorted(np.unique(utcoffsets.dropna()))}")
         # for row_fire in tqdm(list_rows):
         #     do_fire(row_fire)
         files_sim = keep_trying(
@@ -606,13 +624,22 @@ class Run(object):
     @log_order(show_args=False)
     def prioritize(self, df_fires, df_bounds=None):
         df = df_fires.loc[:]
+        tree = None
         if df_bounds is None:
             file_bounds = BOUNDS["bounds"]
             if file_bounds:
-                df_bounds = gdf_from_file(file_bounds).to_crs(df.crs)
+                df_bounds, tree = find_bounds_index(file_bounds, df.crs)
+        elif 0 < len(df_bounds):
+            df_bounds = df_bounds.to_crs(df.crs).reset_index(drop=True)
+            tree = STRtree(np.array(df_bounds.geometry))
         df[["ID", "PRIORITY", "DURATION"]] = "", 0, self._max_days
         if df_bounds is not None:
-            df_join = df[["geometry"]].sjoin(df_bounds)
+            # same as sjoin() but reuses the index of bounds
+            idx_fires, idx_bounds = (
+                tree.query(np.array(df.geometry), predicate="intersects") if tree is not None else ([], [])
+            )
+            df_join = df_bounds.drop(columns=["geometry"]).iloc[idx_bounds]
+            df_join.index = df.index[idx_fires]
             # only keep fires that are in bounds
             df = df.loc[np.unique(df_join.index)]
             if "PRIORITY" in df_join.columns:
@@ -780,15 +807,15 @@ class Run(object):
                         logging.info(
                             "Total of {} fires took {}s - average time is {:0.1f}s".format(n, sim_time, sim_time / n)
                         )
-                        # FIX: why is this forcing and not changed_only?
-                        publish_all(
+                        # NOTE: publish happens in its own process so results keep getting handled
+                        #       and anything queued while it's busy gets done in one go after
+                        queue_publish(
                             self._dir_output,
-                            changed_only=False,
                             force=any_change,
                             merge_only=not self.check_do_publish(),
                         )
                         logging.info(
-                            f"Done {'publishing' if self.check_do_publish() else 'merging'} directories for {g}"
+                            f"Queued {'publishing' if self.check_do_publish() else 'merging'} directories for {g}"
                         )
                     # just updated so not changed anymore
                     changed = False
@@ -842,21 +869,17 @@ class Run(object):
 
         if self._is_batch:
             dirs_fire = [os.path.join(self._dir_sims, x) for x in itertools.chain.from_iterable(dirs_sim.values())]
-            # make one list of tasks and submit it
-            tasks_existed = apply(
-                dirs_fire,
-                get_simulation_task,
-                desc="Creating simulation taks",
-            )
-            tasks_new = [x[0] for x in tasks_existed if not x[1]]
-            # HACK: use any dir_fire for now since they should all work
-            schedule_tasks(dirs_fire[0], tasks_new)
-            successful, unsuccessful = keep_trying_groups(
-                fct=run_fire,
-                values=successful,
-                desc="Running simulations via azurebatch",
-                callback_group=check_publish,
-            )
+            # diff against what's already there and submit everything at once
+            submit_tasks(dirs_fire)
+            try:
+                successful, unsuccessful = keep_trying_groups(
+                    fct=run_fire,
+                    values=successful,
+                    desc="Running simulations via azurebatch",
+                    callback_group=check_publish,
+                )
+            finally:
+                finish_tasks()
         else:
             successful, unsuccessful = keep_trying_groups(
                 fct=run_fire,
@@ -864,6 +887,8 @@ class Run(object):
                 desc="Running simulations",
                 callback_group=check_publish,
             )
+        # anything that was queued needs to be done before the outputs are used
+        wait_for_publish()
         # return all_results, list(all_dates), total_time
         t1 = timeit.default_timer()
         total_time = t1 - t0
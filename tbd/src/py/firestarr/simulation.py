@@ -1,5 +1,6 @@
 import datetime
 import os
+from functools import cache
 
 import numpy as np
 import pandas as pd
@@ -33,6 +34,53 @@ from timezonefinder import TimezoneFinder
 from tbd import get_simulation_file
 
 MAXIMUM_STATION_DISTANCE = 100 * KM_TO_M
+# decimal places to round coordinates to when looking up timezones (~100m)
+TIMEZONE_PRECISION = 3
+# loading timezone polygons is slow so only do it once per process
+TIMEZONE_FINDER = None
+
+
+def get_timezone_finder():
+    global TIMEZONE_FINDER
+    if TIMEZONE_FINDER is None:
+        TIMEZONE_FINDER = TimezoneFinder()
+    return TIMEZONE_FINDER
+
+
+@cache
+def _find_timezone_name(lat, lon):
+    return get_timezone_finder().timezone_at(lng=lon, lat=lat)
+
+
+def find_timezone_name(lat, lon):
+    return _find_timezone_name(round(float(lat), TIMEZONE_PRECISION), round(float(lon), TIMEZONE_PRECISION))
+
+
+@cache
+def find_lst_offset(tz_name, date_origin):
+    tz_original = pytz.timezone(tz_name)
+    # figure out what timezone offset is for origin date
+    # CHECK: what happens if we go over daylight savings time date?
+    #        nothing I think? We're finding offset for LST here
+    date_origin = pd.to_datetime(date_origin)
+    return date_origin - (
+        (date_origin + tz_original.dst(date_origin)).tz_localize(tz_original).tz_convert("UTC").tz_localize(None)
+    )
+
+
+def find_utcoffset_hours(lats, lons, date_origin):
+    # only look up each timezone once no matter how many fires are in it
+    def find_offset(lat, lon):
+        try:
+            return find_lst_offset(find_timezone_name(lat, lon), date_origin).total_seconds() / SECONDS_PER_HOUR
+        except KeyboardInterrupt as ex:
+            raise ex
+        except Exception as ex:
+            # NOTE: leave it to prepare() to fail for just this fire
+            logging.warning(f"Couldn't find UTC offset for ({lat}, {lon}): {ex}")
+            return np.nan
+
+    return np.array([find_offset(lat, lon) for lat, lon in zip(lats, lons)])
 
 
 def save_wx_input(df_wx, file_wx):
@@ -77,6 +125,17 @@ class Simulation(object):
         self._src_models = SourceModelAll(self._dir_out)
         self._src_hourly = SourceHourlyBest(self._dir_out)
 
+    def assign_sources(self, df_fires):
+        # figure out sources for everything at once instead of as each fire is prepared
+        for src in [self._src_fwi, self._src_hourly]:
+            src.assign_sources(df_fires["lat"], df_fires["lon"])
+
+    def find_utcoffset_hours(self, df_fires):
+        return pd.Series(
+            find_utcoffset_hours(df_fires["lat"], df_fires["lon"], self._origin.today),
+            index=df_fires.index,
+        )
+
     def prepare(self, df_fire):
         if len(df_fire) > 1:
             raise RuntimeError("Expected exactly one row")
@@ -102,18 +161,7 @@ class Simulation(object):
             max_days = row_fire["DURATION"]
             lat = row_fire["lat"]
             lon = row_fire["lon"]
-            tf = TimezoneFinder()
-            tz_original = pytz.timezone(tf.timezone_at(lng=lon, lat=lat))
-            # figure out what timezone offset is for origin date
-            # CHECK: what happens if we go over daylight savings time date?
-            #        nothing I think? We're finding offset for LST here
-            date_origin = pd.to_datetime(self._origin.today)
-            utcoffset = date_origin - (
-                (date_origin + tz_original.dst(date_origin))
-                .tz_localize(tz_original)
-                .tz_convert("UTC")
-                .tz_localize(None)
-            )
+            utcoffset = find_lst_offset(find_timezone_name(lat, lon), self._origin.today)
             utcoffset_hours = utcoffset.total_seconds() / SECONDS_PER_HOUR
             # do this instead of using utcoffset() so we know it's LST
             tz_lst = tz_from_offset(utcoffset)
@@ -0,0 +1,132 @@
+"""
+Sparse storage for per-fire probability rasters
+
+Per-fire outputs are mostly empty, so this keeps just the cells with data as
+row, column and value arrays (COO) for the window around them, along with
+what's needed to put them back on the grid. Rows are in order so any strip
+of rows can be found without looking at the rest.
+"""
+
+import os
+
+import numpy as np
+from gis import find_data_mask, find_data_window, iter_blocks
+from osgeo import gdal
+
+SPARSE_EXTENSION = ".npz"
+# path -> (mtime, SparseRaster) so each process only loads rasters once
+SPARSE_SOURCES = {}
+# most rasters to keep loaded at once
+SPARSE_SOURCES_MAX = 256
+
+
+def is_sparse(filename):
+    return filename.endswith(SPARSE_EXTENSION)
+
+
+def to_sparse_name(filename):
+    return os.path.splitext(filename)[0] + SPARSE_EXTENSION
+
+
+def write_sparse(file_raster, file_sparse=None):
+    """!
+    Save the cells with data in a raster
+    @param file_raster Single band raster to read
+    @param file_sparse File to save to (None to put it beside raster)
+    @return Path that sparse raster was saved to
+    """
+    if file_sparse is None:
+        file_sparse = to_sparse_name(file_raster)
+    src = gdal.Open(file_raster)
+    try:
+        if 1 != src.RasterCount:
+            raise RuntimeError(f"Can only store single band rasters as sparse: {file_raster}")
+        band = src.GetRasterBand(1)
+        nodata = band.GetNoDataValue()
+        gt = src.GetGeoTransform()
+        # keep a single cell if there's nothing so there's still something to merge
+        xoff, yoff, xsize, ysize = find_data_window(band) or (0, 0, 1, 1)
+        rows, cols, values = [], [], []
+        # only read window that has data in it
+        for x, y, data in iter_blocks(band, window=(xoff, yoff, xsize, ysize)):
+            mask = find_data_mask(data, nodata)
+            r, c = np.nonzero(mask)
+            rows.append(r + y)
+            cols.append(c + x)
+            values.append(data[mask])
+        rows = np.concatenate(rows).astype(np.int32)
+        cols = np.concatenate(cols).astype(np.int32)
+        values = np.concatenate(values)
+        # blocks go across before down so put back in row order
+        order = np.argsort(rows.astype(np.int64) * xsize + cols, kind="stable")
+        file_tmp = f"{file_sparse}.tmp"
+        # NOTE: write to file object since savez would add an extension to the name
+        with open(file_tmp, "wb") as f:
+            np.savez_compressed(
+                f,
+                rows=rows[order],
+                cols=cols[order],
+                values=values[order],
+                shape=np.array([ysize, xsize]),
+                geotransform=np.array([gt[0] + xoff * gt[1], gt[1], gt[2], gt[3] + yoff * gt[5], gt[4], gt[5]]),
+                projection=np.array(src.GetProjection()),
+                nodata=np.array(np.nan if nodata is None else nodata, dtype=np.float64),
+                band_type=np.array(band.DataType),
+            )
+        os.replace(file_tmp, file_sparse)
+        return file_sparse
+    finally:
+        src = None
+
+
+def open_sparse(filename):
+    """!
+    Load sparse raster, reusing it if it's already loaded and hasn't changed
+    @param filename Sparse raster to load
+    @return SparseRaster for file
+    """
+    mtime = os.path.getmtime(filename)
+    cached = SPARSE_SOURCES.pop(filename, None)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, SparseRaster(filename))
+    # most recently used goes at the end so oldest get dropped first
+    SPARSE_SOURCES[filename] = cached
+    while len(SPARSE_SOURCES) > SPARSE_SOURCES_MAX:
+        del SPARSE_SOURCES[next(iter(SPARSE_SOURCES))]
+    return cached[1]
+
+
+class SparseRaster(object):
+    """!
+    Cells with data from a raster written by write_sparse()
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with np.load(filename) as data:
+            self.rows = data["rows"]
+            self.cols = data["cols"]
+            self.values = data["values"]
+            self.ysize, self.xsize = (int(x) for x in data["shape"])
+            self.geotransform = tuple(float(x) for x in data["geotransform"])
+            self.projection = str(data["projection"])
+            nodata = float(data["nodata"])
+            self.nodata = None if np.isnan(nodata) else nodata
+            self.band_type = int(data["band_type"])
+
+    def read_rows(self, row_start, row_end):
+        """!
+        Find cells with data in a strip of rows
+        @param row_start First row to include
+        @param row_end Row to stop before
+        @return Tuple of rows, columns and values for cells with data
+        """
+        i0, i1 = np.searchsorted(self.rows, [row_start, row_end])
+        return self.rows[i0:i1], self.cols[i0:i1], self.values[i0:i1]
+
+    def to_array(self, fill=None):
+        if fill is None:
+            fill = np.nan if self.nodata is None else self.nodata
+        result = np.full((self.ysize, self.xsize), fill, dtype=self.values.dtype)
+        result[self.rows, self.cols] = self.values
+        return result
@@ -17,9 +17,9 @@ from azurebatch import (
     is_running_on_azure,
     list_nodes,
     make_or_get_job,
-    make_or_get_simulation_task,
-    schedule_job_tasks,
+    submit_simulation_tasks,
 )
+from autoscale import restore_autoscale, scale_for_tasks
 from common import (
     CONFIG,
     DIR_DATA,
@@ -29,15 +29,21 @@ from common import (
     DIR_TMP,
     FILE_SIM_LOG,
     FLAG_IGNORE_PERIM_OUTPUTS,
+    FLAG_SINGLE_WARP,
     FMT_FILE_SECOND,
+    PERIMETER_RASTER_BUFFER_M,
     SECONDS_PER_HOUR,
     SUBDIR_CURRENT,
+    TMP_SUFFIX,
     WANT_DATES,
     ensure_dir,
+    file_signature,
     force_remove,
     get_stack,
     in_run_folder,
     is_newer_than,
+    is_write_complete,
+    link_or_copy,
     listdir_sorted,
     locks_for,
     logging,
@@ -52,6 +58,7 @@ from gis import (
     gdf_from_file,
     is_invalid_tiff,
     project_raster,
+    project_raster_to_grid,
     save_geojson,
     save_point_file,
 )
@@ -60,7 +67,6 @@ from gis import (
 NO_INTENSITY = "--no-intensity"
 # NO_INTENSITY = ""
 
-TMP_SUFFIX = "__tmp__"
 # tasks that have this in their logs are considered successful
 SUCCESS_TEXT = "Total simulation time was"
 
@@ -135,13 +141,18 @@ def find_running_batch(dir_fire):
             pass
 
 
-def get_simulation_task(dir_fire):
-    return make_or_get_simulation_task(assign_job(dir_fire), dir_fire)
+def submit_tasks(dirs_fire):
+    # HACK: use any dir_fire for now since they should all work
+    job_id = assign_job(dirs_fire[0])
+    task_ids = submit_simulation_tasks(job_id, dirs_fire)
+    # does nothing unless AUTOSCALE_DEADLINE_MINUTES is set
+    scale_for_tasks(job_id, dirs_fire)
+    return task_ids
 
 
-def schedule_tasks(dir_fire, tasks):
-    # HACK: use any dir_fire for now since they should all work
-    schedule_job_tasks(assign_job(dir_fire), tasks)
+def finish_tasks():
+    # pool shouldn't stay sized for a job that's done
+    restore_autoscale()
 
 
 def get_nodes():
@@ -262,6 +273,35 @@ def find_outputs(dir_fire):
     return files_prob, files_interim, files_perim
 
 
+def stage_interim_output(f_interim, f_staged):
+    # don't read the whole raster to figure out if it's done being written
+    if not is_write_complete(f_interim, TIFF_SLEEP):
+        raise RuntimeError(f"Tiff still being written {f_interim}")
+    sig = file_signature(f_interim)
+    # reflinks and copies keep mtime and hardlinks are the same file so this means nothing changed
+    if sig == file_signature(f_staged):
+        return f_staged
+    link_or_copy(f_interim, f_staged)
+    if is_invalid_tiff(f_staged, test_read=True):
+        raise RuntimeError(f"Invalid tiff after staging {f_interim} as {f_staged}")
+    if sig != file_signature(f_interim):
+        raise RuntimeError(f"Tiff changed while staging {f_interim}")
+    return f_staged
+
+
+def stage_interim_outputs(files_interim, dir_tmp_fire):
+    # only snapshot the interim probability rasters and not the whole simulation folder
+    ensure_dir(dir_tmp_fire)
+    files_staged = []
+    for f_interim in files_interim:
+        f_staged = os.path.join(dir_tmp_fire, os.path.basename(f_interim).replace("interim_", ""))
+        files_staged.append(call_safe(stage_interim_output, f_interim, f_staged))
+    # remove anything that isn't from the current set of interim outputs
+    names_staged = [os.path.basename(x) for x in files_staged]
+    force_remove([os.path.join(dir_tmp_fire, x) for x in listdir_sorted(dir_tmp_fire) if x not in names_staged])
+    return files_staged
+
+
 def copy_fire_outputs(dir_fire, dir_output, changed):
     # simulation was done or is now, but outputs don't exist
     logging.debug(f"Collecting outputs from {dir_fire}")
@@ -294,44 +334,7 @@ def copy_fire_outputs(dir_fire, dir_output, changed):
         force_remove(dir_tmp_fire)
     if files_interim and not files_prob:
         logging.debug(f"Using interim rasters for {dir_fire}")
-        # FIX: look at timestamps instead of always copying
-        force_remove(dir_tmp_fire)
-        call_safe(shutil.copytree, dir_fire, dir_tmp_fire, dirs_exist_ok=True)
-        # double check that outputs weren't created while copying
-        probs_tmp, interim_tmp, files_perim = find_outputs(dir_tmp_fire)
-
-        # HACK: since we already avoided files_prob if they were out of date then never worry about probs_tmp
-        def check_valid(f_interim):
-            f_tmp = f_interim.replace("interim_", "")
-            if is_invalid_tiff(f_interim, test_read=True):
-                force_remove(f_interim)
-                # try copying from original again to see if that helps
-                f_orig = f_interim.replace(dir_tmp_fire, dir_fire)
-                if is_invalid_tiff(f_orig, test_read=True):
-                    logging.warning(f"Sleeping for {TIFF_SLEEP}s in case {f_orig} is being written to")
-                    time.sleep(TIFF_SLEEP)
-                    if is_invalid_tiff(f_orig, test_read=True):
-                        raise RuntimeError(f"Invalid tiff {f_orig}")
-                logging.warning(f"Trying to copy {f_orig} again since invalid")
-                # don't try this if the original is invalid but try copying again if it was
-                shutil.copyfile(
-                    f_orig,
-                    f_interim,
-                )
-                if is_invalid_tiff(f_interim, test_read=True):
-                    raise RuntimeError(f"Invalid tiff after copy {f_interim}")
-            # at this point f_interim is valid but needs to be renamed
-            shutil.move(f_interim, f_tmp)
-            if is_invalid_tiff(f_tmp, test_read=True):
-                raise RuntimeError(f"Invalid tiff after rename to {f_tmp}")
-
-        for f_interim in interim_tmp:
-            # HACK: maybe overkill to nest but try copying original again in case it was being written to
-            call_safe(check_valid, f_interim)
-        probs_tmp, interim_tmp, files_perim = find_outputs(dir_tmp_fire)
-        if interim_tmp:
-            raise RuntimeError("Expected files to be renamed")
-        files_prob = probs_tmp
+        files_prob = stage_interim_outputs(files_interim, dir_tmp_fire)
         for f in files_prob:
             files_changed[f] = True
         # # force copying because not sure when interim is from
@@ -370,13 +373,18 @@ def copy_fire_outputs(dir_fire, dir_output, changed):
             # using previous extent is limiting later days
             if "perim" not in file_src:
                 extent = None
-            extent = project_raster(
-                file_src,
-                file_out,
-                outputBounds=extent,
-                # HACK: if nodata is none then 0's should just show up as 0?
-                nodata=None,
-            )
+            if FLAG_SINGLE_WARP:
+                # merge uses these as is, so anything in EPSG:4326 needs to come from the merged outputs
+                # NOTE: 0 is nodata like merge always reprojected with, so combined outputs don't change
+                extent = project_raster_to_grid(file_src, file_out, nodata=0)
+            else:
+                extent = project_raster(
+                    file_src,
+                    file_out,
+                    outputBounds=extent,
+                    # HACK: if nodata is none then 0's should just show up as 0?
+                    nodata=None,
+                )
             if extent is None:
                 raise RuntimeError(f"Fire {dir_fire} has invalid output file {file_src}")
             # if file didn't exist then it's changed now
@@ -483,7 +491,7 @@ def _run_fire_from_folder(
                     with locks_for(raster):
                         # FIX: if we never use points then the sims don't guarantee
                         # running from non-fuel for the points like normally
-                        perim = Rasterize(file_sim, raster, reference)
+                        perim = Rasterize(file_sim, raster, reference, buffer=PERIMETER_RASTER_BUFFER_M)
                 else:
                     perim = None
                 # NOTE: save point file either way so we can see where it is
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules import each other by name, so tests need the same path as running them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
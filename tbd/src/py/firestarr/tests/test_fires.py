@@ -0,0 +1,25 @@
+import geopandas as gpd
+from fires import group_fires_by_buffer
+from gis import CRS_COMPARISON
+from shapely.geometry import Point
+
+
+def make_fires(geoms):
+    return gpd.GeoDataFrame(geometry=geoms, crs=CRS_COMPARISON)
+
+
+def test_group_nearby_points():
+    df_groups = group_fires_by_buffer(make_fires([Point(0, 0), Point(500, 0)]))
+    assert 1 == len(df_groups)
+    # has to stay a Point or tbd would rasterize it as a perimeter
+    assert ["Point"] == list(df_groups.geom_type)
+
+
+def test_group_far_points():
+    df_groups = group_fires_by_buffer(make_fires([Point(0, 0), Point(100000, 0)]))
+    assert ["Point", "Point"] == list(df_groups.geom_type)
+
+
+def test_group_point_near_polygon():
+    df_groups = group_fires_by_buffer(make_fires([Point(0, 0), Point(1000, 0).buffer(200)]))
+    assert ["Polygon"] == list(df_groups.geom_type)
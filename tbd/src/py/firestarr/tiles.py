@@ -0,0 +1,316 @@
+"""
+Web map tiles of merged probability rasters
+
+Renders XYZ tiles (EPSG:3857, same layout WMTS GoogleMapsCompatible uses) for
+each day in combined/ into tiles/day_NN/{z}/{x}/{y}.png so they can be pushed
+as-is. Each day keeps a manifest of hashes for blocks of the merged raster so
+only tiles over blocks that changed get rendered again.
+
+Usage: python tiles.py [dir_output] [max_zoom]
+"""
+
+import hashlib
+import math
+import os
+import re
+import shutil
+import sys
+
+import numpy as np
+from common import CONFIG, dump_json, ensure_dir, force_remove, listdir_sorted, logging, read_json_safe
+from gis import GRID_ORIGIN
+from osgeo import gdal, osr
+from tqdm_util import pmap
+
+TILE_SIZE = 256
+# half of the width of the world in EPSG:3857
+WEB_MERCATOR_EXTENT = 20037508.342789244
+# zoomed out far enough to see all of canada in a few tiles
+DEFAULT_MIN_ZOOM = 3
+# cells along each side of blocks that get hashed to find what changed
+TILE_BLOCK_CELLS = 512
+TILE_EXTENSIONS = {"PNG": "png", "WEBP": "webp"}
+TILE_CREATION_OPTIONS = {"PNG": ["ZLEVEL=6"], "WEBP": ["LOSSLESS=TRUE"]}
+FILE_MANIFEST = "tiles.json"
+# NOTE: same as gis/symbology/probability.sld, where colour is for values up to quantity
+PROBABILITY_COLOURS = [
+    (0, "#ffffff", 0),
+    (0.000000001, "#ffffff", 0),
+    (0.1, "#00b1f2", 1),
+    (0.2, "#faf68e", 1),
+    (0.3, "#fcdf4b", 1),
+    (0.4, "#fac044", 1),
+    (0.5, "#f5a23d", 1),
+    (0.6, "#f28938", 1),
+    (0.7, "#f06c33", 1),
+    (0.8, "#ee4f2c", 1),
+    (0.9, "#eb3326", 1),
+    (1.000000001, "#e6151f", 1),
+    (2.000000001, "#64292a", 1),
+    (999, "#b7b7b7", 1),
+]
+# path -> (mtime, dataset) so each process only opens rasters once
+TILE_SOURCES = {}
+
+
+def get_max_zoom():
+    max_zoom = CONFIG.get("TILE_MAX_ZOOM", None)
+    # nothing set means don't make tiles
+    return None if not max_zoom else int(max_zoom)
+
+
+def get_tile_format():
+    return (CONFIG.get("TILE_FORMAT", None) or "PNG").upper()
+
+
+def make_palette(colours=PROBABILITY_COLOURS):
+    quantities = np.array([q for q, _, _ in colours], dtype=np.float64)
+    # extra entry at end for anything past last quantity
+    palette = np.zeros((len(colours) + 1, 4), dtype=np.uint8)
+    for i, (_, colour, opacity) in enumerate(colours):
+        palette[i] = [int(colour[j : j + 2], 16) for j in (1, 3, 5)] + [round(255 * opacity)]
+    return quantities, palette
+
+
+def colourize(data, colours=PROBABILITY_COLOURS):
+    """!
+    Apply colour ramp to probability values
+    @param data Array of values
+    @param colours List of (quantity, colour, opacity) intervals
+    @return Array of RGBA values with an extra last dimension of 4
+    """
+    quantities, palette = make_palette(colours)
+    # first interval with quantity above value, and NaN sorts past the end
+    return palette[np.searchsorted(quantities, data, side="right")]
+
+
+def tile_span(z):
+    return 2 * WEB_MERCATOR_EXTENT / (1 << z)
+
+
+def tile_bounds(z, x, y):
+    span = tile_span(z)
+    minx = -WEB_MERCATOR_EXTENT + x * span
+    maxy = WEB_MERCATOR_EXTENT - y * span
+    return (minx, maxy - span, minx + span, maxy)
+
+
+def find_tiles(bounds, z):
+    """!
+    Find tiles that overlap bounds
+    @param bounds (minx, miny, maxx, maxy) in EPSG:3857
+    @param z Zoom level
+    @return List of (z, x, y) for tiles
+    """
+    minx, miny, maxx, maxy = bounds
+    span = tile_span(z)
+    n = 1 << z
+
+    def clamp(v):
+        return min(n - 1, max(0, int(v)))
+
+    # edges that are exactly on a tile boundary don't need the tile past them
+    x0 = clamp(math.floor((minx + WEB_MERCATOR_EXTENT) / span))
+    x1 = clamp(math.ceil((maxx + WEB_MERCATOR_EXTENT) / span) - 1)
+    y0 = clamp(math.floor((WEB_MERCATOR_EXTENT - maxy) / span))
+    y1 = clamp(math.ceil((WEB_MERCATOR_EXTENT - miny) / span) - 1)
+    return [(z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def find_block_windows(src, block_cells=TILE_BLOCK_CELLS):
+    gt = src.GetGeoTransform()
+    # line blocks up with grid so they stay the same as the merged extent grows
+    off_x = round((gt[0] - GRID_ORIGIN[0]) / gt[1]) % block_cells
+    off_y = round((GRID_ORIGIN[1] - gt[3]) / -gt[5]) % block_cells
+    for row in range(-off_y, src.RasterYSize, block_cells):
+        for col in range(-off_x, src.RasterXSize, block_cells):
+            key = f"{round(gt[0] + col * gt[1])}_{round(gt[3] + row * gt[5])}"
+            x0, y0 = max(0, col), max(0, row)
+            x1, y1 = min(src.RasterXSize, col + block_cells), min(src.RasterYSize, row + block_cells)
+            yield key, (x0, y0, x1 - x0, y1 - y0)
+
+
+def find_block_hashes(path, block_cells=TILE_BLOCK_CELLS):
+    """!
+    Hash blocks of raster that have any probability in them
+    @param path Raster to read
+    @param block_cells Number of cells along each side of blocks
+    @return Dictionary of block key -> [md5, bounds in EPSG:3857]
+    """
+    src = gdal.Open(path)
+    try:
+        gt = src.GetGeoTransform()
+        band = src.GetRasterBand(1)
+        srs_tiles = osr.SpatialReference()
+        srs_tiles.ImportFromEPSG(3857)
+        srs_src = src.GetSpatialRef()
+        for srs in [srs_src, srs_tiles]:
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(srs_src, srs_tiles)
+        blocks = {}
+        for key, (x, y, w, h) in find_block_windows(src, block_cells):
+            data = band.ReadAsArray(x, y, w, h)
+            # nodata is either 0 or -1 so this is anything that could burn
+            if not (data > 0).any():
+                continue
+            bounds = transform.TransformBounds(
+                gt[0] + x * gt[1],
+                gt[3] + (y + h) * gt[5],
+                gt[0] + (x + w) * gt[1],
+                gt[3] + y * gt[5],
+                21,
+            )
+            blocks[key] = [hashlib.md5(data.tobytes()).hexdigest(), list(bounds)]
+        return blocks
+    finally:
+        src = None
+
+
+def open_tile_source(path):
+    mtime = os.path.getmtime(path)
+    cached = TILE_SOURCES.get(path, None)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, gdal.Open(path))
+        TILE_SOURCES[path] = cached
+    return cached[1]
+
+
+def find_tile_path(dir_layer, z, x, y, fmt):
+    return os.path.join(dir_layer, str(z), str(x), f"{y}.{TILE_EXTENSIONS[fmt]}")
+
+
+def render_tile(path, dir_layer, z, x, y, fmt):
+    """!
+    Render a single tile from a merged raster
+    @param path Merged raster to render
+    @param dir_layer Directory to put tiles for raster in
+    @param z Zoom level
+    @param x Tile column
+    @param y Tile row
+    @param fmt GDAL driver to save tile with
+    @return Whether tile has anything in it
+    """
+    src = open_tile_source(path)
+    file_tile = find_tile_path(dir_layer, z, x, y, fmt)
+    # keep small fires visible when zoomed out by taking max instead of sampling
+    resample = "max" if (tile_span(z) / TILE_SIZE) > src.GetGeoTransform()[1] else "near"
+    warp = gdal.Warp(
+        "",
+        src,
+        format="MEM",
+        outputBounds=tile_bounds(z, x, y),
+        width=TILE_SIZE,
+        height=TILE_SIZE,
+        dstSRS="EPSG:3857",
+        resampleAlg=resample,
+        outputType=gdal.GDT_Float32,
+        dstNodata=0,
+        # NOTE: overviews are averaged so they would fade out small fires
+        options=["-ovr", "NONE"],
+    )
+    rgba = colourize(warp.ReadAsArray())
+    warp = None
+    if not rgba[:, :, 3].any():
+        # nothing there anymore so get rid of old tile
+        force_remove(file_tile, verbose=False)
+        return False
+    mem = gdal.GetDriverByName("MEM").Create("", TILE_SIZE, TILE_SIZE, 4, gdal.GDT_Byte)
+    for i in range(4):
+        mem.GetRasterBand(i + 1).WriteArray(rgba[:, :, i])
+    ensure_dir(os.path.dirname(file_tile))
+    file_tmp = f"{file_tile}.tmp"
+    gdal.GetDriverByName(fmt).CreateCopy(file_tmp, mem, options=TILE_CREATION_OPTIONS.get(fmt, []))
+    mem = None
+    # replace so anything uploading never sees a partial tile
+    os.replace(file_tmp, file_tile)
+    return True
+
+
+def find_layer(file):
+    # firestarr_{run_id}_day_NN_{date}.tif
+    m = re.search(r"_(day_\d+)_\d{8}\.tif$", file)
+    return None if m is None else m.group(1)
+
+
+def make_tiles(dir_output, min_zoom=DEFAULT_MIN_ZOOM, max_zoom=None, fmt=None, force=False):
+    """!
+    Render tiles for merged rasters where they changed since last time
+    @param dir_output Run output directory with combined/ in it
+    @param min_zoom Lowest zoom level to render
+    @param max_zoom Highest zoom level to render (None to use TILE_MAX_ZOOM)
+    @param fmt GDAL driver to save tiles with (None to use TILE_FORMAT)
+    @param force Whether to render everything again
+    @return Whether any tiles changed
+    """
+    if max_zoom is None:
+        max_zoom = get_max_zoom()
+        if max_zoom is None:
+            return False
+    if fmt is None:
+        fmt = get_tile_format()
+    if fmt not in TILE_EXTENSIONS:
+        raise RuntimeError(f"Unknown tile format {fmt}")
+    dir_combined = os.path.join(dir_output, "combined")
+    dir_tiles = ensure_dir(os.path.join(dir_output, "tiles"))
+    layers = {
+        find_layer(f): os.path.join(dir_combined, f)
+        for f in listdir_sorted(dir_combined)
+        if find_layer(f) is not None
+    }
+    any_change = False
+    for layer in listdir_sorted(dir_tiles):
+        if layer not in layers:
+            logging.info(f"Removing tiles for {layer}")
+            shutil.rmtree(os.path.join(dir_tiles, layer), ignore_errors=True)
+            any_change = True
+    settings = {
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "format": fmt,
+        "block_cells": TILE_BLOCK_CELLS,
+        "colours": [list(x) for x in PROBABILITY_COLOURS],
+    }
+    jobs = []
+    manifests = {}
+    for layer, path in layers.items():
+        dir_layer = os.path.join(dir_tiles, layer)
+        file_manifest = os.path.join(dir_layer, FILE_MANIFEST)
+        stat = os.stat(path)
+        source = {"file": os.path.basename(path), "mtime": stat.st_mtime, "size": stat.st_size}
+        manifest = read_json_safe(file_manifest) if os.path.isfile(file_manifest) else None
+        if force or manifest is None or manifest["settings"] != settings:
+            # anything there was made differently so start over
+            shutil.rmtree(dir_layer, ignore_errors=True)
+            manifest = {"source": None, "blocks": {}}
+        elif manifest["source"] == source:
+            logging.debug(f"Tiles for {layer} are up to date")
+            continue
+        blocks = find_block_hashes(path)
+        old = manifest["blocks"]
+        changed = [
+            (blocks.get(k, None) or old[k])[1] for k in set(blocks).union(old) if blocks.get(k, None) != old.get(k, None)
+        ]
+        tiles = set()
+        for bounds in changed:
+            for z in range(min_zoom, max_zoom + 1):
+                tiles.update(find_tiles(bounds, z))
+        logging.info(f"Rendering {len(tiles)} tiles for {len(changed)} changed blocks of {layer}")
+        jobs += [(path, dir_layer, z, x, y, fmt) for z, x, y in sorted(tiles)]
+        manifests[file_manifest] = {"settings": settings, "source": source, "blocks": blocks}
+    if jobs:
+        # spread across days and zoom levels since rendering is independent
+        pmap(lambda job: render_tile(*job), jobs, desc="Rendering tiles")
+        any_change = True
+    # only say tiles are done once they're all rendered
+    for file_manifest, manifest in manifests.items():
+        ensure_dir(os.path.dirname(file_manifest))
+        dump_json(manifest, file_manifest)
+    return any_change
+
+
+if __name__ == "__main__":
+    from publish import find_latest_outputs
+
+    dir_output = find_latest_outputs(sys.argv[1] if len(sys.argv) > 1 else None)
+    max_zoom = int(sys.argv[2]) if len(sys.argv) > 2 else (get_max_zoom() or 10)
+    make_tiles(dir_output, max_zoom=max_zoom)
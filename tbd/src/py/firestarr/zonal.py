@@ -0,0 +1,303 @@
+"""
+Zonal statistics of probability for bounds regions and fire groups
+
+For each output day this finds the probability-weighted burned area and the
+area at or above each threshold. Bounds get rasterized onto the merge grid once
+and each day's merged raster is read a block at a time in a single pass. Fire
+groups are summarized from their own rasters in reprojected/ since their
+probability reaches well past the perimeters they start from.
+
+Usage: python zonal.py [dir_output]
+"""
+
+import datetime
+import math
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+from common import (
+    BOUNDS,
+    DIR_GENERATED,
+    DIR_RUNS,
+    FMT_DATE_YMD,
+    FLAG_SPARSE_MERGE,
+    TMP_SUFFIX,
+    dump_json,
+    ensure_dir,
+    is_newer_than,
+    list_dirs,
+    listdir_sorted,
+    logging,
+    read_json_safe,
+    to_csv_safe,
+)
+from gis import GRID_CELL_SIZE, GRID_CRS, GRID_ORIGIN, HA_TO_MSQ, find_bounds_index, is_on_grid, iter_blocks
+from osgeo import gdal, ogr, osr
+from sparse import SparseRaster, is_sparse
+
+ZONAL_THRESHOLDS = [0.1, 0.5, 0.9]
+DIR_ZONES = os.path.join(DIR_GENERATED, "zones")
+FILE_ZONAL = "df_fires_zonal.csv"
+# saved beside FILE_ZONAL so a new process doesn't have to read everything again
+FILE_ZONAL_CACHE = "df_fires_zonal_cache.json"
+# (raster, zones) -> (signature, stats) so rasters that haven't changed don't get read again
+ZONAL_CACHE = {}
+
+
+def make_zone_raster(file_bounds, file_zones=None):
+    """!
+    Rasterize bounds onto the merge grid, with each cell being 1 + index of bounds it's in
+    @param file_bounds Bounds file to rasterize
+    @param file_zones Raster to save to (None to put it in DIR_ZONES)
+    @return Tuple of bounds and path to raster
+    """
+    if file_zones is None:
+        base = os.path.splitext(os.path.basename(file_bounds))[0]
+        file_zones = os.path.join(ensure_dir(DIR_ZONES), f"{base}_{GRID_CELL_SIZE}m.tif")
+    df_bounds, _ = find_bounds_index(file_bounds, GRID_CRS)
+    if os.path.isfile(file_zones) and not is_newer_than(file_bounds, file_zones):
+        return df_bounds, file_zones
+    logging.info(f"Rasterizing {file_bounds} to {file_zones}")
+    if len(df_bounds) >= np.iinfo(np.uint16).max:
+        raise RuntimeError(f"Too many bounds in {file_bounds} to rasterize")
+    # snap outwards to grid so cells line up with merged outputs
+    minx, miny, maxx, maxy = df_bounds.total_bounds
+    minx = GRID_ORIGIN[0] + math.floor((minx - GRID_ORIGIN[0]) / GRID_CELL_SIZE) * GRID_CELL_SIZE
+    miny = GRID_ORIGIN[1] + math.floor((miny - GRID_ORIGIN[1]) / GRID_CELL_SIZE) * GRID_CELL_SIZE
+    maxx = GRID_ORIGIN[0] + math.ceil((maxx - GRID_ORIGIN[0]) / GRID_CELL_SIZE) * GRID_CELL_SIZE
+    maxy = GRID_ORIGIN[1] + math.ceil((maxy - GRID_ORIGIN[1]) / GRID_CELL_SIZE) * GRID_CELL_SIZE
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(GRID_CRS)
+    ds_bounds = ogr.GetDriverByName("Memory").CreateDataSource("zones")
+    lyr = ds_bounds.CreateLayer("zones", srs, ogr.wkbUnknown)
+    lyr.CreateField(ogr.FieldDefn("zone", ogr.OFTInteger))
+    for i, geom in enumerate(df_bounds.geometry):
+        feature = ogr.Feature(lyr.GetLayerDefn())
+        feature.SetField("zone", i + 1)
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(geom.wkb))
+        lyr.CreateFeature(feature)
+        feature = None
+    file_tmp = f"{file_zones}.tmp"
+    output = gdal.GetDriverByName("GTiff").Create(
+        file_tmp,
+        round((maxx - minx) / GRID_CELL_SIZE),
+        round((maxy - miny) / GRID_CELL_SIZE),
+        1,
+        gdal.GDT_UInt16,
+        options=["COMPRESS=LZW", "TILED=YES", "BLOCKSIZE=512", "BIGTIFF=YES"],
+    )
+    output.SetProjection(srs.ExportToWkt())
+    output.SetGeoTransform([minx, GRID_CELL_SIZE, 0, maxy, 0, -GRID_CELL_SIZE])
+    output.GetRasterBand(1).SetNoDataValue(0)
+    # NOTE: where bounds overlap the cell goes to whichever is last
+    gdal.RasterizeLayer(output, [1], lyr, options=["ATTRIBUTE=zone"])
+    output = None
+    lyr = None
+    ds_bounds = None
+    os.replace(file_tmp, file_zones)
+    return df_bounds, file_zones
+
+
+def read_window(band, xoff, yoff, w, h):
+    # anything outside of band is zone 0
+    result = np.zeros((h, w), dtype=np.intp)
+    x0, y0 = max(0, xoff), max(0, yoff)
+    x1, y1 = min(band.XSize, xoff + w), min(band.YSize, yoff + h)
+    if x0 < x1 and y0 < y1:
+        result[(y0 - yoff) : (y1 - yoff), (x0 - xoff) : (x1 - xoff)] = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+    return result
+
+
+def find_zone_stats(file_raster, file_zones=None, num_zones=0, thresholds=ZONAL_THRESHOLDS):
+    """!
+    Accumulate probability for each zone in a single pass through raster
+    @param file_raster Probability raster to summarize
+    @param file_zones Raster of zone for each cell on same grid (None to put everything in zone 0)
+    @param num_zones Highest zone number in file_zones
+    @param thresholds Probabilities to find area at or above
+    @return Array with a column for each zone and rows for weighted area and area above each threshold (ha)
+    """
+    result = np.zeros((len(thresholds) + 1, num_zones + 1))
+
+    def accumulate(ids, p):
+        result[0] += np.bincount(ids, weights=p, minlength=num_zones + 1)
+        for i, t in enumerate(thresholds):
+            result[i + 1] += np.bincount(ids[p >= t], minlength=num_zones + 1)
+
+    if is_sparse(file_raster):
+        if file_zones is not None:
+            raise RuntimeError(f"Can't use zones for sparse raster {file_raster}")
+        # already just the cells with data
+        sr = SparseRaster(file_raster)
+        p = sr.values[sr.values > 0].astype(np.float64)
+        accumulate(np.zeros(len(p), dtype=np.intp), p)
+        return result * (sr.geotransform[1] * -sr.geotransform[5] / HA_TO_MSQ)
+    src = gdal.Open(file_raster)
+    zones = None if file_zones is None else gdal.Open(file_zones)
+    try:
+        gt = src.GetGeoTransform()
+        band_zones = None
+        if zones is not None:
+            gt_zones = zones.GetGeoTransform()
+            # same cell size isn't enough since cells could still be offset from each other
+            for f in [file_raster, file_zones]:
+                if not is_on_grid(f):
+                    raise RuntimeError(f"Can't find zonal statistics for {f} since it isn't on the merge grid")
+            band_zones = zones.GetRasterBand(1)
+            # where raster starts in zones, which is a whole number of cells since both are on grid
+            dx = round((gt[0] - gt_zones[0]) / gt_zones[1])
+            dy = round((gt[3] - gt_zones[3]) / gt_zones[5])
+        for xoff, yoff, data in iter_blocks(src.GetRasterBand(1)):
+            # nodata is either 0 or -1 so this is anything that could burn
+            burn = data > 0
+            if not burn.any():
+                continue
+            p = data[burn].astype(np.float64)
+            if band_zones is None:
+                ids = np.zeros(len(p), dtype=np.intp)
+            else:
+                ids = read_window(band_zones, dx + xoff, dy + yoff, data.shape[1], data.shape[0])[burn]
+            accumulate(ids, p)
+        return result * (gt[1] * -gt[5] / HA_TO_MSQ)
+    finally:
+        src = None
+        zones = None
+
+
+def find_cached_stats(file_raster, file_zones=None, num_zones=0, thresholds=ZONAL_THRESHOLDS):
+    files = [file_raster] + ([] if file_zones is None else [file_zones])
+    # lists instead of tuples so it compares equal after being read from json
+    signature = [[[os.path.getmtime(f), os.path.getsize(f)] for f in files], num_zones, list(thresholds)]
+    key = (file_raster, file_zones)
+    cached = ZONAL_CACHE.get(key, None)
+    if cached is None or cached[0] != signature:
+        cached = (signature, find_zone_stats(file_raster, file_zones, num_zones, thresholds))
+        ZONAL_CACHE[key] = cached
+    return cached[1]
+
+
+def load_zonal_cache(file_cache):
+    if not os.path.isfile(file_cache):
+        return
+    try:
+        for file_raster, file_zones, signature, stats in read_json_safe(file_cache):
+            # anything already in memory is at least as new
+            ZONAL_CACHE.setdefault((file_raster, file_zones), (signature, np.array(stats)))
+    except KeyboardInterrupt as ex:
+        raise ex
+    except Exception as ex:
+        logging.warning(f"Ignoring invalid zonal statistics cache {file_cache}: {ex}")
+
+
+def save_zonal_cache(file_cache, keys):
+    entries = []
+    for key in dict.fromkeys(keys):
+        signature, stats = ZONAL_CACHE[key]
+        entries.append(list(key) + [signature, stats.tolist()])
+    dump_json(entries, file_cache)
+
+
+def find_fire_rasters(dir_date):
+    """!
+    Find the one raster to use for each fire
+    @param dir_date Directory of rasters for a single date
+    @return Dictionary of fire name to raster path
+    """
+    by_fire = {}
+    for f in listdir_sorted(dir_date):
+        if not (f.endswith(".tif") or is_sparse(f)):
+            continue
+        fire_name = os.path.splitext(f)[0].replace(TMP_SUFFIX, "")
+        by_fire.setdefault(fire_name, []).append(os.path.join(dir_date, f))
+
+    def pick(path):
+        # whatever merge is using now, then final outputs over interim ones, then newest
+        return (is_sparse(path) == FLAG_SPARSE_MERGE, TMP_SUFFIX not in path, os.path.getmtime(path))
+
+    return {fire_name: max(paths, key=pick) for fire_name, paths in by_fire.items()}
+
+
+def find_merged_rasters(dir_output):
+    """!
+    Find the one merged raster to use for each day
+    @param dir_output Run output directory with combined/ and maybe views/ in it
+    @return Dictionary of (day, date) to raster path
+    """
+    by_day = {}
+    for dir_merged in ["combined", "views"]:
+        dir_merged = os.path.join(dir_output, dir_merged)
+        if not os.path.isdir(dir_merged):
+            continue
+        for f in listdir_sorted(dir_merged):
+            m = re.search(r"_day_(\d+)_(\d{8})\.(tif|vrt)$", f)
+            if m is None:
+                continue
+            by_day.setdefault((int(m.group(1)), m.group(2)), []).append(os.path.join(dir_merged, f))
+    # views from lazy merges are only newer than combined/ until it gets merged again
+    return {k: max(paths, key=os.path.getmtime) for k, paths in sorted(by_day.items())}
+
+
+def make_zonal_stats(dir_output, dir_out=None, file_bounds=None, thresholds=ZONAL_THRESHOLDS):
+    """!
+    Summarize probability for each bounds region and fire group for each day
+    @param dir_output Run output directory with combined/, views/ and reprojected/ in it
+    @param dir_out Directory to save table in (None for data folder of run)
+    @param file_bounds Bounds file to use for regions (None to use BOUNDS_FILE)
+    @param thresholds Probabilities to find area at or above
+    @return DataFrame of statistics
+    """
+    run_name = os.path.basename(dir_output)
+    if dir_out is None:
+        dir_out = os.path.join(DIR_RUNS, run_name, "data")
+    if file_bounds is None:
+        file_bounds = BOUNDS["bounds"]
+    columns_stats = ["prob_area_ha"] + [f"area_{round(t * 100)}pct_ha" for t in thresholds]
+    file_cache = os.path.join(ensure_dir(dir_out), FILE_ZONAL_CACHE)
+    load_zonal_cache(file_cache)
+    keys = []
+    rows = []
+
+    def find_stats(file_raster, file_zones=None, num_zones=0):
+        keys.append((file_raster, file_zones))
+        return find_cached_stats(file_raster, file_zones, num_zones, thresholds)
+
+    def add_rows(zone_type, names, day, for_date, stats):
+        # no point in listing zones that nothing can burn in
+        for i in np.flatnonzero(stats[0]):
+            rows.append([zone_type, names[i], day, for_date] + list(stats[:, i]))
+
+    merged = find_merged_rasters(dir_output)
+    if file_bounds and merged:
+        df_bounds, file_zones = make_zone_raster(file_bounds)
+        ids = list(df_bounds["ID"] if "ID" in df_bounds.columns else df_bounds.index)
+        for (day, for_date), file_raster in merged.items():
+            stats = find_stats(file_raster, file_zones, len(df_bounds))
+            # zone 0 is outside of all bounds
+            add_rows("bounds", [None] + ids, day, for_date, stats)
+    dir_reprojected = os.path.join(dir_output, "reprojected")
+    dates = [x for x in list_dirs(dir_reprojected) if re.fullmatch(r"\d{8}", x)] if os.path.isdir(dir_reprojected) else []
+    if dates:
+        # same as what merge_dirs() uses for day numbers
+        date_origin = datetime.datetime.strptime(min(dates), FMT_DATE_YMD)
+        for for_date in dates:
+            day = (datetime.datetime.strptime(for_date, FMT_DATE_YMD) - date_origin).days + 1
+            for fire_name, file_raster in find_fire_rasters(os.path.join(dir_reprojected, for_date)).items():
+                add_rows("fire", [fire_name], day, for_date, find_stats(file_raster))
+    df = pd.DataFrame(rows, columns=["zone_type", "zone", "day", "for_date"] + columns_stats)
+    file_zonal = os.path.join(ensure_dir(dir_out), FILE_ZONAL)
+    to_csv_safe(df.round(2), file_zonal, index=False)
+    logging.info(f"Saved statistics for {len(df)} zones and days to {file_zonal}")
+    # only keep what's still in use so cache doesn't grow with every run
+    for key in set(ZONAL_CACHE.keys()).difference(keys):
+        del ZONAL_CACHE[key]
+    save_zonal_cache(file_cache, keys)
+    return df
+
+
+if __name__ == "__main__":
+    from publish import find_latest_outputs
+
+    print(make_zonal_stats(find_latest_outputs(sys.argv[1] if len(sys.argv) > 1 else None)))